@@ -1,14 +1,30 @@
-from fastapi import Depends, HTTPException, status, APIRouter
-from sqlmodel import Session, select
+import asyncio
+import json
+import time
+from typing import Any, Optional, cast
+from fastapi import BackgroundTasks, Depends, Header, HTTPException, status, APIRouter
+from sqlmodel import Session
 from fastapi.responses import StreamingResponse
+from fastapi.concurrency import run_in_threadpool
 
-from ..models import Story, StoryOutline, ChapterOutline, SceneOutline, Scene, Query, ApiCall
+from ..models import User, Story, StoryOutline, ChapterOutline, SceneOutline, Scene
 from .. import orchestrator
+from .. import formats
+from ..book import run_book
+from ..error import GenerationTimeout, OrchestrationError, JobConflict
+from ..progress import Progress, track
+from ..jobs import Job, get_job_workers, parse_event_id
+from ..checkpoint import resuming
 from ..dependencies import GetDbObject
-from ..database import get_db_session
+from ..auth_config import get_current_user
+from ..database import engine
+from ..config import get_settings
 
 
 router = APIRouter()
+conf = get_settings()
+
+_DONE = object()
 
 
 def sse_convert(string):
@@ -21,76 +37,365 @@ def sse_convert(string):
 
     return f"data: {data}\n\n"
 
-def generator_pipeline(gen):
+class _Failed():
+    def __init__(self, error: BaseException):
+        self.error = error
+
+
+async def coalesce_chunks(gen, flush_interval: float, flush_bytes: int, buffer_size: int, heartbeat: Optional[float] = None):
+    """
+    Merge the tiny text deltas from gen into fewer, larger chunks.
+
+    Text is held until flush_interval seconds have passed since the first held delta, or
+    flush_bytes have built up, whichever comes first. Anything that isn't text flushes the
+    held text and passes through in order.
+
+    gen is drained by a separate task into a queue of at most buffer_size items. When the
+    client reads slowly the queue fills and the task stops pulling from gen, which in turn
+    stops reading from the API, rather than output piling up in memory.
+
+    With a heartbeat, None is yielded whenever heartbeat seconds pass with nothing else to
+    yield, so the caller gets a chance to send something while the model is quiet.
+    """
+    buffer: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+
+    async def produce():
+        try:
+            async for item in gen:
+                await buffer.put(item)
+        except Exception as e:
+            await buffer.put(_Failed(e))
+        else:
+            await buffer.put(_DONE)
+
+    producer = asyncio.create_task(produce())
+    loop = asyncio.get_running_loop()
+    held: list[str] = []
+    held_bytes = 0
+    deadline = 0.0
+    # kept across flushes, cancelling a get() on timeout could drop an item
+    getter = None
+    try:
+        while True:
+            if getter is None:
+                getter = asyncio.ensure_future(buffer.get())
+            if held:
+                done, _ = await asyncio.wait({getter}, timeout=max(0.0, deadline - loop.time()))
+                if not done:
+                    yield "".join(held)
+                    held, held_bytes = [], 0
+                    continue
+            elif heartbeat:
+                done, _ = await asyncio.wait({getter}, timeout=heartbeat)
+                if not done:
+                    yield None
+                    continue
+            item = await getter
+            getter = None
+
+            if isinstance(item, str):
+                if not held:
+                    deadline = loop.time() + flush_interval
+                held.append(item)
+                held_bytes += len(item.encode())
+                if held_bytes >= flush_bytes:
+                    yield "".join(held)
+                    held, held_bytes = [], 0
+                continue
+
+            if held:
+                yield "".join(held)
+                held, held_bytes = [], 0
+            if item is _DONE:
+                return
+            if isinstance(item, _Failed):
+                raise item.error
+            yield item
+    finally:
+        if getter is not None:
+            getter.cancel()
+        producer.cancel()
+
+
+async def fan_out(streams: dict[int, Any], concurrency: int, buffer_size: int):
+    """
+    Run streams side by side, at most concurrency of them at once, yielding (key, item) as
+    items arrive. A stream that fails yields (key, exception) and the others carry on.
+
+    Closing this generator cancels whatever is still running.
+    """
+    merged: asyncio.Queue = asyncio.Queue(maxsize=buffer_size)
+    slots = asyncio.Semaphore(max(1, concurrency))
+
+    async def run(key: int, stream):
+        try:
+            async with slots:
+                async for item in stream:
+                    await merged.put((key, item))
+        except Exception as e:
+            await merged.put((key, e))
+        await merged.put((key, _DONE))
+
+    tasks = [asyncio.create_task(run(key, stream)) for key, stream in streams.items()]
+    running = len(tasks)
+    try:
+        while running:
+            key, item = await merged.get()
+            if item is _DONE:
+                running -= 1
+                continue
+            yield key, item
+    finally:
+        for task in tasks:
+            task.cancel()
+
+
+def metrics_event(progress: Progress) -> str:
+    return f"\n\nevent: metrics\ndata: {json.dumps(progress.snapshot())}\n\nevent: chunks\n"
+
+
+async def generator_pipeline(gen):
+    progress = Progress()
+    interval = conf.SSE_METRICS_INTERVAL
+    last_metrics = time.monotonic()
     yield f"event: chunks\n"
-    for result in gen:
-        if isinstance(result, str):
-            y =  sse_convert(result)
-            # print("last yield", y)
-            yield y
-        elif result is None:
+    try:
+        async for result in coalesce_chunks(track(gen, progress), conf.SSE_FLUSH_INTERVAL, conf.SSE_FLUSH_BYTES,
+                                            conf.SSE_BUFFER_SIZE, heartbeat=interval or None):
+            if interval and time.monotonic() - last_metrics >= interval:
+                yield metrics_event(progress)
+                last_metrics = time.monotonic()
+            if isinstance(result, str):
+                y =  sse_convert(result)
+                # print("last yield", y)
+                yield y
+            elif result is None:
+                continue
+            elif isinstance(result, orchestrator.MidPoint):
+                yield f"\n\nevent: mid_point\n"
+                yield f"data: {result.step_name}\n\n"
+                yield f"event: chunks\n"
+            elif isinstance(result, formats.Section):
+                yield f"\n\nevent: section\ndata: {result.json()}\n\nevent: chunks\n"
+            else:
+                if interval:
+                    yield metrics_event(progress)
+                yield f"\n\nevent: result\n"
+                yield f"data: {result.json()}\n\n"
+    except GenerationTimeout as e:
+        print("GENERATION TIMED OUT, METRICS: ", progress.snapshot())
+        # tell the client, rather than leave it on a stream that just ends
+        yield f"\n\nevent: timeout\n"
+        yield f"data: {json.dumps({'step': e.step, 'detail': e.message})}\n\n"
+    except Exception:
+        # the client gets the metrics as they go, only keep them where something went wrong
+        print("GENERATION FAILED, METRICS: ", progress.snapshot())
+        raise
+
+async def chapter_outline_stream(chapter_id: int):
+    """
+    generate_chapter_outline on a session of its own, so the chapters fanned out side by side
+    never share one.
+    """
+    with Session(engine) as session:
+        chapter = session.get(ChapterOutline, chapter_id)
+        if chapter is None:
+            raise OrchestrationError(f"chapter-outline {chapter_id} no longer exists")
+        async for item in orchestrator.generate_chapter_outline(chapter, session):
+            yield item
+
+
+async def chapter_outlines_pipeline(story_outline: StoryOutline):
+    """
+    Every current chapter outline of story_outline at once, CHAPTER_FANOUT_CONCURRENCY at a time,
+    multiplexed into one SSE stream. Events carry the chapter they belong to, and a chapter that
+    fails doesn't stop the others. A summary event closes the stream.
+    """
+    started = time.monotonic()
+    chapters = {cast(int, chapter.id): chapter for chapter in story_outline.chapter_outlines if not chapter.invalidated}
+    streams = {chapter_id: coalesce_chunks(chapter_outline_stream(chapter_id),
+                                           conf.SSE_FLUSH_INTERVAL, conf.SSE_FLUSH_BYTES, conf.SSE_BUFFER_SIZE)
+               for chapter_id in chapters}
+    failed: dict[int, str] = {}
+    succeeded: list[int] = []
+
+    def event(name: str, chapter_id: int, **data) -> str:
+        payload = {"chapter_id": chapter_id, "chapter_number": chapters[chapter_id].chapter_number, **data}
+        return f"event: {name}\ndata: {json.dumps(payload)}\n\n"
+
+    async for chapter_id, item in fan_out(streams, conf.CHAPTER_FANOUT_CONCURRENCY, conf.SSE_BUFFER_SIZE):
+        if isinstance(item, str):
+            yield event("chapter_chunks", chapter_id, text=item)
+        elif item is None:
             continue
-        elif isinstance(result, orchestrator.MidPoint):
-            yield f"\n\nevent: mid_point\n"
-            yield f"data: {result.step_name}\n\n"
-            yield f"event: chunks\n"
+        elif isinstance(item, orchestrator.MidPoint):
+            yield event("chapter_mid_point", chapter_id, step_name=item.step_name)
+        elif isinstance(item, formats.Section):
+            yield event("chapter_section", chapter_id, **item.dict())
+        elif isinstance(item, Exception):
+            print("CHAPTER OUTLINE FAILED: ", chapter_id, repr(item))
+            failed[chapter_id] = getattr(item, "message", None) or repr(item)
+            yield event("chapter_error", chapter_id, detail=failed[chapter_id])
         else:
-            yield f"\n\nevent: result\n"
-            yield f"data: {result.json()}\n\n"
+            succeeded.append(chapter_id)
+            yield f"event: chapter_result\ndata: {item.json()}\n\n"
 
-def generate_story_base(story: Story, session: Session):
+    summary = {"story_outline_id": story_outline.id,
+               "succeeded": sorted(succeeded),
+               "failed": failed,
+               "elapsed": round(time.monotonic() - started, 2)}
+    print("CHAPTER OUTLINES DONE: ", summary)
+    yield f"event: summary\ndata: {json.dumps(summary)}\n\n"
+
+
+async def generate_story_base(story: Story, session: Session):
 
     gen = orchestrator.generate_story(story, session)
 
-    yield from generator_pipeline(gen)
+    async for event in generator_pipeline(gen):
+        yield event
 
 
-def generate_story_outline(story_outline: StoryOutline, session: Session):
+async def generate_story_outline(story_outline: StoryOutline, session: Session):
 
     gen = orchestrator.generate_story_outline(story_outline, session)
 
-    yield from generator_pipeline(gen)
+    async for event in generator_pipeline(gen):
+        yield event
 
 
-def generate_chapter_outline(chapter: ChapterOutline, session: Session):
+async def generate_chapter_outline(chapter: ChapterOutline, session: Session):
 
     gen = orchestrator.generate_chapter_outline(chapter, session)
 
-    yield from generator_pipeline(gen)
+    async for event in generator_pipeline(gen):
+        yield event
 
 
-def generate_scene_outline(scene: SceneOutline, session: Session):
+async def generate_scene_outline(scene: SceneOutline, session: Session):
 
     gen = orchestrator.generate_scene_outline(scene, session)
 
-    yield from generator_pipeline(gen)
+    async for event in generator_pipeline(gen):
+        yield event
 
 
-def generate_scene_text(scene: Scene, session: Session):
+async def generate_scene_text(scene: Scene, session: Session):
 
     gen = orchestrator.generate_scene_text(scene, session)
 
-    yield from generator_pipeline(gen)
+    async for event in generator_pipeline(gen):
+        yield event
+
+
+# what a job can generate: the object it's for and the stream it runs
+JOB_KINDS = {"story": (Story, generate_story_base),
+             "story-outline": (StoryOutline, generate_story_outline),
+             "story-outline-chapters": (StoryOutline, lambda story_outline, session: chapter_outlines_pipeline(story_outline)),
+             "chapter-outline": (ChapterOutline, generate_chapter_outline),
+             "scene-outline": (SceneOutline, generate_scene_outline),
+             "scene": (Scene, generate_scene_text)}
+
+
+def overlapping_jobs(kind: str, obj: Any) -> list[tuple[str, int]]:
+    """The jobs of other kinds that would generate some of what a job of kind for obj does."""
+    if kind == "chapter-outline":
+        return [("story-outline-chapters", obj.story_outline_id)]
+    if kind == "story-outline-chapters":
+        return [("chapter-outline", cast(int, chapter.id)) for chapter in obj.chapter_outlines if not chapter.invalidated]
+    return []
+
+
+async def run_job(job: Job):
+    """The SSE stream of a job, see jobs.py."""
+    model, pipeline = JOB_KINDS[job["kind"]]
+    with Session(engine) as session:
+        obj = session.get(model, job["target_id"])
+        if obj is None:
+            raise OrchestrationError(f"{job['kind']} {job['target_id']} no longer exists")
+        token = resuming.set(bool(job["resume"]))
+        try:
+            async for event in pipeline(obj, session):
+                yield event
+        finally:
+            resuming.reset(token)
+
+
+async def job_sse(kind: str, obj: Any, last_event_id: Optional[str], resume: bool = False) -> StreamingResponse:
+    """
+    Stream the generation of obj, attaching to the one under way if there is one.
+
+    A Last-Event-ID from the same object's stream picks up where it left off instead, even
+    once the job is done. With resume, steps already done from the same inputs are reused
+    rather than generated again (see checkpoint.py), as they are after a failed job.
+
+    While a job of another kind is generating some of the same objects (a chapter fanned out
+    over its story outline), the request is refused with a 409 naming that job to attach to.
+    """
+    workers = get_job_workers()
+    last = parse_event_id(last_event_id)
+    job = await run_in_threadpool(workers.queue.get, last[0]) if last is not None else None
+    after = 0
+    if job is not None and last is not None and job["kind"] == kind and job["target_id"] == obj.id:
+        after = last[1]
+        print("JOB STREAM RESUMED: ", job["id"], after)
+    else:
+        overlaps = await run_in_threadpool(overlapping_jobs, kind, obj)
+        try:
+            job = await workers.submit(kind, obj.id, obj.author_id, resume, overlaps)
+        except JobConflict as e:
+            raise HTTPException(status_code=status.HTTP_409_CONFLICT, detail=e.message,
+                                headers={"X-Job-Id": str(e.job_id)})
+    return StreamingResponse(workers.attach(job["id"], after), media_type="text/event-stream",
+                             headers={"X-Job-Id": str(job["id"])})
 
 
 @router.get("/story/{obj_id}", response_class=StreamingResponse)
-async def story_sse(story: Story = Depends(GetDbObject(True, model=Story)), session: Session = Depends(get_db_session)):
-    return StreamingResponse(generate_story_base(story, session), media_type="text/event-stream")
+async def story_sse(story: Story = Depends(GetDbObject(True, model=Story)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("story", story, last_event_id, resume)
 
 @router.get("/story-outline/{obj_id}", response_class=StreamingResponse)
-async def story_outline_sse(story_outline: StoryOutline = Depends(GetDbObject(True, model=StoryOutline)), session: Session = Depends(get_db_session)):
-    return StreamingResponse(generate_story_outline(story_outline, session), media_type="text/event-stream")
+async def story_outline_sse(story_outline: StoryOutline = Depends(GetDbObject(True, model=StoryOutline)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("story-outline", story_outline, last_event_id, resume)
+
+@router.get("/story-outline/{obj_id}/chapters", response_class=StreamingResponse)
+async def chapter_outlines_sse(story_outline: StoryOutline = Depends(GetDbObject(True, model=StoryOutline)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("story-outline-chapters", story_outline, last_event_id, resume)
 
 @router.get("/chapter-outline/{obj_id}", response_class=StreamingResponse)
-async def chapter_outline_sse(chapter_outline: ChapterOutline = Depends(GetDbObject(True, model=ChapterOutline)), session: Session = Depends(get_db_session)):
-    return StreamingResponse(generate_chapter_outline(chapter_outline, session), media_type="text/event-stream")
+async def chapter_outline_sse(chapter_outline: ChapterOutline = Depends(GetDbObject(True, model=ChapterOutline)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("chapter-outline", chapter_outline, last_event_id, resume)
 
 @router.get("/scene-outline/{obj_id}", response_class=StreamingResponse)
-async def scene_outline_sse(scene_outline: SceneOutline = Depends(GetDbObject(True, model=SceneOutline)), session: Session = Depends(get_db_session)):
-    return StreamingResponse(generate_scene_outline(scene_outline, session), media_type="text/event-stream")
+async def scene_outline_sse(scene_outline: SceneOutline = Depends(GetDbObject(True, model=SceneOutline)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("scene-outline", scene_outline, last_event_id, resume)
 
 @router.get("/scene/{obj_id}", response_class=StreamingResponse)
-async def scene_sse(scene: Scene = Depends(GetDbObject(True, model=Scene)), session: Session = Depends(get_db_session)):
-    return StreamingResponse(generate_scene_text(scene, session), media_type="text/event-stream")
-
-
+async def scene_sse(scene: Scene = Depends(GetDbObject(True, model=Scene)), last_event_id: Optional[str] = Header(None), resume: bool = False):
+    return await job_sse("scene", scene, last_event_id, resume)
+
+async def get_job(job_id: int, current_user: User = Depends(get_current_user)) -> Job:
+    job = await run_in_threadpool(get_job_workers().queue.get, job_id)
+    if job is None:
+        raise HTTPException(status_code=status.HTTP_404_NOT_FOUND, detail="Job not found")
+    if job["author_id"] != current_user.id:
+        raise HTTPException(status_code=status.HTTP_403_FORBIDDEN, detail="Not authorized to access this job")
+    return job
+
+@router.get("/jobs/{job_id}")
+async def job_status(job: Job = Depends(get_job)):
+    return job
+
+@router.get("/jobs/{job_id}/events", response_class=StreamingResponse)
+async def job_events(job: Job = Depends(get_job), last_event_id: Optional[str] = Header(None)):
+    """Attach to a job's stream, from the start or from a Last-Event-ID."""
+    resume = parse_event_id(last_event_id)
+    after = resume[1] if resume is not None and resume[0] == job["id"] else 0
+    return StreamingResponse(get_job_workers().attach(job["id"], after), media_type="text/event-stream",
+                             headers={"X-Job-Id": str(job["id"])})
+
+@router.post("/book/{obj_id}", status_code=status.HTTP_202_ACCEPTED)
+async def book(background_tasks: BackgroundTasks, batch: bool = False, story: Story = Depends(GetDbObject(True, model=Story))):
+    """Generate everything the story still needs in the background, through the Batch API if batch is set."""
+    background_tasks.add_task(run_book, cast(int, story.id), batch)
+    return {"story_id": story.id, "batch": batch}
@@ -0,0 +1,297 @@
+import asyncio
+import itertools
+import json
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from collections.abc import AsyncGenerator, AsyncIterator, Coroutine
+from typing import Any, Optional, cast
+import httpx
+from sqlmodel.orm.session import Session
+from .models import User, Query, ApiCall, Message, LinkableObject
+from .utils import calc_cost
+from .tokens import async_num_tokens_from_messages, usage_tokens
+from .persistence import query_log
+from .routing import Route, default_route
+from .budget import plan_max_tokens, continuation_messages, record_call, record_output
+from .deadline import Deadline
+from .formats import StreamParser
+from .executor import async_http_client, build_messages, pair_query_with_object, CONTINUE_PROMPT, MAX_RETRIES
+from .error import BatchError
+from .checkpoint import BATCHED, COMPLETE
+from .config import get_settings
+
+"""
+Offline batch generation, shaped like OpenAI's Batch API.
+
+Under a BatchCollector, orchestrator steps don't call the API themselves. Each request is
+queued, and once every running lane (a chapter, say) is waiting on one, the queue is written
+out as a JSONL batch, uploaded to /files, submitted to /batches and polled until it's done.
+The results are handed back to the waiting steps, which parse and persist them exactly as
+they would a streamed response, then queue their next request for the following batch.
+
+So a book costs one batch per round of steps rather than one open connection per call, and
+nothing needs a browser on the other end. mock_llm.py implements the same endpoints for
+running it locally.
+"""
+
+conf = get_settings()
+
+# the Batch API bills at half the synchronous price
+BATCH_DISCOUNT = 0.5
+TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+current_batch: ContextVar[Optional["BatchCollector"]] = ContextVar("current_batch", default=None)
+
+
+class BatchAPI():
+    """The files and batches endpoints, over the shared LLM connection pool."""
+    def __init__(self, base_url: str, api_key: str):
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"Authorization": f"Bearer {api_key}"}
+
+    async def _request(self, method: str, path: str, **kwargs) -> httpx.Response:
+        response = await async_http_client.request(method, f"{self.base_url}{path}", headers=self.headers, **kwargs)
+        if response.status_code >= 400:
+            raise BatchError(f"{method} {path} failed with {response.status_code}: {response.text[:500]}")
+        return response
+
+    async def upload(self, lines: list[dict]) -> str:
+        content = "".join(json.dumps(line) + "\n" for line in lines).encode()
+        response = await self._request("POST", "/files", data={"purpose": "batch"},
+                                       files={"file": ("batch.jsonl", content, "application/jsonl")})
+        return response.json()["id"]
+
+    async def create(self, input_file_id: str, metadata: dict[str, str]) -> dict:
+        response = await self._request("POST", "/batches", json={"input_file_id": input_file_id,
+                                                                  "endpoint": "/v1/chat/completions",
+                                                                  "completion_window": conf.BATCH_COMPLETION_WINDOW,
+                                                                  "metadata": metadata})
+        return response.json()
+
+    async def retrieve(self, batch_id: str) -> dict:
+        return (await self._request("GET", f"/batches/{batch_id}")).json()
+
+    async def content(self, file_id: str) -> list[dict]:
+        response = await self._request("GET", f"/files/{file_id}/content")
+        return [json.loads(line) for line in response.text.splitlines() if line.strip()]
+
+
+class BatchCollector():
+    def __init__(self, api: BatchAPI, label: str):
+        self.api = api
+        self.label = label
+        self.batches = 0
+        self._ids = itertools.count()
+        self._pending: dict[str, tuple[dict, asyncio.Future]] = {}
+        self._running = 0
+        self._changed = asyncio.Event()
+
+    async def request(self, body: dict) -> dict:
+        """Queue a chat completion for the next batch and wait for its response body."""
+        if self._running == 0:
+            raise BatchError("batch requests must come from a lane started by BatchCollector.run")
+        custom_id = f"{self.label}-{next(self._ids)}"
+        future = asyncio.get_running_loop().create_future()
+        self._pending[custom_id] = (body, future)
+        self._changed.set()
+        return await future
+
+    @asynccontextmanager
+    async def idle(self) -> AsyncIterator[None]:
+        """For a lane waiting on another lane rather than on a batch, so the next batch doesn't wait for it."""
+        self._running -= 1
+        self._changed.set()
+        try:
+            yield
+        finally:
+            self._running += 1
+
+    async def _lane(self, coro: Coroutine) -> Any:
+        try:
+            return await coro
+        finally:
+            self._running -= 1
+            self._changed.set()
+
+    async def run(self, coros: list[Coroutine]) -> list[Any]:
+        """
+        Run coros side by side, submitting a batch whenever all of them are waiting on one.
+
+        Returns their results, or the exception a lane failed with, in order.
+        """
+        self._running += len(coros)
+        tasks = [asyncio.create_task(self._lane(coro)) for coro in coros]
+        while self._running:
+            await self._changed.wait()
+            self._changed.clear()
+            if self._pending and len(self._pending) >= self._running:
+                await self._submit()
+        return await asyncio.gather(*tasks, return_exceptions=True)
+
+    async def _submit(self):
+        pending, self._pending = self._pending, {}
+        self.batches += 1
+        try:
+            lines = [{"custom_id": custom_id, "method": "POST", "url": "/v1/chat/completions", "body": body}
+                     for custom_id, (body, _future) in pending.items()]
+            batch = await self.api.create(await self.api.upload(lines), {"label": self.label})
+            print(f"BATCH {batch['id']} SUBMITTED: {len(lines)} requests")
+            while batch["status"] not in TERMINAL_STATUSES:
+                await asyncio.sleep(conf.BATCH_POLL_INTERVAL)
+                batch = await self.api.retrieve(batch["id"])
+            print(f"BATCH {batch['id']} {batch['status'].upper()}: ", batch.get("request_counts"))
+
+            for file_id in (batch.get("output_file_id"), batch.get("error_file_id")):
+                if not file_id:
+                    continue
+                for line in await self.api.content(file_id):
+                    _body, future = pending.get(line["custom_id"], (None, None))
+                    if future is None or future.done():
+                        continue
+                    response = line.get("response") or {}
+                    if response.get("status_code") == 200:
+                        future.set_result(response["body"])
+                    else:
+                        future.set_exception(BatchError(f"request failed: {line.get('error') or response}"))
+            missing = BatchError(f"batch {batch['id']} {batch['status']} without a result for this request")
+        except (httpx.HTTPError, BatchError) as e:
+            print("BATCH FAILED: ", e)
+            missing = BatchError(f"batch failed: {e}")
+        for _body, future in pending.values():
+            if not future.done():
+                future.set_exception(missing)
+
+
+async def gather(*coros: Coroutine) -> list[Any]:
+    """Run coros side by side, as lanes of the current batch if there is one, exceptions returned rather than raised."""
+    collector = current_batch.get()
+    if collector is not None:
+        return await collector.run(list(coros))
+    return await asyncio.gather(*coros, return_exceptions=True)
+
+
+@asynccontextmanager
+async def idle() -> AsyncIterator[None]:
+    """BatchCollector.idle for the current batch, if there is one."""
+    collector = current_batch.get()
+    if collector is None:
+        yield
+        return
+    async with collector.idle():
+        yield
+
+
+async def batch_query_executor(db: Session, system_prompt: str, prompt: str, user: User, obj: Optional[LinkableObject]=None, previous_messages: list[Message] = [], use_cache: bool = True, route: Optional[Route] = None, step: Optional[str] = None,
+                               deadline: Optional[Deadline] = None, resume_from: Optional[Query] = None,
+                               stream_parser: Optional[StreamParser] = None, response_format: Optional[dict] = None) -> AsyncGenerator[str | Query, None]:
+    """
+    async_query_executor for the current batch: the same Query and ApiCall records, continuations,
+    retries and resumes, but every call is a line in a batch instead of a stream, so only the
+    Query is yielded. The response cache, hedging, the deadline and stream_parser don't apply
+    to batches, there's no stream to cut short.
+    """
+    collector = cast(BatchCollector, current_batch.get())
+    system_prompt, messages = build_messages(system_prompt, prompt, previous_messages)
+
+    complete_output = ""
+    query = Query(author_id=cast(int, user.id), original_prompt=prompt, system_prompt=system_prompt,
+                  complete_output=complete_output, step=step, status=BATCHED)
+    query.previous_messages=previous_messages
+    if obj is not None:
+        pair_query_with_object(query, obj)
+    query_key = await query_log.insert(query)
+    print("BATCHING QUERY: ", step)
+
+    route = route or default_route()
+    request_params = route.request_params()
+    if response_format is not None:
+        request_params["response_format"] = response_format
+    model = route.model
+
+    initial_message_count = len(messages)
+    request_messages = messages
+    continuing = False
+    completion_tokens = 0
+    retry_count = 0
+
+    if resume_from is not None and resume_from.complete_output:
+        complete_output = resume_from.complete_output
+        query.continues = 1
+        messages.append({"role": "assistant", "content": complete_output})
+        messages.append({"role": "user", "content": CONTINUE_PROMPT})
+        request_messages = continuation_messages(messages[0], messages[initial_message_count - 1],
+                                                 complete_output, CONTINUE_PROMPT, model)
+        continuing = True
+
+    while True:
+        prompt_tokens = await async_num_tokens_from_messages(request_messages, model)
+        body = {**request_params,
+                "max_tokens": plan_max_tokens(step, model, prompt_tokens, request_params["max_tokens"], route.context_window),
+                "messages": request_messages}
+        body = {key: value for key, value in body.items() if value is not None}
+        record_call(step, model, continuing)
+
+        try:
+            response = await collector.request(body)
+        except BatchError as e:
+            print(e)
+            failed_call = ApiCall(success=False, error=f"{type(e).__name__}: {e}", cost=0.0, output="")
+            failed_call.input_messages=[Message(**x) for x in request_messages]
+            await query_log.insert(failed_call, parent=query_key, final=True)
+            retry_count += 1
+            if retry_count > MAX_RETRIES:
+                break
+            continue
+
+        choice = response["choices"][0]
+        response_text = choice["message"].get("content") or ""
+        finish_reason = choice.get("finish_reason")
+        reported = usage_tokens(response.get("usage"))
+        if reported is None:
+            reported = (prompt_tokens,
+                        await async_num_tokens_from_messages([{"role": "assistant", "content": response_text}], model))
+        completion_tokens += reported[1]
+
+        api_call = ApiCall(success=finish_reason in ("stop", "length"), cost=calc_cost(*reported, model) * BATCH_DISCOUNT,
+                           output=response_text)
+        api_call.input_messages=[Message(**x) for x in request_messages]
+        if finish_reason == "content_filter":
+            api_call.error = "content_filter"
+        elif not api_call.success:
+            api_call.error = "unknown"
+        await query_log.insert(api_call, parent=query_key, final=True)
+
+        complete_output += response_text
+        query.complete_output = complete_output
+
+        if finish_reason == "length":
+            messages.append({"role": "assistant", "content": response_text})
+            messages.append({"role": "user", "content": CONTINUE_PROMPT})
+            request_messages = continuation_messages(messages[0], messages[initial_message_count - 1],
+                                                     complete_output, CONTINUE_PROMPT, model)
+            continuing = True
+            retry_count = 0
+            continue
+        if finish_reason == "stop":
+            messages.append({"role": "assistant", "content": response_text})
+            record_output(step, model, completion_tokens)
+            break
+        if finish_reason == "content_filter":
+            retry_count += 1
+            if retry_count > MAX_RETRIES:
+                break
+            continue
+        print("Unknown ERROR: " + finish_reason if finish_reason else "NONE")
+        break
+
+    query.all_messages = [Message(**x) for x in messages]
+    query.complete_output = complete_output
+    query.status = COMPLETE
+    query.id = await query_log.row_id(query_key)
+    await query_log.update(query_key, query, final=True)
+
+    yield query
+
+
+def batch_collector(label: str) -> BatchCollector:
+    return BatchCollector(BatchAPI(str(conf.BATCH_BASE_URL or conf.OPENAI_BASE_URL), conf.OPENAI_API_KEY), label)
@@ -0,0 +1,52 @@
+import argparse
+import asyncio
+from sqlmodel import Session
+from .models import Story
+from .database import engine
+from .persistence import query_log
+from .batch import current_batch, batch_collector
+from .checkpoint import resuming
+from . import orchestrator
+from . import error
+
+"""
+Generate a whole book without a browser attached.
+
+    python -m server.book 12            # stream the steps, chapters side by side
+    python -m server.book 12 --batch    # submit each round of steps as one batch, see batch.py
+
+The generator API's POST /book/{id} runs the same thing in the background.
+"""
+
+
+async def run_book(story_id: int, use_batch: bool):
+    with Session(engine) as db_session:
+        story = db_session.get(Story, story_id)
+        if story is None:
+            raise error.OrchestrationError(f"No story {story_id}")
+        collector = batch_collector(f"story-{story_id}") if use_batch else None
+        token = current_batch.set(collector)
+        # a step that was done before the run stopped isn't paid for twice
+        resume_token = resuming.set(True)
+        try:
+            await orchestrator.generate_book(story, db_session)
+        finally:
+            resuming.reset(resume_token)
+            current_batch.reset(token)
+        if collector is not None:
+            print(f"BOOK {story_id} DONE IN {collector.batches} BATCHES")
+        else:
+            print(f"BOOK {story_id} DONE")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Generate every step a story still needs.")
+    parser.add_argument("story_id", type=int)
+    parser.add_argument("--batch", action="store_true", help="use the Batch API instead of streaming")
+    args = parser.parse_args()
+
+    query_log.start()
+    try:
+        asyncio.run(run_book(args.story_id, args.batch))
+    finally:
+        query_log.stop()
@@ -0,0 +1,174 @@
+from collections import deque
+from dataclasses import dataclass
+from typing import Any, Optional
+from .tokens import count_text_tokens, num_tokens_from_messages
+from .config import get_settings
+
+"""
+Token budgeting for LLM calls.
+
+Before a call, the planner counts the prompt against the model's context window and picks
+max_tokens from how long that orchestrator step's outputs have run recently, so the call has
+room to finish in one go rather than stopping at "length" and needing a continuation.
+
+When a continuation can't be avoided, it's sent with only what the model needs to pick up
+where it stopped: the system prompt, the request, and the end of what it wrote so far.
+Re-sending the whole conversation bills all of it again for a few hundred tokens of output.
+
+Continuations are counted per step so it can be seen whether they're going away.
+"""
+
+conf = get_settings()
+
+# (context window, most output tokens the model will produce in one response)
+MODEL_LIMITS: dict[str, tuple[int, int]] = {
+    "gpt-4-1106-preview": (128000, 4096),
+    "gpt-4": (8192, 8192),
+    "gpt-4-0613": (8192, 8192),
+    "gpt-4-32k": (32768, 32768),
+    "gpt-3.5-turbo-1106": (16385, 4096),
+    "gpt-3.5-turbo": (4096, 4096),
+    "gpt-3.5-turbo-0613": (4096, 4096),
+    "gpt-3.5-turbo-16k": (16385, 16385),
+}
+
+# completion lengths kept per step and model
+OUTPUT_HISTORY = 100
+# history needed before it's trusted over the model's maximum
+MIN_OUTPUT_SAMPLES = 5
+# the shortest max_tokens the planner will set
+MIN_PLANNED_TOKENS = 256
+
+
+@dataclass
+class StepBudget():
+    outputs: deque
+    calls: int = 0
+    continuations: int = 0
+
+
+_steps: dict[tuple[str, str], StepBudget] = {}
+
+
+def _step(step: Optional[str], model: str) -> StepBudget:
+    return _steps.setdefault((step or "unnamed", model), StepBudget(outputs=deque(maxlen=OUTPUT_HISTORY)))
+
+
+def model_limits(model: str, context_window: Optional[int] = None) -> Optional[tuple[int, int]]:
+    """(context window, max output) for a model, a route's context_window taking precedence."""
+    limits = MODEL_LIMITS.get(model)
+    if context_window:
+        return context_window, min(context_window, limits[1]) if limits else context_window
+    return limits
+
+
+def record_output(step: Optional[str], model: str, completion_tokens: int):
+    """Remember how long a finished step's output was, across all its continuations."""
+    _step(step, model).outputs.append(completion_tokens)
+
+
+def record_call(step: Optional[str], model: str, continuation: bool):
+    budget = _step(step, model)
+    budget.calls += 1
+    if continuation:
+        budget.continuations += 1
+        print("CONTINUATION FOR STEP: ", step, continuation_stats().get(step or "unnamed"))
+
+
+def continuation_stats() -> dict[str, dict[str, Any]]:
+    """Calls and continuations per step, summed over models."""
+    stats: dict[str, dict[str, Any]] = {}
+    for (step, _model), budget in _steps.items():
+        entry = stats.setdefault(step, {"calls": 0, "continuations": 0})
+        entry["calls"] += budget.calls
+        entry["continuations"] += budget.continuations
+    for entry in stats.values():
+        entry["continuation_rate"] = entry["continuations"] / entry["calls"] if entry["calls"] else 0.0
+    return stats
+
+
+def expected_output(step: Optional[str], model: str) -> Optional[int]:
+    """A high percentile of the step's recent output lengths, None until there's enough history."""
+    outputs = _step(step, model).outputs
+    if len(outputs) < MIN_OUTPUT_SAMPLES:
+        return None
+    ordered = sorted(outputs)
+    return ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+
+
+def typical_output(step: Optional[str], model: str) -> Optional[int]:
+    """The median of the step's recent output lengths, None until there's enough history."""
+    outputs = _step(step, model).outputs
+    if len(outputs) < MIN_OUTPUT_SAMPLES:
+        return None
+    return sorted(outputs)[len(outputs) // 2]
+
+
+def plan_max_tokens(step: Optional[str], model: str, prompt_tokens: int, configured: Optional[int],
+                    context_window: Optional[int] = None) -> Optional[int]:
+    """
+    Pick max_tokens for a call.
+
+    Up to what the model can produce and the context window has left. Within that, the step's
+    usual output length with MAX_TOKENS_HEADROOM to spare, or all of it while there's no
+    history. A configured max_tokens is kept as a ceiling, with a warning if the step's
+    outputs usually run past it. Unknown models without a context_window get configured back.
+    """
+    limits = model_limits(model, context_window)
+    if limits is None:
+        return configured
+    window, max_output = limits
+
+    room = min(max_output, window - prompt_tokens)
+    if room < MIN_PLANNED_TOKENS:
+        print(f"WARNING: PROMPT OF {prompt_tokens} TOKENS LEAVES {window - prompt_tokens} OF {model}'S {window} FOR OUTPUT")
+        room = max(1, window - prompt_tokens)
+
+    expected = expected_output(step, model)
+    planned = room if expected is None else min(room, max(MIN_PLANNED_TOKENS, int(expected * conf.MAX_TOKENS_HEADROOM)))
+    if expected is not None and expected > room:
+        print(f"WARNING: STEP {step} USUALLY WRITES ~{expected} TOKENS, ONLY {room} FIT, EXPECT A CONTINUATION")
+
+    if configured:
+        if expected is not None and expected > configured:
+            print(f"WARNING: STEP {step} USUALLY WRITES ~{expected} TOKENS, MORE THAN max_tokens={configured}")
+        planned = min(planned, int(configured))
+    return planned
+
+
+def fit_messages(messages: list[dict], model: str, window: int, reserve: int) -> list[dict]:
+    """
+    Drop the oldest turns between the system prompt and the last message until the prompt fits
+    the window with reserve tokens to spare. Returns a new list, messages is left alone.
+    """
+    fitted = list(messages)
+    while len(fitted) > 2 and num_tokens_from_messages(fitted, model) + reserve > window:
+        dropped = fitted.pop(1)
+        print("TRIMMED FROM PROMPT: ", dropped["role"], count_text_tokens(dropped["content"], model), "tokens")
+    return fitted
+
+
+def tail(text: str, max_tokens: int, model: str) -> str:
+    """The end of text, whole paragraphs (or lines, for a single long one) up to max_tokens."""
+    for separator in ("\n\n", "\n"):
+        pieces = text.split(separator)
+        kept: list[str] = []
+        used = 0
+        for piece in reversed(pieces):
+            cost = count_text_tokens(piece, model)
+            if used + cost > max_tokens and kept:
+                break
+            kept.append(piece)
+            used += cost
+        if used <= max_tokens or separator == "\n":
+            return separator.join(reversed(kept))
+    return text
+
+
+def continuation_messages(system_message: dict, request: dict, output_so_far: str, continue_prompt: str, model: str) -> list[dict]:
+    """The trimmed conversation for a continuation: the system prompt, the request, and the end of the output so far."""
+    written = tail(output_so_far, conf.CONTINUATION_CONTEXT_TOKENS, model)
+    return [system_message,
+            request,
+            {"role": "assistant", "content": written},
+            {"role": "user", "content": continue_prompt}]
@@ -0,0 +1,125 @@
+import hashlib
+import json
+import sqlite3
+import threading
+import time
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Optional, TypedDict
+from fastapi.concurrency import run_in_threadpool
+from .config import get_settings
+
+"""
+Content-addressed cache for LLM responses.
+
+Keyed on a hash of the exact request (messages plus sampling parameters), so a retry, a
+refreshed tab, or a regenerate without edits gets replayed instead of paid for again.
+
+Two tiers: a small in-memory LRU in front of a SQLite file shared by all workers. Entries
+expire after a TTL, and the SQLite tier evicts least recently used entries once it grows
+past a size budget.
+"""
+
+
+class CachedResponse(TypedDict):
+    # the full text the query produced, across continuations
+    output: str
+    # messages appended to the conversation after the initial request (assistant turns and continue prompts)
+    messages: list[dict]
+
+
+def cache_key(messages: list[dict], **params) -> str:
+    """Hash the exact request. Any change to the messages or the sampling parameters is a different entry."""
+    payload = json.dumps({"messages": messages, "params": params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+
+class ResponseCache():
+    def __init__(self, path: str, ttl: float, max_bytes: int, memory_entries: int):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.memory_entries = memory_entries
+        self._memory: OrderedDict[str, tuple[float, CachedResponse]] = OrderedDict()
+        self._lock = threading.Lock()
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS responses (
+                                key TEXT PRIMARY KEY,
+                                value TEXT NOT NULL,
+                                size INTEGER NOT NULL,
+                                created_at REAL NOT NULL,
+                                accessed_at REAL NOT NULL)""")
+            conn.execute("CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at)")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10)
+
+    def _remember(self, key: str, created_at: float, value: CachedResponse):
+        with self._lock:
+            self._memory[key] = (created_at, value)
+            self._memory.move_to_end(key)
+            while len(self._memory) > self.memory_entries:
+                self._memory.popitem(last=False)
+
+    def get(self, key: str) -> Optional[CachedResponse]:
+        now = time.time()
+        with self._lock:
+            hit = self._memory.get(key)
+            if hit is not None:
+                if now - hit[0] <= self.ttl:
+                    self._memory.move_to_end(key)
+                    return hit[1]
+                del self._memory[key]
+
+        with self._connect() as conn:
+            row = conn.execute("SELECT value, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            if now - row[1] > self.ttl:
+                conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                return None
+            conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+
+        value: CachedResponse = json.loads(row[0])
+        self._remember(key, row[1], value)
+        return value
+
+    def put(self, key: str, value: CachedResponse):
+        now = time.time()
+        encoded = json.dumps(value, ensure_ascii=False)
+        self._remember(key, now, value)
+        with self._connect() as conn:
+            conn.execute("INSERT OR REPLACE INTO responses (key, value, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                         (key, encoded, len(encoded), now, now))
+            self._evict(conn, now)
+
+    def _evict(self, conn: sqlite3.Connection, now: float):
+        conn.execute("DELETE FROM responses WHERE created_at < ?", (now - self.ttl,))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        # least recently used first, until we're back under budget
+        for key, size in conn.execute("SELECT key, size FROM responses ORDER BY accessed_at ASC").fetchall():
+            if total <= self.max_bytes:
+                break
+            conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+            total -= size
+
+    async def aget(self, key: str) -> Optional[CachedResponse]:
+        return await run_in_threadpool(self.get, key)
+
+    async def aput(self, key: str, value: CachedResponse):
+        await run_in_threadpool(self.put, key, value)
+
+
+@lru_cache()
+def get_response_cache() -> Optional[ResponseCache]:
+    """The process-wide response cache, or None if it's disabled."""
+    conf = get_settings()
+    if not conf.RESPONSE_CACHE:
+        return None
+    return ResponseCache(conf.RESPONSE_CACHE_PATH,
+                         ttl=conf.RESPONSE_CACHE_TTL,
+                         max_bytes=int(conf.RESPONSE_CACHE_MAX_MB * 1024 * 1024),
+                         memory_entries=conf.RESPONSE_CACHE_MEMORY_ENTRIES)
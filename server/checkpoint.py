@@ -0,0 +1,110 @@
+import time
+from contextvars import ContextVar
+from datetime import datetime, timedelta
+from typing import Optional
+from sqlalchemy import and_, or_
+from sqlmodel import Session, select
+from .models import Query, LinkableObject
+from .persistence import query_log
+from .config import get_settings
+
+"""
+Checkpoints of in-flight generations.
+
+While a stream runs, the executor copies the text so far onto its Query row every
+CHECKPOINT_CHARS characters or CHECKPOINT_INTERVAL seconds. The copy goes through the
+write-behind query log, so there's no commit per chunk, and a restart loses at most that
+much of what was paid for.
+
+Rows being written have status "streaming" and an updated_on that each checkpoint moves
+forward. One that has gone CHECKPOINT_STALE_AFTER seconds without a checkpoint belonged to
+a process that died. Those are marked "interrupted" at startup, and the next run of the
+same step for the same object continues from its output instead of starting over, marking
+it "resumed".
+
+Finished steps are checkpoints too: a query keeps its step, output and messages. While
+resuming is set, a step whose system prompt, prompt and previous messages match a finished
+query of the same step for the same object reuses its output instead of calling the model,
+so a pipeline that failed or was cut short halfway only pays for the steps it hadn't done.
+Any change upstream changes the prompts and the step runs again.
+"""
+
+conf = get_settings()
+
+STREAMING = "streaming"
+COMPLETE = "complete"
+INTERRUPTED = "interrupted"
+RESUMED = "resumed"
+# waiting on a batch, which outlives the process, see batch.py
+BATCHED = "batched"
+
+# set while a generation should reuse the steps it has already done
+resuming: ContextVar[bool] = ContextVar("resuming", default=False)
+
+LINK_COLUMNS = {"Story": Query.story_id,
+                "StoryOutline": Query.story_outline_id,
+                "ChapterOutline": Query.chapter_outline_id,
+                "SceneOutline": Query.scene_outline_id,
+                "Scene": Query.scene_id}
+
+
+class Checkpointer():
+    def __init__(self, query_key: int, query: Query):
+        self.query_key = query_key
+        self.query = query
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+    def due(self, new_chars: int) -> bool:
+        """Count new_chars of output, True once enough has come in (or enough time gone by) for a checkpoint."""
+        self._unsaved += new_chars
+        if not self._unsaved:
+            return False
+        return self._unsaved >= conf.CHECKPOINT_CHARS or time.monotonic() - self._saved_at >= conf.CHECKPOINT_INTERVAL
+
+    async def save(self, output: str):
+        self.query.complete_output = output
+        self.query.updated_on = datetime.now()
+        await query_log.update(self.query_key, self.query)
+        self._unsaved = 0
+        self._saved_at = time.monotonic()
+
+
+def _stale():
+    return and_(Query.status == STREAMING,
+                Query.updated_on < datetime.now() - timedelta(seconds=conf.CHECKPOINT_STALE_AFTER))
+
+
+def mark_interrupted(db: Session) -> int:
+    """Mark the queries a dead process left streaming as interrupted."""
+    count = db.query(Query).filter(_stale()).update({Query.status: INTERRUPTED}, synchronize_session=False)
+    db.commit()
+    if count:
+        print("INTERRUPTED QUERIES FOUND: ", count)
+    return count
+
+
+def interrupted_query(db: Session, step: str, obj: LinkableObject, prompt: str) -> Optional[Query]:
+    """The latest interrupted query with output for the same step, object and prompt, if any."""
+    column = LINK_COLUMNS.get(type(obj).__name__)
+    if column is None or obj.id is None:
+        return None
+    return db.exec(select(Query)
+                   .where(Query.step == step, column == obj.id, Query.original_prompt == prompt,
+                          Query.complete_output != "",
+                          or_(Query.status == INTERRUPTED, _stale()))
+                   .order_by(Query.id.desc())).first()  # type: ignore
+
+
+def completed_query(db: Session, step: str, obj: LinkableObject, system_prompt: str, prompt: str,
+                    previous_messages: str) -> Optional[Query]:
+    """The latest finished query with output for the same step and object from exactly the same messages, if any."""
+    column = LINK_COLUMNS.get(type(obj).__name__)
+    if column is None or obj.id is None:
+        return None
+    return db.exec(select(Query)
+                   .where(Query.step == step, column == obj.id, Query.status == COMPLETE,
+                          Query.system_prompt == system_prompt, Query.original_prompt == prompt,
+                          Query.internal_previous_messages == previous_messages,
+                          Query.complete_output != "")
+                   .order_by(Query.id.desc())).first()  # type: ignore
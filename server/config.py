@@ -37,6 +37,98 @@ class Settings(BaseSettings):
     QUERY_MAX_TOKENS: float = config.get('QUERY_MAX_TOKENS', None)
     QUERY_TEMPERATURE: float = config.get('QUERY_TEMPERATURE', 1)
     QUERY_FREQUENCY_PENALTY: float = config.get('QUERY_FREQUENCY_PENALTY', 0.1)
+    # request the usage block on streamed responses. off by default, backends that don't support
+    # stream_options reject the request. can also be turned on per endpoint in LLM_ENDPOINTS.
+    STREAM_USAGE: bool = config.get('STREAM_USAGE', False)
+    RESPONSE_CACHE: bool = config.get('RESPONSE_CACHE', False)
+    RESPONSE_CACHE_PATH: str = config.get('RESPONSE_CACHE_PATH', './response_cache.db')
+    RESPONSE_CACHE_TTL: float = config.get('RESPONSE_CACHE_TTL', 7 * 24 * 60 * 60)
+    RESPONSE_CACHE_MAX_MB: float = config.get('RESPONSE_CACHE_MAX_MB', 256)
+    RESPONSE_CACHE_MEMORY_ENTRIES: int = config.get('RESPONSE_CACHE_MEMORY_ENTRIES', 256)
+    QUERY_LOG_QUEUE_SIZE: int = config.get('QUERY_LOG_QUEUE_SIZE', 10000)
+    QUERY_LOG_BATCH_SIZE: int = config.get('QUERY_LOG_BATCH_SIZE', 200)
+    QUERY_LOG_FLUSH_INTERVAL: float = config.get('QUERY_LOG_FLUSH_INTERVAL', 0.5)
+    SSE_FLUSH_INTERVAL: float = config.get('SSE_FLUSH_INTERVAL', 0.05)
+    SSE_FLUSH_BYTES: int = config.get('SSE_FLUSH_BYTES', 512)
+    SSE_BUFFER_SIZE: int = config.get('SSE_BUFFER_SIZE', 256)
+    # seconds between metrics events on generation streams, 0 to turn them off
+    SSE_METRICS_INTERVAL: float = config.get('SSE_METRICS_INTERVAL', 1.0)
+    # chapter outlines generated at once by the story outline's chapters endpoint
+    CHAPTER_FANOUT_CONCURRENCY: int = config.get('CHAPTER_FANOUT_CONCURRENCY', 4)
+    # steps run at once by a whole book generation, see scheduler.py
+    BOOK_CONCURRENCY: int = config.get('BOOK_CONCURRENCY', 8)
+    # generation jobs, see jobs.py
+    JOB_QUEUE_PATH: str = config.get('JOB_QUEUE_PATH', './jobs.db')
+    JOB_WORKERS: int = config.get('JOB_WORKERS', 32)
+    JOB_POLL_INTERVAL: float = config.get('JOB_POLL_INTERVAL', 0.2)
+    JOB_FLUSH_INTERVAL: float = config.get('JOB_FLUSH_INTERVAL', 0.5)
+    JOB_HEARTBEAT_INTERVAL: float = config.get('JOB_HEARTBEAT_INTERVAL', 30)
+    JOB_STALE_AFTER: float = config.get('JOB_STALE_AFTER', 300)
+    JOB_RETENTION: float = config.get('JOB_RETENTION', 24 * 60 * 60)
+    # output a step writes before it must have started on its format, see formats.StreamParser
+    FORMAT_PROBE_CHARS: int = config.get('FORMAT_PROBE_CHARS', 1000)
+    # ask for steps as JSON in their schema instead of markdown, per route with MODEL_ROUTES
+    STRUCTURED_OUTPUT: bool = config.get('STRUCTURED_OUTPUT', False)
+    LLM_MAX_CONNECTIONS: int = config.get('LLM_MAX_CONNECTIONS', 100)
+    LLM_MAX_KEEPALIVE_CONNECTIONS: int = config.get('LLM_MAX_KEEPALIVE_CONNECTIONS', 20)
+    LLM_KEEPALIVE_EXPIRY: float = config.get('LLM_KEEPALIVE_EXPIRY', 60)
+    # needs the h2 package (pip install httpx[http2]), ignored with a warning without it
+    LLM_HTTP2: bool = config.get('LLM_HTTP2', False)
+    LLM_CONNECT_TIMEOUT: float = config.get('LLM_CONNECT_TIMEOUT', 10)
+    # the longest gap between two streamed chunks, not the length of the whole generation
+    LLM_READ_TIMEOUT: float = config.get('LLM_READ_TIMEOUT', 120)
+    LLM_WRITE_TIMEOUT: float = config.get('LLM_WRITE_TIMEOUT', 30)
+    LLM_POOL_TIMEOUT: float = config.get('LLM_POOL_TIMEOUT', 60)
+    LLM_WARM_CONNECTIONS: int = config.get('LLM_WARM_CONNECTIONS', 4)
+    # streams open at once per worker, 0 for no cap
+    LLM_MAX_CONCURRENCY: int = config.get('LLM_MAX_CONCURRENCY', 0)
+    # JSON list of endpoints to spread the default route over, see endpoints.py
+    LLM_ENDPOINTS: str | None = config.get('LLM_ENDPOINTS')
+    LLM_ENDPOINT_MAX_FAILURES: int = config.get('LLM_ENDPOINT_MAX_FAILURES', 3)
+    LLM_ENDPOINT_EJECT_SECONDS: float = config.get('LLM_ENDPOINT_EJECT_SECONDS', 30)
+    LLM_ENDPOINT_SLOW_FACTOR: float = config.get('LLM_ENDPOINT_SLOW_FACTOR', 3)
+    # where book batches are sent, OPENAI_BASE_URL if unset
+    BATCH_BASE_URL: str | None = config.get('BATCH_BASE_URL')
+    BATCH_POLL_INTERVAL: float = config.get('BATCH_POLL_INTERVAL', 60)
+    BATCH_COMPLETION_WINDOW: str = config.get('BATCH_COMPLETION_WINDOW', '24h')
+    # provider limits per endpoint and model, shared by all workers, 0 for unlimited (the default)
+    RATE_LIMIT_RPM: int = config.get('RATE_LIMIT_RPM', 0)
+    RATE_LIMIT_TPM: int = config.get('RATE_LIMIT_TPM', 0)
+    # JSON, per model limits, e.g. {"gpt-3.5-turbo": {"rpm": 3500, "tpm": 160000}}
+    RATE_LIMIT_OVERRIDES: str | None = config.get('RATE_LIMIT_OVERRIDES')
+    RATE_LIMIT_PATH: str = config.get('RATE_LIMIT_PATH', './rate_limit.db')
+    # charged for the completion when QUERY_MAX_TOKENS isn't set, settled against the real usage after
+    RATE_LIMIT_COMPLETION_ESTIMATE: int = config.get('RATE_LIMIT_COMPLETION_ESTIMATE', 1500)
+    # fire a duplicate request when the first token is slow, first stream with content wins
+    HEDGE_REQUESTS: bool = config.get('HEDGE_REQUESTS', False)
+    # time-to-first-token percentile after which we hedge
+    HEDGE_PERCENTILE: float = config.get('HEDGE_PERCENTILE', 95)
+    # hedge delay used until HEDGE_MIN_SAMPLES first tokens have been timed
+    HEDGE_DELAY: float = config.get('HEDGE_DELAY', 4.0)
+    HEDGE_MIN_DELAY: float = config.get('HEDGE_MIN_DELAY', 0.5)
+    HEDGE_MIN_SAMPLES: int = config.get('HEDGE_MIN_SAMPLES', 20)
+    HEDGE_MAX_FRACTION: float = config.get('HEDGE_MAX_FRACTION', 0.05)
+    # JSON routing table of orchestrator steps to models, see server/routing.py
+    MODEL_ROUTES: str | None = config.get('MODEL_ROUTES')
+    # JSON of model -> [prompt, completion] USD per 1K tokens, on top of utils.MODEL_PRICES
+    MODEL_PRICES: str | None = config.get('MODEL_PRICES')
+    # max_tokens is planned as a step's usual output length times this
+    MAX_TOKENS_HEADROOM: float = config.get('MAX_TOKENS_HEADROOM', 1.5)
+    # how much of the output so far a continuation is sent
+    CONTINUATION_CONTEXT_TOKENS: int = config.get('CONTINUATION_CONTEXT_TOKENS', 1000)
+    # backoff between retries of a failed or filtered call, jittered
+    RETRY_BASE_DELAY: float = config.get('RETRY_BASE_DELAY', 1.0)
+    RETRY_MAX_DELAY: float = config.get('RETRY_MAX_DELAY', 30.0)
+    # time budget of one orchestrator step, retries and continuations included
+    STEP_DEADLINE: float = config.get('STEP_DEADLINE', 900)
+    # a stream with no chunk for this long is abandoned and resumed, the first chunk gets LLM_FIRST_CHUNK_TIMEOUT
+    LLM_IDLE_TIMEOUT: float = config.get('LLM_IDLE_TIMEOUT', 30)
+    LLM_FIRST_CHUNK_TIMEOUT: float = config.get('LLM_FIRST_CHUNK_TIMEOUT', 90)
+    # streamed output is saved to its Query every CHECKPOINT_CHARS characters or CHECKPOINT_INTERVAL seconds
+    CHECKPOINT_CHARS: int = config.get('CHECKPOINT_CHARS', 2000)
+    CHECKPOINT_INTERVAL: float = config.get('CHECKPOINT_INTERVAL', 10)
+    # a streaming Query without a checkpoint for this long was interrupted
+    CHECKPOINT_STALE_AFTER: float = config.get('CHECKPOINT_STALE_AFTER', 300)
 
 
 @lru_cache()
@@ -0,0 +1,72 @@
+import asyncio
+import time
+from dataclasses import dataclass
+from typing import AsyncIterator, Optional
+from .error import StreamStalled
+
+"""
+Deadlines for generations.
+
+Each orchestrator step gets a time budget (STEP_DEADLINE) that's handed down through the
+executor to every HTTP call it makes, and a stream that stops sending chunks without closing
+is abandoned after an idle timeout rather than left to hold the connection, the DB session
+and the user's SSE stream forever. A stalled stream is retried like any other failure, as
+long as the step has budget left.
+"""
+
+
+@dataclass(frozen=True)
+class Deadline():
+    # time.monotonic() at which the budget runs out
+    at: float
+
+    @classmethod
+    def after(cls, seconds: float) -> "Deadline":
+        return cls(time.monotonic() + seconds)
+
+    def remaining(self) -> float:
+        return max(0.0, self.at - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0
+
+
+def cap(seconds: float, deadline: Optional[Deadline]) -> float:
+    """seconds, or whatever is left of the deadline if that's less."""
+    return seconds if deadline is None else min(seconds, deadline.remaining())
+
+
+async def watch(chunks: AsyncIterator, first_timeout: float, idle_timeout: float,
+                deadline: Optional[Deadline] = None) -> AsyncIterator:
+    """
+    Pass chunks through, raising StreamStalled if one takes too long.
+
+    The first chunk gets first_timeout (it includes the connection and the model's time to
+    first token), every later one idle_timeout, and none gets past the deadline. chunks is
+    closed either way.
+    """
+    iterator = aiter(chunks)
+    timeout = first_timeout
+    try:
+        while True:
+            limit = cap(timeout, deadline)
+            # not asyncio.wait_for, which can swallow a cancellation that lands as the chunk arrives
+            step = asyncio.ensure_future(anext(iterator))
+            try:
+                done, _ = await asyncio.wait({step}, timeout=limit)
+            finally:
+                if not step.done():
+                    step.cancel()
+                    await asyncio.wait({step})
+            if not done:
+                if deadline is not None and deadline.expired():
+                    raise StreamStalled("step deadline reached mid-stream")
+                raise StreamStalled(f"no chunk for {limit:.1f}s")
+            try:
+                chunk = step.result()
+            except StopAsyncIteration:
+                return
+            yield chunk
+            timeout = idle_timeout
+    finally:
+        await iterator.aclose()  # type: ignore
@@ -0,0 +1,181 @@
+import asyncio
+import json
+import random
+import statistics
+import time
+from dataclasses import dataclass
+from typing import Any, Awaitable, Callable, Optional, TypeVar
+import openai
+from .config import get_settings
+
+"""
+Load balancing and failover across OpenAI compatible endpoints.
+
+LLM_ENDPOINTS lists the endpoints the default route is spread over, e.g.
+
+    [{"url": "http://10.0.0.5:8000/v1", "weight": 2, "max_concurrency": 32},
+     {"url": "http://10.0.0.6:8000/v1", "max_concurrency": 32},
+     {"url": "https://api.openai.com/v1", "weight": 0.5, "api_key": "sk-...", "stream_usage": true}]
+
+Without it, OPENAI_BASE_URL is the only endpoint. Routes with their own base_url (see
+routing.py) bypass the pool.
+
+Each request goes to the endpoint with the fewest requests in flight for its weight, among
+those under their max_concurrency. In flight counts come from the HTTP transport and last
+until the stream is closed, so endpoints are told apart by scheme, host and port. When every
+endpoint is full, requests wait for room.
+
+Health checks are passive and per worker: LLM_ENDPOINT_MAX_FAILURES failures in a row, or a
+time to first token LLM_ENDPOINT_SLOW_FACTOR times the other endpoints' median, ejects an
+endpoint for LLM_ENDPOINT_EJECT_SECONDS. If nothing healthy is left, the endpoint due back
+first is used anyway. A request that can't be opened moves on to the next endpoint straight
+away, failures mid-stream are resumed by the executor on whichever endpoint is picked next.
+"""
+
+conf = get_settings()
+
+T = TypeVar("T")
+
+# how often a request waiting for an endpoint with room looks again
+POLL_INTERVAL = 0.05
+# weight of the newest sample in an endpoint's moving average time to first token
+LATENCY_ALPHA = 0.2
+# samples before an endpoint's latency is compared against the others
+MIN_LATENCY_SAMPLES = 5
+
+# errors opening a stream that another endpoint may not have
+FAILOVER_ERRORS = (openai.APIConnectionError, openai.InternalServerError, openai.RateLimitError)
+
+
+@dataclass
+class Endpoint():
+    url: str
+    weight: float = 1
+    # 0 for no cap
+    max_concurrency: int = 0
+    # None means OPENAI_API_KEY
+    api_key: Optional[str] = None
+    # client side rate limits, None for the defaults, see ratelimit.py
+    rpm: Optional[int] = None
+    tpm: Optional[int] = None
+    # ask for usage on streamed responses, None means STREAM_USAGE
+    stream_usage: Optional[bool] = None
+    failures: int = 0
+    ejected_until: float = 0
+    latency: Optional[float] = None
+    samples: int = 0
+    # picked but not yet sent, so not in the transport's count
+    pending: int = 0
+
+    def ejected(self) -> bool:
+        return self.ejected_until > time.monotonic()
+
+
+def load_endpoints() -> list[Endpoint]:
+    if not conf.LLM_ENDPOINTS:
+        return [Endpoint(url=str(conf.OPENAI_BASE_URL))]
+    endpoints = [Endpoint(**entry) for entry in json.loads(conf.LLM_ENDPOINTS)]
+    if not endpoints:
+        raise ValueError("LLM_ENDPOINTS is empty")
+    return endpoints
+
+
+class EndpointPool():
+    def __init__(self, endpoints: list[Endpoint], in_flight: Callable[[str], int]):
+        self.endpoints = endpoints
+        self._in_flight = in_flight
+
+    def outstanding(self, endpoint: Endpoint) -> int:
+        return self._in_flight(endpoint.url) + endpoint.pending
+
+    def _has_room(self, endpoint: Endpoint) -> bool:
+        return endpoint.max_concurrency <= 0 or self.outstanding(endpoint) < endpoint.max_concurrency
+
+    def _pick(self, exclude: set[str]) -> Optional[Endpoint]:
+        candidates = [e for e in self.endpoints if e.url not in exclude]
+        if not candidates:
+            return None
+        healthy = [e for e in candidates if not e.ejected()]
+        if not healthy:
+            # better an endpoint that has been failing than none at all
+            return min(candidates, key=lambda e: e.ejected_until)
+        with_room = [e for e in healthy if self._has_room(e)]
+        if not with_room:
+            return None
+        random.shuffle(with_room)
+        return min(with_room, key=lambda e: (self.outstanding(e) + 1) / e.weight)
+
+    async def acquire(self, exclude: set[str]) -> Endpoint:
+        waited = False
+        while True:
+            endpoint = self._pick(exclude)
+            if endpoint is not None:
+                endpoint.pending += 1
+                return endpoint
+            if not waited:
+                print("ALL LLM ENDPOINTS AT CAPACITY, WAITING: ", self.stats())
+                waited = True
+            await asyncio.sleep(POLL_INTERVAL)
+
+    async def call(self, send: Callable[[Endpoint], Awaitable[T]]) -> T:
+        """send(endpoint) on the best endpoint, failing over to the others while they're left."""
+        tried: set[str] = set()
+        while True:
+            endpoint = await self.acquire(tried)
+            try:
+                return await send(endpoint)
+            except FAILOVER_ERRORS as e:
+                self.record_failure(endpoint)
+                tried.add(endpoint.url)
+                if len(tried) >= len(self.endpoints):
+                    raise
+                print("LLM ENDPOINT FAILED, FAILING OVER: ", endpoint.url, type(e).__name__)
+            finally:
+                endpoint.pending -= 1
+
+    def endpoint_for(self, url: str) -> Optional[Endpoint]:
+        matches = [e for e in self.endpoints if url.startswith(e.url.rstrip("/"))]
+        return max(matches, key=lambda e: len(e.url), default=None)
+
+    def eject(self, endpoint: Endpoint, reason: str):
+        endpoint.ejected_until = time.monotonic() + conf.LLM_ENDPOINT_EJECT_SECONDS
+        endpoint.failures = 0
+        endpoint.latency = None
+        endpoint.samples = 0
+        print(f"EJECTING LLM ENDPOINT FOR {conf.LLM_ENDPOINT_EJECT_SECONDS}s: ", endpoint.url, reason)
+
+    def record_failure(self, endpoint: Endpoint):
+        endpoint.failures += 1
+        if endpoint.failures >= conf.LLM_ENDPOINT_MAX_FAILURES:
+            self.eject(endpoint, f"{endpoint.failures} failures in a row")
+
+    def record_success(self, endpoint: Endpoint, ttft: Optional[float]):
+        endpoint.failures = 0
+        if ttft is None:
+            return
+        endpoint.samples += 1
+        endpoint.latency = ttft if endpoint.latency is None else LATENCY_ALPHA * ttft + (1 - LATENCY_ALPHA) * endpoint.latency
+        others = [e.latency for e in self.endpoints
+                  if e is not endpoint and e.latency is not None and e.samples >= MIN_LATENCY_SAMPLES and not e.ejected()]
+        if endpoint.samples >= MIN_LATENCY_SAMPLES and others:
+            typical = statistics.median(others)
+            if endpoint.latency > conf.LLM_ENDPOINT_SLOW_FACTOR * typical:
+                self.eject(endpoint, f"time to first token {endpoint.latency:.2f}s against {typical:.2f}s elsewhere")
+
+    def report(self, stream: Any, ok: bool, ttft: Optional[float] = None):
+        """Record how a stream opened through the pool went, by the URL it was sent to."""
+        response = getattr(stream, "response", None)
+        endpoint = self.endpoint_for(str(response.url)) if response is not None else None
+        if endpoint is None:
+            return
+        if ok:
+            self.record_success(endpoint, ttft)
+        else:
+            self.record_failure(endpoint)
+
+    def stats(self) -> list[dict[str, Any]]:
+        return [{"url": e.url,
+                 "outstanding": self.outstanding(e),
+                 "ejected": e.ejected(),
+                 "failures": e.failures,
+                 "latency": e.latency} for e in self.endpoints]
@@ -6,3 +6,36 @@ class ParsingError(Exception):
 class OrchestrationError(Exception):
     def __init__(self, message):
         self.message = message
+
+class StreamStalled(Exception):
+    def __init__(self, message):
+        self.message = message
+
+class GenerationTimeout(Exception):
+    def __init__(self, message, step=None):
+        self.message = message
+        self.step = step
+
+class BatchError(Exception):
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
+
+class JobConflict(Exception):
+    """A job that can't be queued while another one generating some of the same objects is active."""
+    def __init__(self, message, job_id):
+        self.message = message
+        self.job_id = job_id
+
+    def __str__(self):
+        return self.message
+
+class FormatDiverged(ParsingError):
+    """Streamed output that has gone off format and can't be parsed however it ends."""
+    def __init__(self, message):
+        self.message = message
+
+    def __str__(self):
+        return self.message
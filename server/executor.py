@@ -1,17 +1,38 @@
+import asyncio
 import backoff
-import tiktoken
+import httpx
+import random
+from functools import lru_cache
 import openai
-from collections.abc import Generator
+from collections.abc import AsyncGenerator, Callable
 from typing import cast, Optional
-from openai import OpenAI
+from openai import AsyncOpenAI, AsyncStream
+from fastapi.concurrency import run_in_threadpool
 from sqlmodel.orm.session import Session
 from .models import User, Query, ApiCall, Message, LinkableObject, StoryOutline, Story, SceneOutline, ChapterOutline, Scene
 from .utils import calc_cost
+from .tokens import async_num_tokens_from_messages, usage_tokens, cached_prompt_tokens
+from .cache import get_response_cache, cache_key
+from .persistence import query_log
+from .ratelimit import get_rate_limiter, estimate_completion_tokens
+from .routing import Route, default_route
+from .budget import plan_max_tokens, model_limits, fit_messages, continuation_messages, record_call, record_output, MIN_PLANNED_TOKENS
+from .hedging import hedged_stream, HedgeOutcome
+from .http_pool import build_async_http_client, warm_pool, pool_timeout, PoolStats
+from .endpoints import EndpointPool, load_endpoints
+from .deadline import Deadline, cap, watch
+from .error import StreamStalled, GenerationTimeout, FormatDiverged
+from .formats import StreamParser
+from .checkpoint import Checkpointer, STREAMING, COMPLETE
+from .progress import current_progress
 from .config import get_settings
 
 conf = get_settings()
 
-client = OpenAI(api_key=conf.OPENAI_API_KEY, base_url=conf.OPENAI_BASE_URL)
+async_http_client, async_transport = build_async_http_client()
+async_client = AsyncOpenAI(api_key=conf.OPENAI_API_KEY, base_url=conf.OPENAI_BASE_URL, http_client=async_http_client)
+# the default route is spread over LLM_ENDPOINTS
+endpoint_pool = EndpointPool(load_endpoints(), async_transport.in_flight_to)
 
 
 CONTINUE_PROMPT = "Your last message got cutoff, without repeating yourself, please continue writing exactly where you left off."
@@ -21,10 +42,86 @@ QUERY_MAX_TOKENS = conf.QUERY_MAX_TOKENS
 QUERY_TEMPERATURE = conf.QUERY_TEMPERATURE
 QUERY_FREQUENCY_PENALTY = conf.QUERY_FREQUENCY_PENALTY
 
+# cached responses are replayed in pieces of this many characters
+CACHE_REPLAY_CHUNK_SIZE = 512
 
-@backoff.on_exception(backoff.expo, (openai.RateLimitError, openai.APITimeoutError))
-def completions_with_backoff(**kwargs):
-    return client.chat.completions.create(**kwargs)
+def stream_options(url: str) -> dict:
+    """Ask the endpoint at url to report usage on the final chunk, so we don't have to re-tokenize, if it's set to."""
+    endpoint = endpoint_pool.endpoint_for(url)
+    stream_usage = endpoint.stream_usage if endpoint is not None and endpoint.stream_usage is not None else conf.STREAM_USAGE
+    return {"stream_options": {"include_usage": True}} if stream_usage else {}
+
+
+async def warm_llm_connections():
+    """Pre-open LLM_WARM_CONNECTIONS connections to each endpoint, see http_pool.warm_pool."""
+    if conf.LLM_WARM_CONNECTIONS <= 0:
+        return
+    for endpoint in endpoint_pool.endpoints:
+        endpoint_client = get_async_client(endpoint.url, endpoint.api_key)
+        await warm_pool(async_http_client, f"{endpoint_client.base_url}models",
+                        {"Authorization": f"Bearer {endpoint_client.api_key}"}, conf.LLM_WARM_CONNECTIONS)
+    print("LLM POOL WARMED: ", pool_stats())
+
+
+def pool_stats() -> PoolStats:
+    return async_transport.stats()
+
+
+def retry_delay(attempt: int) -> float:
+    """Exponential backoff with full jitter, so retries from many generations don't line up."""
+    return random.uniform(0, min(conf.RETRY_MAX_DELAY, conf.RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+
+@lru_cache()
+def get_async_client(base_url: Optional[str] = None, api_key: Optional[str] = None) -> AsyncOpenAI:
+    """The client for a route's base_url or an endpoint, sharing the connection pool of the default one."""
+    api_key = api_key or conf.OPENAI_API_KEY
+    if (base_url is None or base_url == conf.OPENAI_BASE_URL) and api_key == conf.OPENAI_API_KEY:
+        return async_client
+    return AsyncOpenAI(api_key=api_key, base_url=base_url or conf.OPENAI_BASE_URL, http_client=async_http_client)
+
+
+async def async_completions_with_backoff(estimated_tokens: int, base_url: Optional[str] = None,
+                                         sent: Optional[Callable[[str], None]] = None,
+                                         deadline: Optional[Deadline] = None, **kwargs):
+    """
+    Create a completion once the rate limiter has budget for estimated_tokens on the endpoint it goes to.
+
+    Rate limit errors and timeouts are retried with exponential backoff, for no longer than
+    the deadline has left. With a deadline those are the only retries, the client's own are
+    off, and each attempt's timeouts are capped by what's left of it. Every attempt waits for budget again, is refunded if it fails, and
+    a 429 drains the endpoint's buckets for all workers. Without a base_url the request goes
+    through the endpoint pool and only fails once no endpoint would take it. sent(url) is
+    called as each attempt is sent to url, after those waits, and the caller settles the
+    charge against url.
+    """
+    limiter = get_rate_limiter()
+    model = kwargs["model"]
+
+    async def send(url: str, client: AsyncOpenAI):
+        await limiter.acquire(url, model, estimated_tokens)
+        if sent is not None:
+            sent(url)
+        params = {**kwargs, "extra_body": stream_options(url)} if kwargs.get("stream") else kwargs
+        if deadline is not None:
+            client = client.with_options(max_retries=0)
+            params = {**params, "timeout": pool_timeout(deadline.remaining())}
+        try:
+            return await client.chat.completions.create(**params)
+        except Exception as e:
+            await limiter.settle(url, model, estimated_tokens, 0)
+            if isinstance(e, openai.RateLimitError):
+                await limiter.penalize(url, model)
+            raise
+
+    @backoff.on_exception(backoff.expo, (openai.RateLimitError, openai.APITimeoutError),
+                          max_time=deadline.remaining() if deadline is not None else None)
+    async def attempt():
+        if base_url is not None:
+            return await send(base_url, get_async_client(base_url))
+        return await endpoint_pool.call(lambda endpoint: send(endpoint.url, get_async_client(endpoint.url, endpoint.api_key)))
+
+    return await attempt()
 
 def pair_query_with_object(query: Query, obj: LinkableObject):
     if obj.__class__.__name__ == "Story":
@@ -51,14 +148,12 @@ def pair_query_with_object(query: Query, obj: LinkableObject):
 
 
 
-def query_executor(db: Session, system_prompt: str, prompt: str, user: User, obj: Optional[LinkableObject]=None, previous_messages: list[Message] = []) -> Generator[str | Query, None, None]:
+def build_messages(system_prompt: str, prompt: str, previous_messages: list[Message]) -> tuple[str, list[dict]]:
     """
-    Execute a query against the openai API.
+    Assemble the chat messages for a query, applying the configured system prompt prefix.
 
-    Side Effects:
-    Generates a Query objects and associated ApiCall objects and saves them to the database.
+    Returns the (possibly prefixed) system prompt along with the message list.
     """
-
     if conf.SYS_PROMPT_PREFIX:
         system_prompt = conf.SYS_PROMPT_PREFIX + system_prompt
 
@@ -68,167 +163,328 @@ def query_executor(db: Session, system_prompt: str, prompt: str, user: User, obj
     for message in previous_messages:
         messages.append({"role": message.role, "content": message.content})
     messages.append({"role": "user", "content": prompt})
+    return system_prompt, messages
+
+
+async def async_query_executor(db: Session, system_prompt: str, prompt: str, user: User, obj: Optional[LinkableObject]=None, previous_messages: list[Message] = [], use_cache: bool = True, route: Optional[Route] = None, step: Optional[str] = None,
+                               deadline: Optional[Deadline] = None, resume_from: Optional[Query] = None,
+                               stream_parser: Optional[StreamParser] = None, response_format: Optional[dict] = None) -> AsyncGenerator[str | Query, None]:
+    """
+    Execute a query against the openai API, streaming from the AsyncOpenAI client.
+
+    Nothing here blocks a threadpool worker while waiting on the API, so a single
+    event loop can hold many concurrent generations open.
+
+    route picks the model, endpoint and sampling parameters, see routing.py. Defaults to
+    the default route. step names the orchestrator step, max_tokens is planned from its
+    history (see budget.py).
+
+    deadline bounds every call and retry. Streams that go quiet for LLM_IDLE_TIMEOUT are
+    abandoned and resumed like failed ones, and once the deadline passes the output so far is
+    saved and GenerationTimeout raised.
+
+    The output is checkpointed onto the Query as it streams (see checkpoint.py). Given the
+    Query of an interrupted run of the same request as resume_from, its output is yielded
+    straight away and the model asked to continue it.
+
+    Everything yielded is fed to stream_parser, if given. Once it finds the output has gone
+    off format (see formats.StreamParser) the call is cut off, recorded as failed, and its
+    FormatDiverged raised for the caller to retry, rather than paying for the rest of it.
+
+    response_format is sent as is, to ask for structured output (see formats.StructuredFormat).
+
+    If the response cache is enabled, an identical earlier request is replayed instead of
+    sent. Pass use_cache=False to force a fresh sample, the fresh result still replaces the
+    cached one.
+
+    Side Effects:
+    Generates a Query objects and associated ApiCall objects and queues them on the
+    write-behind query log. The yielded Query is never attached to a session, and the
+    stream never waits on the database.
+    """
+
+    system_prompt, messages = build_messages(system_prompt, prompt, previous_messages)
 
     complete_output = ""
     retry_count = 0
 
     query = Query(author_id=cast(int, user.id), original_prompt=prompt, system_prompt=system_prompt,
-                   complete_output=complete_output)
+                   complete_output=complete_output, step=step, status=STREAMING)
     query.previous_messages=previous_messages
     if obj is not None:
-        print("pairing")
         pair_query_with_object(query, obj)
-    db.add(query)
-    db.commit()
-    db.refresh(query)
+    query_key = await query_log.insert(query)
+    checkpoint = Checkpointer(query_key, query)
+    progress = current_progress.get()
     print("ATTEMPTING QUERY: ", system_prompt, prompt)
 
-    # $0.01 / 1K tokens	$0.03 / 1K tokens
+    route = route or default_route()
+    request_params = route.request_params()
+    if response_format is not None:
+        request_params["response_format"] = response_format
+    model = route.model
+
+    response_cache = get_response_cache()
+    key = cache_key(messages, **request_params) if response_cache is not None else None
+    if response_cache is not None and key is not None and use_cache:
+        cached = await response_cache.aget(key)
+        if cached is not None:
+            print("CACHE HIT: ", key)
+            output = cached["output"]
+            for i in range(0, len(output), CACHE_REPLAY_CHUNK_SIZE):
+                yield output[i:i + CACHE_REPLAY_CHUNK_SIZE]
+                if stream_parser is not None:
+                    stream_parser.feed(output[i:i + CACHE_REPLAY_CHUNK_SIZE])
+
+            api_call = ApiCall(success=True, cost=0.0, output=output)
+            api_call.input_messages=[Message(**x) for x in messages]
+            await query_log.insert(api_call, parent=query_key, final=True)
+
+            query.complete_output = output
+            query.all_messages = [Message(**x) for x in messages + cached["messages"]]
+            query.status = COMPLETE
+            query.id = await query_log.row_id(query_key)
+            await query_log.update(query_key, query, final=True)
+
+            yield query
+            return
+
+    initial_message_count = len(messages)
+    finish_reason = None
+    rate_limiter = get_rate_limiter()
+    # what's actually sent, messages keeps the whole conversation for the record
+    request_messages = messages
+    continuing = False
+    completion_tokens = 0
+    response_chunks: list[str] = []
+    prompt_tokens = 0
+    estimated_tokens = 0
+    timed_out = False
+    diverged: Optional[FormatDiverged] = None
+    hedge_outcome = HedgeOutcome()
+
+    if resume_from is not None and resume_from.complete_output:
+        print("RESUMING INTERRUPTED QUERY: ", resume_from.id)
+        complete_output = resume_from.complete_output
+        query.complete_output = complete_output
+        query.continues = 1
+        yield complete_output
+        if stream_parser is not None:
+            stream_parser.feed(complete_output)
+        messages.append({"role": "assistant", "content": complete_output})
+        messages.append({"role": "user", "content": CONTINUE_PROMPT})
+        request_messages = continuation_messages(messages[0], messages[initial_message_count - 1],
+                                                 complete_output, CONTINUE_PROMPT, model)
+        continuing = True
+    # streams opened by the current attempt and the endpoint each went to, to blame the endpoint if
+    # it fails and settle its rate limit charge
+    opened: list[tuple[AsyncStream, str]] = []
 
     while True:
+        if deadline is not None and deadline.expired():
+            print("DEADLINE EXCEEDED FOR STEP: ", step)
+            timed_out = True
+            break
         try:
-            stream = completions_with_backoff(model="gpt-4-1106-preview",
-                                                messages=messages,
-                                                max_tokens=QUERY_MAX_TOKENS,
-                                                temperature=QUERY_TEMPERATURE,
-                                                frequency_penalty=QUERY_FREQUENCY_PENALTY,
-                                                stream=True)
-
-
-            response_text = ""
+            stats = pool_stats()
+            print("LLM POOL: ", stats)
+            if stats["waiting"]:
+                print("WARNING: LLM POOL SATURATED, REQUEST WILL QUEUE FOR A CONNECTION")
+            prompt_tokens = await async_num_tokens_from_messages(request_messages, model)
+            limits = model_limits(model, route.context_window)
+            if limits is not None and prompt_tokens + MIN_PLANNED_TOKENS > limits[0]:
+                request_messages = await run_in_threadpool(fit_messages, request_messages, model, limits[0], MIN_PLANNED_TOKENS)
+                prompt_tokens = await async_num_tokens_from_messages(request_messages, model)
+            call_params = {**request_params,
+                           "max_tokens": plan_max_tokens(step, model, prompt_tokens, request_params["max_tokens"], route.context_window)}
+            estimated_tokens = prompt_tokens + estimate_completion_tokens(call_params["max_tokens"])
+            record_call(step, model, continuing)
+            if progress is not None:
+                progress.start_call(step, model, prompt_tokens, continuing)
+
+            response_chunks = []
             finish_reason = None
-            for chunk in stream:
-                choice = chunk.choices[0]
-                delta =  choice.delta
-                if choice.finish_reason:
-                    finish_reason = choice.finish_reason
-
-                if delta.content:
-                    response_text += delta.content
-                    yield delta.content
-
+            usage = None
+            hedge_outcome = HedgeOutcome()
+            opened = []
+            async with rate_limiter.slot():
+                async def open_stream(sent: Callable[[], None]):
+                    sent_to = []
+                    def sending(url: str):
+                        sent_to.append(url)
+                        sent()
+                    stream = await async_completions_with_backoff(estimated_tokens,
+                                                                  base_url=route.base_url,
+                                                                  sent=sending,
+                                                                  deadline=deadline,
+                                                                  messages=request_messages,
+                                                                  stream=True,
+                                                                  timeout=pool_timeout(deadline.remaining() if deadline else None),
+                                                                  **call_params)
+                    opened.append((stream, sent_to[-1]))
+                    return stream
+
+                chunks = watch(hedged_stream(model, open_stream, hedge_outcome),
+                               conf.LLM_FIRST_CHUNK_TIMEOUT, conf.LLM_IDLE_TIMEOUT, deadline)
+                async for chunk in chunks:
+                    # the usage chunk comes last and carries no choices
+                    usage = getattr(chunk, "usage", None) or usage
+                    if not chunk.choices:
+                        continue
+                    choice = chunk.choices[0]
+                    delta = choice.delta
+                    if choice.finish_reason:
+                        finish_reason = choice.finish_reason
+
+                    if delta.content:
+                        response_chunks.append(delta.content)
+                        yield delta.content
+                        if progress is not None:
+                            progress.add(delta.content)
+                        if checkpoint.due(len(delta.content)):
+                            await checkpoint.save(complete_output + "".join(response_chunks))
+                        if stream_parser is not None:
+                            stream_parser.feed(delta.content)
+                            if stream_parser.error is not None:
+                                diverged = stream_parser.error
+                                break
+                if diverged is not None:
+                    # closes the stream, the rest of the output is never generated or billed
+                    await chunks.aclose()  # type: ignore
+
+            response_text = "".join(response_chunks)
             print("RECEIVED: ", response_text)
-
-            call_cost = None
-            # if response.usage:
-            #     call_cost = calc_cost(
-            #         response.usage.prompt_tokens, response.usage.completion_tokens)
-            #     tiktoken_call_cost = calc_cost(
-            #         num_tokens_from_messages(messages), num_tokens_from_messages([{"role": "assistant", "content": choice.message.content}]))
-
-            #     print("COST COMPARISON (should be even, api cost first): ", call_cost, tiktoken_call_cost)
-            tiktoken_call_cost = calc_cost(
-                num_tokens_from_messages(messages), num_tokens_from_messages([{"role": "assistant", "content": response_text}]))
-            call_cost = tiktoken_call_cost
-
-            api_call = ApiCall(query_id=cast(int, query.id), success=True, cost=call_cost,
+            endpoint_pool.report(hedge_outcome.stream, ok=True, ttft=hedge_outcome.ttft)
+
+            if hedge_outcome.hedged:
+                # the losing request was closed before it finished, but its prompt was still billed
+                lost_call = ApiCall(success=False, error="hedge_lost", cost=calc_cost(prompt_tokens, 0, model), output="")
+                lost_call.input_messages=[Message(**x) for x in request_messages]
+                await query_log.insert(lost_call, parent=query_key, final=True)
+                for stream, url in opened:
+                    if stream is not hedge_outcome.stream:
+                        await rate_limiter.settle(url, model, estimated_tokens, prompt_tokens)
+
+            reported = usage_tokens(usage)
+            if reported is not None:
+                cached_tokens = cached_prompt_tokens(usage)
+                if cached_tokens is not None:
+                    print("CACHED PROMPT TOKENS: ", cached_tokens, "/", reported[0])
+            else:
+                # provider didn't report usage, fall back to counting ourselves.
+                reported = (prompt_tokens,
+                            await async_num_tokens_from_messages([{"role": "assistant", "content": response_text}], model))
+            call_cost = calc_cost(*reported, model)
+            completion_tokens += reported[1]
+            for stream, url in opened:
+                if stream is hedge_outcome.stream:
+                    await rate_limiter.settle(url, model, estimated_tokens, sum(reported))
+
+            api_call = ApiCall(success=True, cost=call_cost,
                                 output=response_text)
-            api_call.input_messages=[Message(**x) for x in messages]
-            db.add(api_call)
-            db.commit()
+            api_call.input_messages=[Message(**x) for x in request_messages]
+            if diverged is not None:
+                api_call.success = False
+                api_call.error = f"format_diverged: {diverged}"
+            elif finish_reason == "content_filter":
+                api_call.success = False
+                api_call.error = "content_filter"
+            elif finish_reason not in ("stop", "length"):
+                api_call.success = False
+                api_call.error = "unknown"
+            await query_log.insert(api_call, parent=query_key, final=True)
 
             if response_text:
                 complete_output += response_text
                 query.complete_output = complete_output
 
+            if diverged is not None:
+                print("OUTPUT WENT OFF FORMAT, ABORTED: ", diverged)
+                messages.append({"role": "assistant", "content": response_text})
+                break
             if finish_reason == None:
                 print("WARNING: NO FINISH REASON DETECTED, LIKELY ISSUE")
             # CONTINUE CASE
             if finish_reason == "length":
-                new_message = {"role": "assistant", "content": response_text}
-                messages.append(new_message)
+                messages.append({"role": "assistant", "content": response_text})
                 messages.append({"role": "user", "content": CONTINUE_PROMPT})
+                # only the request and the end of the output so far, not the whole conversation again
+                request_messages = continuation_messages(messages[0], messages[initial_message_count - 1],
+                                                         complete_output, CONTINUE_PROMPT, model)
+                continuing = True
 
                 retry_count = 0
                 continue
             # SUCCESS CASE
             if finish_reason == "stop":
-                new_message = {"role": "assistant", "content": response_text}
-                messages.append(new_message)
+                messages.append({"role": "assistant", "content": response_text})
+                record_output(step, model, completion_tokens)
                 break
 
             # ERROR CASES
             elif finish_reason == "content_filter":
                 print("Content Filtering ERROR: " + finish_reason)
-                api_call.success = False
-                api_call.error = "content_filter"
 
                 retry_count += 1
 
                 if retry_count > MAX_RETRIES:
                     break
+                await asyncio.sleep(cap(retry_delay(retry_count), deadline))
                 continue
             else:
                 # other error case
                 print("Unknown ERROR: " + finish_reason if finish_reason else "NONE")
-                api_call.success = False
-                api_call.error = "unknown"
-
-                retry_count += 1
-
-                if retry_count > MAX_RETRIES:
-                    break
                 break
 
-        except openai.APIError as e:
+        # httpx errors too, a connection dropped mid-stream isn't wrapped by the openai client
+        except (openai.APIError, httpx.TransportError, StreamStalled) as e:
             print(e)
+            # the stream being read, or every one this attempt opened if it failed before content
+            for stream, url in opened:
+                if hedge_outcome.stream is None or stream is hedge_outcome.stream:
+                    endpoint_pool.report(stream, ok=False)
+            # what streamed before the failure already reached the client, keep it and pick up from there
+            partial = "".join(response_chunks)
+            partial_tokens = await async_num_tokens_from_messages([{"role": "assistant", "content": partial}], model) if partial else 0
+            failed_call = ApiCall(success=False, error=f"{type(e).__name__}: {e}",
+                                  cost=calc_cost(prompt_tokens, partial_tokens, model) if partial else 0.0,
+                                  output=partial)
+            failed_call.input_messages=[Message(**x) for x in request_messages]
+            await query_log.insert(failed_call, parent=query_key, final=True)
+            for stream, url in opened:
+                read = stream is hedge_outcome.stream and partial
+                await rate_limiter.settle(url, model, estimated_tokens, prompt_tokens + partial_tokens if read else 0)
+
+            if partial:
+                complete_output += partial
+                query.complete_output = complete_output
+                completion_tokens += partial_tokens
+                messages.append({"role": "assistant", "content": partial})
+                messages.append({"role": "user", "content": CONTINUE_PROMPT})
+                request_messages = continuation_messages(messages[0], messages[initial_message_count - 1],
+                                                         complete_output, CONTINUE_PROMPT, model)
+                continuing = True
+
             retry_count += 1
             if retry_count > MAX_RETRIES:
                 break
 
+            await asyncio.sleep(cap(retry_delay(retry_count), deadline))
             continue
 
     query.all_messages = [Message(**x) for x in messages]
-    db.add(query)
-    db.commit()
+    query.complete_output = complete_output
+    query.status = COMPLETE
+    query.id = await query_log.row_id(query_key)
+    await query_log.update(query_key, query, final=True)
 
-    yield query
-
-"""
-Slight variant of https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
-
-NOTICE:
-Eyeball testing has determined that this overestimates tokens by ~1% for gpt-4-1106-preview.
-"""
-def num_tokens_from_messages(messages, model="gpt-4-1106-preview"):
-    """Return the number of tokens used by a list of messages."""
-    try:
-        encoding = tiktoken.encoding_for_model(model)
-    except KeyError:
-        print("Warning: model not found. Using cl100k_base encoding.")
-        encoding = tiktoken.get_encoding("cl100k_base")
-    if model in {
-        "gpt-3.5-turbo-0613",
-        "gpt-3.5-turbo-16k-0613",
-        "gpt-4-0314",
-        "gpt-4-32k-0314",
-        "gpt-4-0613",
-        "gpt-4-32k-0613",
-        "gpt-4-1106-preview"
-        }:
-        tokens_per_message = 3
-        tokens_per_name = 1
-    elif model == "gpt-3.5-turbo-0301":
-        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
-        tokens_per_name = -1  # if there's a name, the role is omitted
-    elif "gpt-3.5-turbo" in model:
-        print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
-        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
-    elif "gpt-4" in model:
-        print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
-        return num_tokens_from_messages(messages, model="gpt-4-0613")
-    else:
-        raise NotImplementedError(
-            f"""num_tokens_from_messages() is not implemented for model {model}. See https://github.com/openai/openai-python/blob/main/chatml.md for information on how messages are converted to tokens."""
-        )
-    num_tokens = 0
-    for message in messages:
-        num_tokens += tokens_per_message
-        for key, value in message.items():
-            num_tokens += len(encoding.encode(value))
-            if key == "name":
-                num_tokens += tokens_per_name
-    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
-    return num_tokens
+    # only complete, successful generations are worth replaying
+    if response_cache is not None and key is not None and finish_reason == "stop":
+        await response_cache.aput(key, {"output": complete_output, "messages": messages[initial_message_count:]})
 
+    if timed_out:
+        raise GenerationTimeout(f"step {step} ran out of time", step=step)
+    if diverged is not None:
+        raise diverged
 
+    yield query
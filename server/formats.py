@@ -1,6 +1,10 @@
+import json
 import re
-from typing import TypedDict
-from .error import ParsingError
+import types
+from typing import Any, Callable, Literal, Optional, TypedDict, Union, cast, get_args, get_origin, get_type_hints
+from pydantic import BaseModel
+from .error import ParsingError, FormatDiverged
+from .config import get_settings
 
 
 # Everything except story base MUST be split before it is parsed.
@@ -444,7 +448,7 @@ SCENE_OUTLINE_FORMAT_STEP_2 = f"""\
 
 
 class SceneTextInnerParsed(TypedDict):
-    type: str
+    type: Literal["Paragraph", "Dialogue"]
     description: str
     content: str
 
@@ -483,3 +487,279 @@ SCENE_TEXT_FORMAT_STEP_2 = f"""\
 
     {SCENE_TEXT_FORMAT_STEP_1}
     """
+
+
+class Section(BaseModel):
+    """One block of a streamed output (a chapter, a scene, a paragraph), complete."""
+    # the "# " section it's in, named as split_sections names it, None before any
+    section: Optional[str]
+    heading: str
+    content: str
+    index: int
+
+
+class StreamParser():
+    """
+    Push based parser for the formats above, fed the output as it streams.
+
+    Blocks are the headings at level (the number of #s) matching block, in section, or
+    anywhere if section is None. A block is complete once the next heading at its level or
+    above starts. take() returns the blocks completed since it was last called, close()
+    ends the output and returns the rest.
+
+    The output has diverged, and error is set, when it goes max_preamble characters without
+    a heading of any kind, or into the section without a block. A loosely written heading
+    isn't divergence, repair.py can fix those up. Nothing more is parsed after
+    that. Whether what's left parses is still up to the format's parse_* function.
+    """
+    def __init__(self, block: str, level: int, section: Optional[str] = None, max_preamble: int = 1000):
+        self.block = re.compile(block)
+        self.level = level
+        self.section = section
+        self.max_preamble = max_preamble
+        self.error: Optional[FormatDiverged] = None
+        self._line = ""
+        self._chars = 0
+        self._current: Optional[str] = None
+        self._section_start: Optional[int] = 0 if section is None else None
+        self._blocks = 0
+        self._headings = 0
+        # blocks before the current section started
+        self._blocks_before = 0
+        self._open: Optional[tuple[str, list[str]]] = None
+        self._completed: list[Section] = []
+
+    def _in_section(self) -> bool:
+        return self.section is None or self._current == self.section
+
+    def _close_block(self) -> list[Section]:
+        if self._open is None:
+            return []
+        heading, lines = self._open
+        self._open = None
+        self._blocks += 1
+        return [Section(section=self._current, heading=heading, content="\n".join(lines).strip(), index=self._blocks)]
+
+    def _line_done(self, line: str) -> list[Section]:
+        completed: list[Section] = []
+        heading = re.match(r"(#+)\s*(.*?)\s*$", line)
+        if heading is None:
+            if self._open is not None:
+                self._open[1].append(line)
+            return completed
+        level, text = len(heading.group(1)), heading.group(2)
+        self._headings += 1
+        if level <= self.level:
+            completed += self._close_block()
+        if level == 1 and self.level > 1:
+            self._current = text.replace(" ", "_").lower()
+            self._section_start = self._chars if self._in_section() else None
+            self._blocks_before = self._blocks
+        elif level == self.level and self._in_section() and self.block.fullmatch(text):
+            self._open = (text, [])
+        elif self._open is not None:
+            self._open[1].append(line)
+        return completed
+
+    def _check(self):
+        seen = self._chars + len(self._line)
+        if self.level > 1 and self._headings == 0 and seen > self.max_preamble:
+            self.error = FormatDiverged(f"no heading in the first {self.max_preamble} characters")
+        elif (self._section_start is not None and self._in_section() and self._open is None
+              and self._blocks == self._blocks_before and seen - self._section_start > self.max_preamble):
+            where = f"the {self.section} section" if self.section else "the output"
+            self.error = FormatDiverged(f"nothing matching {self.block.pattern!r} in the first {self.max_preamble} characters of {where}")
+
+    def feed(self, delta: str):
+        if self.error is not None:
+            return
+        *lines, self._line = (self._line + delta).split("\n")
+        for line in lines:
+            self._completed += self._line_done(line)
+            self._chars += len(line) + 1
+        self._check()
+
+    def take(self) -> list[Section]:
+        completed, self._completed = self._completed, []
+        return completed
+
+    def close(self) -> list[Section]:
+        if self.error is None:
+            if self._line:
+                self._completed += self._line_done(self._line)
+            self._line = ""
+            self._completed += self._close_block()
+        return self.take()
+
+
+# the blocks of each format, for stream_parser: (heading pattern, level)
+STREAM_FORMATS: dict[Callable, tuple[str, int]] = {
+    parse_story_base: (r"Setting|Main Characters|Summary|Tags", 1),
+    parse_story_outline_simple: (r"Chapter \d+.*", 3),
+    parse_story_outline_medium: (r"Chapter \d+.*", 3),
+    parse_story_outline_complex: (r"Chapter \d+.*", 3),
+    parse_chapter_outline: (r"Scene \d+.*", 3),
+    parse_scene_outline: (r"Scene:? \d+.*", 2),
+    parse_scene_text: (r"(?:Paragraph|Dialogue):?.*", 3),
+}
+
+
+def stream_parser(parse: Callable, section: Optional[str] = None) -> Optional[StreamParser]:
+    """A StreamParser for the format parse parses, found in section, None for formats it doesn't know."""
+    if parse not in STREAM_FORMATS:
+        return None
+    block, level = STREAM_FORMATS[parse]
+    return StreamParser(block, level, section, get_settings().FORMAT_PROBE_CHARS)
+
+
+def json_schema(tp: Any) -> dict:
+    """
+    The JSON schema of a TypedDict above, strict as OpenAI's structured outputs want it:
+    every key required, no others, null only where the TypedDict allows None.
+    """
+    origin, args = get_origin(tp), get_args(tp)
+    if origin in (Union, types.UnionType):
+        schema = json_schema(next(arg for arg in args if arg is not type(None)))
+        return {**schema, "type": [schema["type"], "null"]}
+    if origin is Literal:
+        return {"type": "string", "enum": list(args)}
+    if origin is list:
+        return {"type": "array", "items": json_schema(args[0])}
+    if tp is str:
+        return {"type": "string"}
+    hints = get_type_hints(tp)
+    return {"type": "object", "properties": {key: json_schema(hint) for key, hint in hints.items()},
+            "required": list(hints), "additionalProperties": False}
+
+
+JSON_TYPES: dict[str, type] = {"string": str, "array": list, "object": dict, "null": type(None)}
+
+
+def validate(value: Any, schema: dict, path: str = "$"):
+    """Check decoded JSON against a json_schema, raising ParsingError at the first thing that doesn't fit."""
+    allowed = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    if not any(isinstance(value, JSON_TYPES[kind]) for kind in allowed):
+        raise ParsingError(f"{path} should be {' or '.join(allowed)}, not {type(value).__name__}")
+    if "enum" in schema and value not in schema["enum"]:
+        raise ParsingError(f"{path} should be one of {', '.join(schema['enum'])}, not {value!r}")
+    if isinstance(value, list):
+        for i, item in enumerate(value):
+            validate(item, schema["items"], f"{path}[{i}]")
+    elif isinstance(value, dict):
+        missing = [key for key in schema["required"] if key not in value]
+        if missing:
+            raise ParsingError(f"{path} is missing {', '.join(missing)}")
+        for key, inner in schema["properties"].items():
+            validate(value[key], inner, f"{path}.{key}")
+
+
+def render_story_base(d: StoryBaseParsed) -> str:
+    return (f"# Setting\n{d['setting']}\n\n# Main Characters\n{d['main_characters']}\n\n"
+            f"# Summary\n{d['summary']}\n\n# Tags\n{', '.join(d['tags'])}")
+
+
+def render_story_outline_simple(d: SimpleOutlineParsed) -> str:
+    return "\n".join(f"### Chapter {c['chapter_number']} — {c['title']}\n{c['description']}" for c in d['chapters'])
+
+
+def render_story_outline(d: MediumOutlineParsed | ComplexOutlineParsed) -> str:
+    lines = []
+    part = None
+    for c in d['chapters']:
+        # a part's heading goes before its first chapter only
+        if c['part_label'] and c['part_label'] != part:
+            lines.append(f"## {c['part_label']}")
+        part = c['part_label']
+        lines += [f"### Chapter {c['chapter_number']} — {c['title']}",
+                  "#### Chapter Purpose", c['chapter_purpose'],
+                  "#### Main Events", c['main_events']]
+        if 'chapter_summary' in c:
+            lines += ["#### Chapter Summary", cast(ComplexOutlineInnerParsed, c)['chapter_summary']]
+        lines += ["#### Chapter Notes", c['notes']]
+    return "\n".join(lines)
+
+
+def render_chapter_outline(d: ChapterOutlineParsed) -> str:
+    return "\n".join(f"### Scene {s['scene_number']}\n"
+                     f"#### Setting\n{s['setting']}\n"
+                     f"#### Primary Function\n{s['primary_function']}\n"
+                     f"#### Secondary Function\n{s['secondary_function']}\n"
+                     f"#### Summary\n{s['summary']}\n"
+                     f"#### Context\n{s['context']}" for s in d['scenes'])
+
+
+def render_scene_outline(d: SceneOutlineParsed) -> str:
+    return "\n".join(f"## Scene {s['scene_number']}\n{s['content']}" for s in d['scenes'])
+
+
+def render_scene_text(d: SceneTextParsed) -> str:
+    return "\n".join(f"### {s['type']} {s['description']}\n{s['content']}" for s in d['sections'])
+
+
+# each format's structure, and how to write it back out so the parse_* function reads it
+STRUCTURED_FORMATS: dict[Callable, tuple[Any, Callable[[Any], str]]] = {
+    parse_story_base: (StoryBaseParsed, render_story_base),
+    parse_story_outline_simple: (SimpleOutlineParsed, render_story_outline_simple),
+    parse_story_outline_medium: (MediumOutlineParsed, render_story_outline),
+    parse_story_outline_complex: (ComplexOutlineParsed, render_story_outline),
+    parse_chapter_outline: (ChapterOutlineParsed, render_chapter_outline),
+    parse_scene_outline: (SceneOutlineParsed, render_scene_outline),
+    parse_scene_text: (SceneTextParsed, render_scene_text),
+}
+
+# the "# " sections split_sections knows, in the order the formats put them
+SECTION_HEADINGS = {
+    "editing_notes": "Editing Notes",
+    "outline": "Outline",
+    "factsheet": "FactSheet",
+    "characters": "Characters",
+    "scene": "Scene",
+}
+
+STRUCTURED_INSTRUCTIONS = """
+
+Rather than markdown, answer with a JSON object in the response format you've been given: a key for each section of the format above, and the headings within a section as its fields."""
+
+
+class StructuredFormat():
+    """
+    A format asked for as JSON (OpenAI's structured outputs) instead of as markdown.
+
+    A sectioned format's answer has a key for section, holding parse's structure, and one
+    for each of others, free text. Otherwise the answer is parse's structure. decode()
+    validates an answer and renders it as the markdown parse (or split_sections) reads, so
+    nothing after the step can tell the difference.
+    """
+    def __init__(self, parse: Callable, section: Optional[str] = None, others: tuple[str, ...] = ()):
+        structure, self.render = STRUCTURED_FORMATS[parse]
+        self.name = parse.__name__.removeprefix("parse_")
+        self.section = section
+        inner = json_schema(structure)
+        if section is None:
+            self.schema = inner
+        else:
+            keys = [key for key in SECTION_HEADINGS if key == section or key in others]
+            self.schema = {"type": "object",
+                           "properties": {key: inner if key == section else {"type": "string"} for key in keys},
+                           "required": keys, "additionalProperties": False}
+
+    def response_format(self) -> dict:
+        return {"type": "json_schema", "json_schema": {"name": self.name, "strict": True, "schema": self.schema}}
+
+    def decode(self, output: str) -> str:
+        try:
+            answer = json.loads(output)
+        except json.JSONDecodeError as e:
+            raise ParsingError(f"Could not decode {self.name}: {e}")
+        validate(answer, self.schema)
+        if self.section is None:
+            return self.render(answer)
+        return "\n\n".join(f"# {SECTION_HEADINGS[key]}\n" + (self.render(answer[key]) if key == self.section else answer[key].strip())
+                           for key in self.schema["properties"])
+
+
+def structured_format(parse: Callable, section: Optional[str] = None, others: tuple[str, ...] = ()) -> Optional[StructuredFormat]:
+    """The StructuredFormat of the format parse parses, None for formats it doesn't know."""
+    if parse not in STRUCTURED_FORMATS:
+        return None
+    return StructuredFormat(parse, section, others)
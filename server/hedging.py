@@ -0,0 +1,204 @@
+import asyncio
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Any, AsyncIterator, Awaitable, Callable, Optional
+from .config import get_settings
+
+"""
+Hedged requests for LLM streams.
+
+Most streams produce their first token within a second, a few take ten or more. When
+hedging is on and a stream hasn't produced content within a delay derived from recent
+time-to-first-token (a high percentile, so only the slow tail gets hedged), a duplicate
+request is fired. Whichever stream produces content first is used and the other is closed.
+
+Time-to-first-token, and the hedge delay, run from when the request is sent: open_stream
+is given a callback to call then, after whatever it waited on first (the rate limiter,
+backoff), so a request held back by the limiter isn't taken for a slow one.
+
+Hedges cost a second prompt, so they are capped at HEDGE_MAX_FRACTION of requests.
+"""
+
+conf = get_settings()
+
+# time-to-first-token samples kept per model
+TTFT_WINDOW = 200
+
+
+@dataclass
+class HedgeStats():
+    requests: int = 0
+    hedges: int = 0
+    hedge_wins: int = 0
+    # time-to-first-token of recent winning streams, per model
+    ttft: dict[str, deque] = field(default_factory=dict)
+
+    def record_ttft(self, model: str, seconds: float):
+        self.ttft.setdefault(model, deque(maxlen=TTFT_WINDOW)).append(seconds)
+
+    def percentile(self, model: str, pct: float) -> Optional[float]:
+        samples = self.ttft.get(model)
+        if not samples or len(samples) < conf.HEDGE_MIN_SAMPLES:
+            return None
+        ordered = sorted(samples)
+        index = min(len(ordered) - 1, int(len(ordered) * pct / 100))
+        return ordered[index]
+
+    def delay(self, model: str) -> float:
+        """How long to wait for a first token before hedging, HEDGE_DELAY until there are enough samples."""
+        observed = self.percentile(model, conf.HEDGE_PERCENTILE)
+        if observed is None:
+            return conf.HEDGE_DELAY
+        return max(conf.HEDGE_MIN_DELAY, observed)
+
+    def can_hedge(self) -> bool:
+        return self.hedges < conf.HEDGE_MAX_FRACTION * self.requests
+
+    def report(self) -> dict[str, Any]:
+        return {"requests": self.requests,
+                "hedges": self.hedges,
+                "hedge_wins": self.hedge_wins,
+                "hedge_rate": self.hedges / self.requests if self.requests else 0.0,
+                "hedge_win_rate": self.hedge_wins / self.hedges if self.hedges else 0.0}
+
+
+hedge_stats = HedgeStats()
+
+
+@dataclass
+class HedgeOutcome():
+    hedged: bool = False
+    # the duplicate request produced content before the original
+    hedge_won: bool = False
+    # the stream that was read, and how long it took to produce content
+    stream: Any = None
+    ttft: Optional[float] = None
+
+
+class _Sent():
+    """When an attempt's request went out, set by the callback open_stream is given."""
+    def __init__(self):
+        self.at = time.monotonic()
+        self.event = asyncio.Event()
+
+    def __call__(self):
+        self.at = time.monotonic()
+        self.event.set()
+
+
+class _Primed():
+    """A stream that has been read up to and including its first chunk with content."""
+    def __init__(self, stream: Any, iterator: AsyncIterator, head: list, started: float):
+        self.stream = stream
+        self.iterator = iterator
+        self.head = head
+        self.ttft = time.monotonic() - started
+
+    async def chunks(self) -> AsyncIterator:
+        for chunk in self.head:
+            yield chunk
+        async for chunk in self.iterator:
+            yield chunk
+
+
+def _has_content(chunk) -> bool:
+    return bool(chunk.choices) and bool(chunk.choices[0].delta.content)
+
+
+async def close_stream(stream: Any):
+    response = getattr(stream, "response", None)
+    if response is not None:
+        await response.aclose()
+
+
+async def _prime(open_stream: Callable[[Callable[[], None]], Awaitable[Any]], sent: _Sent) -> _Primed:
+    stream = await open_stream(sent)
+    iterator = aiter(stream)
+    head = []
+    try:
+        async for chunk in iterator:
+            head.append(chunk)
+            if _has_content(chunk):
+                break
+    except BaseException:
+        await close_stream(stream)
+        raise
+    return _Primed(stream, iterator, head, sent.at)
+
+
+async def _discard(task: asyncio.Task):
+    """Cancel a losing attempt and close its stream if it got that far."""
+    task.cancel()
+    try:
+        primed = await task
+    except BaseException:
+        return
+    await close_stream(primed.stream)
+
+
+async def hedged_stream(model: str, open_stream: Callable[[Callable[[], None]], Awaitable[Any]], outcome: HedgeOutcome) -> AsyncIterator:
+    """
+    Yield the chunks of open_stream(sent), hedged by a second one if the first is slow.
+
+    open_stream calls sent() as it sends the request. outcome is filled in as the race is decided.
+    """
+    hedge_stats.requests += 1
+    if not conf.HEDGE_REQUESTS:
+        primed = await _prime(open_stream, _Sent())
+        hedge_stats.record_ttft(model, primed.ttft)
+        outcome.stream, outcome.ttft = primed.stream, primed.ttft
+        try:
+            async for chunk in primed.chunks():
+                yield chunk
+        finally:
+            await close_stream(primed.stream)
+        return
+
+    original_sent = _Sent()
+    original = asyncio.create_task(_prime(open_stream, original_sent))
+    hedge: Optional[asyncio.Task] = None
+    winner: Optional[asyncio.Task] = None
+    try:
+        # the delay starts once the request is out
+        sending = asyncio.ensure_future(original_sent.event.wait())
+        try:
+            await asyncio.wait({original, sending}, return_when=asyncio.FIRST_COMPLETED)
+        finally:
+            sending.cancel()
+        done, _ = await asyncio.wait({original}, timeout=hedge_stats.delay(model))
+        if not done and hedge_stats.can_hedge():
+            hedge_stats.hedges += 1
+            outcome.hedged = True
+            print("HEDGING: no first token after", round(hedge_stats.delay(model), 2), "s")
+            hedge = asyncio.create_task(_prime(open_stream, _Sent()))
+            done, _ = await asyncio.wait({original, hedge}, return_when=asyncio.FIRST_COMPLETED)
+            winner = done.pop()
+            if winner.exception() is not None:
+                # a failed attempt doesn't win, the other one gets its chance
+                other = original if winner is hedge else hedge
+                await asyncio.wait({other})
+                if other.exception() is None:
+                    winner = other
+            outcome.hedge_won = winner is hedge and winner.exception() is None
+            if outcome.hedge_won:
+                hedge_stats.hedge_wins += 1
+            print("HEDGE STATS: ", hedge_stats.report())
+        else:
+            await asyncio.wait({original})
+            winner = original
+
+        primed: _Primed = winner.result()
+    finally:
+        for task in (original, hedge):
+            if task is not None and task is not winner:
+                await _discard(task)
+
+    hedge_stats.record_ttft(model, primed.ttft)
+    outcome.stream, outcome.ttft = primed.stream, primed.ttft
+    try:
+        async for chunk in primed.chunks():
+            yield chunk
+    finally:
+        # also when the caller stops early (a stalled stream, a client that went away)
+        await close_stream(primed.stream)
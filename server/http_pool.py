@@ -0,0 +1,153 @@
+import asyncio
+import threading
+import httpx
+from collections import Counter
+from typing import AsyncIterator, Callable, Optional, TypedDict
+from .config import get_settings
+
+"""
+HTTP connection pool for the LLM clients.
+
+The OpenAI clients are handed httpx clients built from config instead of the defaults, so
+pool size, keep-alive and the per-phase timeouts are tuned for holding many long streams
+open at once. HTTP/2 is used when asked for and the h2 package is installed, multiplexing
+the streams over a few connections.
+
+The async transport counts requests in flight (until the response body is closed, not just
+until the headers arrive), in total and per origin, so pool occupancy can be reported and
+endpoints.py can send requests to the least busy endpoint. Occupancy is worked out from those
+counts and the pool limits rather than read from httpcore's pool, whose internals aren't
+public.
+"""
+
+conf = get_settings()
+
+
+class PoolStats(TypedDict):
+    max_connections: int
+    in_flight: int
+    peak_in_flight: int
+    # requests in flight beyond max_connections, queued for a connection (http/1.1 only)
+    waiting: int
+
+
+def http2_available() -> bool:
+    try:
+        import h2  # noqa: F401
+    except ImportError:
+        return False
+    return True
+
+
+def use_http2() -> bool:
+    if not conf.LLM_HTTP2:
+        return False
+    if not http2_available():
+        print("WARNING: LLM_HTTP2 is set but the h2 package isn't installed, using HTTP/1.1")
+        return False
+    return True
+
+
+def pool_limits() -> httpx.Limits:
+    return httpx.Limits(max_connections=conf.LLM_MAX_CONNECTIONS,
+                        max_keepalive_connections=conf.LLM_MAX_KEEPALIVE_CONNECTIONS,
+                        keepalive_expiry=conf.LLM_KEEPALIVE_EXPIRY)
+
+
+def pool_timeout(limit: Optional[float] = None) -> httpx.Timeout:
+    """The configured per-phase timeouts, none longer than limit if given."""
+    def capped(seconds: float) -> float:
+        return seconds if limit is None else min(seconds, limit)
+    return httpx.Timeout(connect=capped(conf.LLM_CONNECT_TIMEOUT),
+                         read=capped(conf.LLM_READ_TIMEOUT),
+                         write=capped(conf.LLM_WRITE_TIMEOUT),
+                         pool=capped(conf.LLM_POOL_TIMEOUT))
+
+
+def origin(url: httpx.URL | str) -> str:
+    url = httpx.URL(url)
+    return f"{url.scheme}://{url.netloc.decode()}"
+
+
+class _CountedStream(httpx.AsyncByteStream):
+    def __init__(self, stream: httpx.AsyncByteStream, release: Callable[[], None]):
+        self._stream = stream
+        self._release = release
+        self._released = False
+
+    async def __aiter__(self) -> AsyncIterator[bytes]:
+        async for part in self._stream:
+            yield part
+
+    async def aclose(self):
+        try:
+            await self._stream.aclose()
+        finally:
+            if not self._released:
+                self._released = True
+                self._release()
+
+
+class CountingTransport(httpx.AsyncHTTPTransport):
+    def __init__(self, http2: bool = False, **kwargs):
+        super().__init__(http2=http2, **kwargs)
+        self.http2 = http2
+        self.in_flight = 0
+        self.peak_in_flight = 0
+        self._by_origin: Counter[str] = Counter()
+        self._lock = threading.Lock()
+
+    def _release(self, key: str):
+        with self._lock:
+            self.in_flight -= 1
+            self._by_origin[key] -= 1
+
+    def in_flight_to(self, url: str) -> int:
+        """Requests in flight to url's origin."""
+        return self._by_origin[origin(url)]
+
+    async def handle_async_request(self, request: httpx.Request) -> httpx.Response:
+        key = origin(request.url)
+        with self._lock:
+            self.in_flight += 1
+            self.peak_in_flight = max(self.peak_in_flight, self.in_flight)
+            self._by_origin[key] += 1
+        try:
+            response = await super().handle_async_request(request)
+        except BaseException:
+            self._release(key)
+            raise
+        response.stream = _CountedStream(response.stream, lambda: self._release(key))  # type: ignore
+        return response
+
+    def stats(self) -> PoolStats:
+        # over http/1.1 every request in flight holds a connection, the ones past the limit wait
+        # for one. over http/2 requests share connections and don't wait.
+        in_flight = self.in_flight
+        limit = conf.LLM_MAX_CONNECTIONS
+        return PoolStats(max_connections=limit,
+                         in_flight=in_flight,
+                         peak_in_flight=self.peak_in_flight,
+                         waiting=max(0, in_flight - limit) if not self.http2 else 0)
+
+
+def build_async_http_client() -> tuple[httpx.AsyncClient, CountingTransport]:
+    transport = CountingTransport(http2=use_http2(), limits=pool_limits())
+    return httpx.AsyncClient(transport=transport, timeout=pool_timeout()), transport
+
+
+async def warm_pool(client: httpx.AsyncClient, url: str, headers: dict[str, str], connections: int):
+    """
+    Open connections to the API ahead of the first generation, so it doesn't pay for TLS.
+
+    Any response will do, even an error, what we want is the connection left in the pool.
+    Failures are only logged.
+    """
+    async def touch():
+        try:
+            response = await client.get(url, headers=headers)
+            await response.aclose()
+        except httpx.HTTPError as e:
+            print("WARNING: could not warm LLM connection:", e)
+
+    await asyncio.gather(*(touch() for _ in range(connections)))
@@ -0,0 +1,358 @@
+import asyncio
+import sqlite3
+import time
+from collections.abc import AsyncIterator, Callable, Sequence
+from functools import lru_cache
+from typing import Optional, TypedDict
+from fastapi.concurrency import run_in_threadpool
+from .error import JobConflict
+from .config import get_settings
+
+"""
+Durable generation jobs.
+
+A generation request doesn't run the generation any more, it submits a job to a queue in a
+SQLite file shared by all workers and attaches to the job's stream. Each process runs
+JOB_WORKERS tasks taking jobs off the queue. There's at most one queued or running job per
+object and step, so a reconnecting EventSource, a retrying proxy or a second tab attach to
+the generation already under way instead of paying for another one. A job can also name
+jobs of other kinds that overlap it (a chapter and the fan-out over its story outline), it
+isn't queued while one of those is active.
+
+Everything the job streams is kept as numbered events. They're written to the file in
+batches, every JOB_FLUSH_INTERVAL seconds and whenever an SSE event ends, clients in the same
+process see them before that. Frames that end an event carry an SSE id "<job id>:<seq>", and
+attaching with a Last-Event-ID replays what came after it, so a reconnect starts on the event
+it was in the middle of again, loses nothing and a client that dropped off still gets the
+result, the job carries on without it. Clients in another process poll the file for new
+events every JOB_POLL_INTERVAL seconds.
+
+Workers beat on their running jobs every JOB_HEARTBEAT_INTERVAL seconds, a running job that
+hasn't had one in JOB_STALE_AFTER seconds died with its process and is marked failed, the next
+request starts over (resuming the interrupted query, see checkpoint.py). Finished jobs are
+kept JOB_RETENTION seconds.
+"""
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+class Job(TypedDict):
+    id: int
+    kind: str
+    target_id: int
+    author_id: int
+    resume: bool
+    status: str
+    error: Optional[str]
+    created_at: float
+    started_at: Optional[float]
+    heartbeat_at: float
+    finished_at: Optional[float]
+
+
+def event_id(job_id: int, seq: int) -> str:
+    return f"{job_id}:{seq}"
+
+
+def sse_frame(job_id: int, seq: int, data: str) -> str:
+    """data, with its id if it ends an event, where a reconnect can pick up cleanly."""
+    if data.endswith("\n\n"):
+        return f"{data[:-1]}id: {event_id(job_id, seq)}\n\n"
+    return data
+
+
+def parse_event_id(value: Optional[str]) -> Optional[tuple[int, int]]:
+    """(job id, seq) from a Last-Event-ID, None if there's none or it isn't one of ours."""
+    if not value:
+        return None
+    job_id, _, seq = value.partition(":")
+    if not (job_id.isdigit() and seq.isdigit()):
+        return None
+    return int(job_id), int(seq)
+
+
+class JobQueue():
+    def __init__(self, path: str, stale_after: float, retention: float):
+        self.path = path
+        self.stale_after = stale_after
+        self.retention = retention
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                                id INTEGER PRIMARY KEY AUTOINCREMENT,
+                                kind TEXT NOT NULL,
+                                target_id INTEGER NOT NULL,
+                                author_id INTEGER NOT NULL,
+                                -- reuse the steps already done, see checkpoint.py
+                                resume INTEGER NOT NULL DEFAULT 0,
+                                status TEXT NOT NULL,
+                                error TEXT,
+                                created_at REAL NOT NULL,
+                                started_at REAL,
+                                heartbeat_at REAL NOT NULL,
+                                finished_at REAL)""")
+            # one active job per object and step
+            conn.execute(f"""CREATE UNIQUE INDEX IF NOT EXISTS jobs_active ON jobs (kind, target_id)
+                             WHERE status IN ('{QUEUED}', '{RUNNING}')""")
+            conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+            conn.execute("""CREATE TABLE IF NOT EXISTS events (
+                                job_id INTEGER NOT NULL,
+                                seq INTEGER NOT NULL,
+                                data TEXT NOT NULL,
+                                PRIMARY KEY (job_id, seq))""")
+
+    def _connect(self) -> sqlite3.Connection:
+        conn = sqlite3.connect(self.path, timeout=10, isolation_level=None)
+        conn.row_factory = sqlite3.Row
+        return conn
+
+    def _fail_stale(self, conn: sqlite3.Connection, now: float, where: str = "", params: tuple = ()) -> int:
+        return conn.execute(f"""UPDATE jobs SET status = ?, error = ?, finished_at = ?
+                                WHERE status = ? AND heartbeat_at < ? {where}""",
+                            (FAILED, "worker stopped", now, RUNNING, now - self.stale_after, *params)).rowcount
+
+    def submit(self, kind: str, target_id: int, author_id: int, resume: bool = False,
+               overlaps: Sequence[tuple[str, int]] = ()) -> tuple[Job, bool]:
+        """
+        The active job for kind and target, or a new one. True if it's new.
+
+        A new job after one that failed resumes, whether resume is set or not. Raises
+        JobConflict rather than queue one while a job in overlaps, (kind, target) pairs
+        generating some of the same objects, is active.
+        """
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            self._fail_stale(conn, now, "AND kind = ? AND target_id = ?", (kind, target_id))
+            row = conn.execute("SELECT * FROM jobs WHERE kind = ? AND target_id = ? AND status IN (?, ?)",
+                               (kind, target_id, QUEUED, RUNNING)).fetchone()
+            created = row is None
+            if created:
+                for other_kind, other_id in overlaps:
+                    self._fail_stale(conn, now, "AND kind = ? AND target_id = ?", (other_kind, other_id))
+                    other = conn.execute("SELECT id FROM jobs WHERE kind = ? AND target_id = ? AND status IN (?, ?)",
+                                         (other_kind, other_id, QUEUED, RUNNING)).fetchone()
+                    if other is not None:
+                        raise JobConflict(f"{other_kind} {other_id} is being generated by job {other['id']}", other["id"])
+                last = conn.execute("SELECT status FROM jobs WHERE kind = ? AND target_id = ? ORDER BY id DESC LIMIT 1",
+                                    (kind, target_id)).fetchone()
+                resume = resume or (last is not None and last["status"] == FAILED)
+                job_id = conn.execute("""INSERT INTO jobs (kind, target_id, author_id, resume, status, created_at, heartbeat_at)
+                                         VALUES (?, ?, ?, ?, ?, ?, ?)""",
+                                      (kind, target_id, author_id, resume, QUEUED, now, now)).lastrowid
+                row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+                self._prune(conn, now)
+            conn.execute("COMMIT")
+            return Job(**row), created
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _prune(self, conn: sqlite3.Connection, now: float):
+        old = "SELECT id FROM jobs WHERE finished_at < ?"
+        conn.execute(f"DELETE FROM events WHERE job_id IN ({old})", (now - self.retention,))
+        conn.execute("DELETE FROM jobs WHERE finished_at < ?", (now - self.retention,))
+
+    def claim(self) -> Optional[Job]:
+        """Take the oldest queued job, if any."""
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)).fetchone()
+            if row is not None:
+                conn.execute("UPDATE jobs SET status = ?, started_at = ?, heartbeat_at = ? WHERE id = ?",
+                             (RUNNING, now, now, row["id"]))
+            conn.execute("COMMIT")
+            return Job(**{**dict(row), "status": RUNNING, "started_at": now}) if row is not None else None
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def get(self, job_id: int) -> Optional[Job]:
+        with self._connect() as conn:
+            row = conn.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**row) if row is not None else None
+
+    def append(self, job_id: int, events: list[tuple[int, str]]):
+        """Record a batch of (seq, data) streamed events, in one transaction. Appending one twice is a no-op."""
+        with self._connect() as conn:
+            conn.executemany("INSERT OR IGNORE INTO events (job_id, seq, data) VALUES (?, ?, ?)",
+                             [(job_id, seq, data) for seq, data in events])
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def beat(self, job_id: int):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET heartbeat_at = ? WHERE id = ?", (time.time(), job_id))
+
+    def events(self, job_id: int, after: int) -> list[tuple[int, str]]:
+        with self._connect() as conn:
+            return [(row["seq"], row["data"]) for row in
+                    conn.execute("SELECT seq, data FROM events WHERE job_id = ? AND seq > ? ORDER BY seq", (job_id, after))]
+
+    def finish(self, job_id: int, status: str, error: Optional[str] = None):
+        with self._connect() as conn:
+            conn.execute("UPDATE jobs SET status = ?, error = ?, finished_at = ? WHERE id = ?",
+                         (status, error, time.time(), job_id))
+
+    def fail_stale(self) -> int:
+        """Mark the running jobs of workers that died as failed."""
+        with self._connect() as conn:
+            count = self._fail_stale(conn, time.time())
+        if count:
+            print("STALE JOBS FOUND: ", count)
+        return count
+
+
+class JobWorkers():
+    """This process's workers, and the streams clients attach to."""
+    def __init__(self, queue: JobQueue, count: int, poll_interval: float, flush_interval: float, heartbeat_interval: float):
+        self.queue = queue
+        self.count = count
+        self.poll_interval = poll_interval
+        self.flush_interval = flush_interval
+        self.heartbeat_interval = heartbeat_interval
+        self._tasks: list[asyncio.Task] = []
+        # the events of the jobs running here that aren't in the file yet
+        self._pending: dict[int, list[tuple[int, str]]] = {}
+        self._run: Optional[Callable[[Job], AsyncIterator[str]]] = None
+        self._submitted: Optional[asyncio.Event] = None
+        self._changed: Optional[asyncio.Event] = None
+
+    def start(self, run: Callable[[Job], AsyncIterator[str]]):
+        """Start taking jobs, run(job) streams the events of a job."""
+        self._run = run
+        self._submitted = asyncio.Event()
+        self._changed = asyncio.Event()
+        self.queue.fail_stale()
+        self._tasks = [asyncio.create_task(self._work()) for _ in range(max(1, self.count))]
+
+    async def stop(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+    def _notify(self):
+        if self._changed is not None:
+            self._changed.set()
+            self._changed = asyncio.Event()
+
+    async def _wait(self, event: Optional[asyncio.Event]):
+        """Until event is set or poll_interval has passed."""
+        if event is None:
+            await asyncio.sleep(self.poll_interval)
+            return
+        waiter = asyncio.ensure_future(event.wait())
+        try:
+            await asyncio.wait({waiter}, timeout=self.poll_interval)
+        finally:
+            waiter.cancel()
+
+    async def submit(self, kind: str, target_id: int, author_id: int, resume: bool = False,
+                     overlaps: Sequence[tuple[str, int]] = ()) -> Job:
+        job, created = await run_in_threadpool(self.queue.submit, kind, target_id, author_id, resume, overlaps)
+        if created:
+            print("JOB QUEUED: ", job["id"], kind, target_id, "resuming" if job["resume"] else "")
+            if self._submitted is not None:
+                self._submitted.set()
+        else:
+            print("JOB ALREADY ACTIVE, ATTACHING: ", job["id"], kind, target_id)
+        return job
+
+    async def _work(self):
+        assert self._submitted is not None
+        while True:
+            job = await run_in_threadpool(self.queue.claim)
+            if job is None:
+                self._submitted.clear()
+                await self._wait(self._submitted)
+                continue
+            await self._execute(job)
+
+    async def _execute(self, job: Job):
+        assert self._run is not None
+        print("JOB STARTED: ", job["id"], job["kind"], job["target_id"])
+        seq = 0
+        pending = self._pending[job["id"]] = []
+        flushing = asyncio.Lock()
+        last_beat = time.monotonic()
+
+        async def flush():
+            nonlocal last_beat
+            async with flushing:
+                if pending:
+                    events = list(pending)
+                    await run_in_threadpool(self.queue.append, job["id"], events)
+                    del pending[:len(events)]
+                    last_beat = time.monotonic()
+
+        async def keep_alive():
+            nonlocal last_beat
+            while True:
+                await asyncio.sleep(self.flush_interval)
+                await flush()
+                if time.monotonic() - last_beat >= self.heartbeat_interval:
+                    await run_in_threadpool(self.queue.beat, job["id"])
+                    last_beat = time.monotonic()
+
+        async def record(data: str):
+            nonlocal seq
+            seq += 1
+            pending.append((seq, data))
+            self._notify()
+            if data.endswith("\n\n"):
+                await flush()
+
+        beating = asyncio.create_task(keep_alive())
+        # unless it gets to the end, or fails on its own
+        status, failure = FAILED, "worker stopped"
+        try:
+            async for data in self._run(job):
+                await record(data)
+            status, failure = DONE, None
+        except Exception as e:
+            print("JOB FAILED: ", job["id"], repr(e))
+            status, failure = FAILED, getattr(e, "message", None) or repr(e)
+            await record(f"\n\nevent: error\ndata: {failure}\n\n")
+        finally:
+            beating.cancel()
+            try:
+                await flush()
+                await run_in_threadpool(self.queue.finish, job["id"], status, failure)
+            finally:
+                del self._pending[job["id"]]
+                self._notify()
+        print("JOB FINISHED: ", job["id"], status)
+
+    async def attach(self, job_id: int, after: int = 0) -> AsyncIterator[str]:
+        """The job's events after seq after, as SSE, until the job is finished."""
+        while True:
+            changed = self._changed
+            job = await run_in_threadpool(self.queue.get, job_id)
+            events = await run_in_threadpool(self.queue.events, job_id, after)
+            start = after
+            for seq, data in events + self._pending.get(job_id, []):
+                # pending events can go to the file between the two reads, don't skip past them
+                if seq != after + 1:
+                    continue
+                yield sse_frame(job_id, seq, data)
+                after = seq
+            if job is None or job["status"] in (DONE, FAILED):
+                return
+            if after == start:
+                await self._wait(changed)
+
+
+@lru_cache()
+def get_job_workers() -> JobWorkers:
+    conf = get_settings()
+    queue = JobQueue(conf.JOB_QUEUE_PATH, stale_after=conf.JOB_STALE_AFTER, retention=conf.JOB_RETENTION)
+    return JobWorkers(queue, conf.JOB_WORKERS, conf.JOB_POLL_INTERVAL, conf.JOB_FLUSH_INTERVAL, conf.JOB_HEARTBEAT_INTERVAL)
@@ -5,6 +5,14 @@ from .api import router as api_router
 from fastapi.security import OAuth2PasswordBearer
 from .config import get_settings
 from .auth_config import router as auth_router
+from .tokens import warm_tokenizers
+from .persistence import query_log
+from .executor import warm_llm_connections
+from .checkpoint import mark_interrupted
+from .jobs import get_job_workers
+from .api.generator import run_job
+from .database import engine
+from sqlmodel import Session
 from fastapi.middleware.cors import CORSMiddleware
 
 
@@ -31,6 +39,22 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
+@app.on_event("startup")
+async def warm_up():
+    warm_tokenizers()
+    query_log.start()
+    with Session(engine) as session:
+        mark_interrupted(session)
+    get_job_workers().start(run_job)
+    await warm_llm_connections()
+
+
+@app.on_event("shutdown")
+async def shut_down():
+    await get_job_workers().stop()
+    query_log.stop()
+
+
 @app.exception_handler(AuthJWTException)
 def authjwt_exception_handler(request: Request, exc: AuthJWTException):
     # see https://github.com/IndominusByte/fastapi-jwt-auth/issues/97
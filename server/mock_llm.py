@@ -0,0 +1,413 @@
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import re
+import time
+from dataclasses import dataclass, field
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+
+"""
+A local, deterministic stand-in for the OpenAI chat completions API.
+
+Point OPENAI_BASE_URL at it to run the whole pipeline (or load test the generator
+endpoints) without network access or spending anything:
+
+    python -m server.mock_llm --port 8001 --ttft 0.6 --tps 40
+    OPENAI_BASE_URL=http://localhost:8001/v1 uvicorn server.main:app
+
+Responses follow whichever format from formats.py the prompt asks for, or the JSON schema
+of a json_schema response_format, so every step parses. The same request always gets the
+same response. Streaming speed, the mix of finish reasons, injected errors and 429s are all
+configurable. A continuation request (CONTINUE_PROMPT) gets the rest of the response it
+continues.
+
+The files and batches endpoints of the Batch API are there too, batches are worked through
+in the background at the same speed and fault rates as single requests.
+"""
+
+CONTINUE_MARKER = "Your last message got cutoff"
+# the follow ups of repair.py
+REPAIR_MARKERS = ("Your answer above is missing", "In your answer above")
+
+WORDS = ("the", "rain", "city", "light", "she", "he", "they", "whispered", "door", "old", "river", "memory",
+         "across", "quiet", "signal", "under", "glass", "before", "promise", "machine", "cat", "neon", "was",
+         "never", "again", "into", "dark", "slowly", "heart", "broken", "map", "street", "station", "and",
+         "with", "a", "of", "to", "in", "her", "his", "their", "voice", "dream", "shadow", "morning", "laughed")
+
+
+@dataclass
+class MockSettings():
+    # seconds before the first token
+    ttft: float = 0.5
+    # jitter on ttft, as a fraction of it
+    ttft_jitter: float = 0.5
+    tokens_per_second: float = 50
+    # weights of the finish reasons, "length" cuts the response somewhere in its second half
+    finish_weights: dict[str, float] = field(default_factory=lambda: {"stop": 1.0, "length": 0.0, "content_filter": 0.0})
+    # fraction of requests that fail, half before streaming (500) and half mid-stream
+    error_rate: float = 0.0
+    # fraction of requests answered with a 429
+    rate_limit_rate: float = 0.0
+    # fraction of requests answered with prose in no format at all
+    off_format_rate: float = 0.0
+    # fraction of requests (always the same ones) answered nearly in format, see _flaw
+    flaw_rate: float = 0.0
+    # multiplies the length of generated prose
+    scale: float = 1.0
+    seed: int = 0
+    # seconds a batch spends validating before it starts
+    batch_delay: float = 1.0
+
+
+settings = MockSettings()
+app = FastAPI(title="mock llm")
+
+files: dict[str, bytes] = {}
+batches: dict[str, dict] = {}
+
+
+def _rng(*parts: str) -> random.Random:
+    digest = hashlib.sha256("\x00".join((str(settings.seed),) + parts).encode()).hexdigest()
+    return random.Random(int(digest[:16], 16))
+
+
+def _sentence(rng: random.Random) -> str:
+    words = [rng.choice(WORDS) for _ in range(rng.randint(6, 18))]
+    return " ".join(words).capitalize() + "."
+
+
+def _prose(rng: random.Random, sentences: int) -> str:
+    return " ".join(_sentence(rng) for _ in range(max(1, int(sentences * settings.scale))))
+
+
+def _title(rng: random.Random) -> str:
+    return " ".join(rng.choice(WORDS) for _ in range(rng.randint(1, 3))).title()
+
+
+def _chapters(rng: random.Random, detail: str) -> str:
+    chapters = []
+    for n in range(1, rng.randint(3, 6) + 1):
+        if detail == "simple":
+            chapters.append(f"### Chapter {n} — {_title(rng)}\n{_sentence(rng)}")
+            continue
+        chapter = (f"### Chapter {n} — {_title(rng)}\n"
+                   f"#### Chapter Purpose\n{_prose(rng, 2)}\n"
+                   f"#### Main Events\n" + "\n".join(f"- {_sentence(rng)}" for _ in range(rng.randint(2, 4))) + "\n")
+        if detail == "complex":
+            chapter += f"#### Chapter Summary\n{_prose(rng, 4)}\n"
+        chapter += f"#### Chapter Notes\n{_prose(rng, 2)}"
+        chapters.append(chapter)
+    return "\n".join(chapters)
+
+
+def _scenes(rng: random.Random) -> str:
+    return "\n".join(f"### Scene {n}\n"
+                     f"#### Setting\n{_sentence(rng)}\n"
+                     f"#### Primary Function\n{_sentence(rng)}\n"
+                     f"#### Secondary Function\n{_sentence(rng)}\n"
+                     f"#### Summary\n{_prose(rng, 3)}\n"
+                     f"#### Context\n{_sentence(rng)}"
+                     for n in range(1, rng.randint(2, 4) + 1))
+
+
+def fake_response(prompt: str, rng: random.Random) -> str:
+    """A response in whichever formats.py format the prompt asks for, markers checked most specific first."""
+    notes = f"# Editing Notes\n{_prose(rng, 3)}\n\n" if "# Editing Notes" in prompt else ""
+    if "<the dialogue section>" in prompt:
+        sections = []
+        for _ in range(rng.randint(4, 8)):
+            if rng.random() < 0.35:
+                sections.append(f"### Dialogue {_sentence(rng)}\n\"{_sentence(rng)}\" {_sentence(rng)}")
+            else:
+                sections.append(f"### Paragraph {_sentence(rng)}\n{_prose(rng, 6)}")
+        return notes + "# Scene\n## Scene 1\n" + "\n".join(sections)
+    if "Dialogue Placeholder: <" in prompt:
+        beats = [f"- {'Dialogue Placeholder' if rng.random() < 0.3 else 'Paragraph'}: {_sentence(rng)}"
+                 for _ in range(rng.randint(4, 8))]
+        return notes + "# Outline\n## Scene 1\n" + "\n".join(beats)
+    if "<the primary function>" in prompt:
+        return notes + f"# Outline\n## Chapter 1 — {_title(rng)}\n" + _scenes(rng)
+    if "<a paragraph summarizing the chapter>" in prompt:
+        return notes + "# Outline\n\n" + _chapters(rng, "complex") + \
+            f"\n\n# FactSheet\n{_prose(rng, 4)}\n\n# Characters\n{_prose(rng, 4)}"
+    if "<the function of this chapter in the story>" in prompt:
+        return notes + "# Outline\n\n" + _chapters(rng, "medium")
+    if "<one sentence describing the chapter>" in prompt:
+        return "# Outline\n\n" + _chapters(rng, "simple")
+    if "<comma separated list of tags" in prompt:
+        tags = ", ".join(sorted({rng.choice(WORDS) for _ in range(5)}))
+        return (f"# Setting\n{_prose(rng, 3)}\n\n# Main Characters\n{_prose(rng, 3)}\n\n"
+                f"# Summary\n{_prose(rng, 5)}\n\n# Tags\n{tags}")
+    return _prose(rng, 8)
+
+
+def fake_json(schema: dict, rng: random.Random, key: str = "", index: int = 1):
+    """A value fitting a formats.json_schema, key and index (of the array it's in) picking something plausible."""
+    kinds = schema["type"] if isinstance(schema["type"], list) else [schema["type"]]
+    if "null" in kinds and rng.random() < 0.5:
+        return None
+    if "enum" in schema:
+        return rng.choice(schema["enum"])
+    if kinds[0] == "object":
+        return {name: fake_json(inner, rng, name, index) for name, inner in schema["properties"].items()}
+    if kinds[0] == "array":
+        return [fake_json(schema["items"], rng, key, i) for i in range(1, rng.randint(3, 6) + 1)]
+    if key.endswith("_number"):
+        return str(index)
+    if key in ("title", "part_label", "tags"):
+        return _title(rng)
+    if key in ("description", "setting", "primary_function", "secondary_function", "context"):
+        return _sentence(rng)
+    return _prose(rng, 3)
+
+
+def _flaw(text: str, rng: random.Random) -> str:
+    """text with one of the mistakes repair.py fixes: a section left out, loose headings or an entry missing a heading."""
+    flaws = [lambda t: re.sub(r"^(#+ (?:Chapter|Scene) \d+) — ", r"\1: ", t, flags=re.MULTILINE),
+             lambda t: t.replace("# Outline\n", "## Revised outline\n\n", 1)]
+    if "# Editing Notes\n" in text:
+        flaws.append(lambda t: re.sub(r"# Editing Notes\n.*?\n\n(?=# )", "", t, count=1, flags=re.DOTALL))
+    for heading in ("#### Main Events\n", "#### Context\n"):
+        if heading in text:
+            flaws.append(lambda t, heading=heading: t.replace(heading, "", 1))
+    return rng.choice(flaws)(text)
+
+
+def repair_response(request: str, original: str) -> str:
+    """What a repair follow up asks for, taken from the response it should have been part of."""
+    parts = [re.search(rf"^{re.escape(heading)}\n.*?(?=\n\n# |\Z)", original, re.MULTILINE | re.DOTALL)
+             for heading in re.findall(r'"(# [^"]+)"', request)]
+    parts += [re.search(rf"^#+ {label}\b.*?(?=\n#{{1,3}} |\Z)", original, re.MULTILINE | re.DOTALL)
+              for label in re.findall(r"(?:Chapter|Scene) \d+", request)]
+    return "\n\n".join(part.group(0) for part in parts if part is not None)
+
+
+def _tokens(text: str) -> list[str]:
+    """Split text roughly the way a BPE tokenizer would, a word (with its leading space) or punctuation at a time."""
+    return re.findall(r"\s*\w+|\s*[^\w\s]|\s+", text)
+
+
+def plan_response(messages: list[dict], max_tokens: int | None,
+                  response_format: dict | None = None) -> tuple[list[str], str, int]:
+    """Return (tokens to send, finish reason, prompt tokens) for a request."""
+    requests = [m for m in messages if m["role"] == "user" and not m["content"].startswith(CONTINUE_MARKER)]
+    request = requests[-1]["content"] if requests else ""
+    system = next((m["content"] for m in messages if m["role"] == "system"), "")
+    if response_format and response_format.get("type") == "json_schema":
+        full = json.dumps(fake_json(response_format["json_schema"]["schema"], _rng(system, request)), indent=1, ensure_ascii=False)
+    elif request.startswith(REPAIR_MARKERS):
+        original = next((m["content"] for m in reversed(requests) if not m["content"].startswith(REPAIR_MARKERS)), "")
+        full = repair_response(request, fake_response(original, _rng(system, original)))
+    else:
+        full = fake_response(request, _rng(system, request))
+        if _rng(system, request, "flaw").random() < settings.flaw_rate:
+            full = _flaw(full, _rng(system, request, "which flaw"))
+
+    text = full
+    if messages[-1]["content"].startswith(CONTINUE_MARKER):
+        written = next((m["content"] for m in reversed(messages) if m["role"] == "assistant"), "")
+        at = full.rfind(written) if written else -1
+        text = full[at + len(written):] if at >= 0 else ""
+
+    rng = _rng(json.dumps(messages))
+    tokens = _tokens(text)
+    reasons, weights = zip(*settings.finish_weights.items())
+    finish = rng.choices(reasons, weights)[0]
+    if finish == "length" and len(tokens) > 1:
+        tokens = tokens[:rng.randint(len(tokens) // 2, len(tokens) - 1)]
+    elif finish == "content_filter":
+        tokens = tokens[:rng.randint(0, len(tokens) // 4)]
+    else:
+        finish = "stop"
+    if max_tokens and len(tokens) > max_tokens:
+        tokens, finish = tokens[:max_tokens], "length"
+
+    prompt_tokens = sum(len(_tokens(m["content"])) + 3 for m in messages) + 3
+    return tokens, finish, prompt_tokens
+
+
+def _error(status: int, message: str, kind: str, headers: dict | None = None) -> JSONResponse:
+    return JSONResponse(status_code=status, headers=headers,
+                        content={"error": {"message": message, "type": kind, "param": None, "code": None}})
+
+
+def _chunk(completion_id: str, model: str, created: int, delta: dict, finish: str | None) -> str:
+    return "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model,
+                                  "choices": [{"index": 0, "delta": delta, "finish_reason": finish}]}) + "\n\n"
+
+
+@app.get("/v1/models")
+async def models():
+    return {"object": "list", "data": [{"id": "mock", "object": "model", "created": 0, "owned_by": "mock"}]}
+
+
+@app.post("/v1/chat/completions")
+async def chat_completions(request: Request):
+    body = await request.json()
+    messages: list[dict] = body["messages"]
+    model = body.get("model", "mock")
+    rng = _rng(json.dumps(messages), "faults", str(time.time_ns()))
+
+    if rng.random() < settings.rate_limit_rate:
+        return _error(429, "Rate limit reached (mock)", "requests", headers={"retry-after": "1"})
+    fail = rng.random() < settings.error_rate
+    if fail and rng.random() < 0.5:
+        return _error(500, "The server had an error while processing your request (mock)", "server_error")
+
+    tokens, finish, prompt_tokens = plan_response(messages, body.get("max_tokens"), body.get("response_format"))
+    if rng.random() < settings.off_format_rate:
+        tokens, finish = _tokens(_prose(rng, int(40 * settings.scale))), "stop"
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+    completion_id = "chatcmpl-mock-" + hashlib.sha1(json.dumps(messages).encode()).hexdigest()[:12]
+    created = int(time.time())
+    ttft = max(0.0, settings.ttft * (1 + rng.uniform(-settings.ttft_jitter, settings.ttft_jitter)))
+
+    if not body.get("stream"):
+        await asyncio.sleep(ttft + len(tokens) / settings.tokens_per_second)
+        return {"id": completion_id, "object": "chat.completion", "created": created, "model": model, "usage": usage,
+                "choices": [{"index": 0, "finish_reason": finish, "message": {"role": "assistant", "content": "".join(tokens)}}]}
+
+    include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+    fail_at = rng.randint(0, max(0, len(tokens) - 1)) if fail else None
+
+    async def stream():
+        await asyncio.sleep(ttft)
+        yield _chunk(completion_id, model, created, {"role": "assistant", "content": ""}, None)
+        started = time.monotonic()
+        for i, token in enumerate(tokens):
+            if i == fail_at:
+                yield "data: " + json.dumps({"error": {"message": "Stream interrupted (mock)", "type": "server_error"}}) + "\n\n"
+                return
+            # sleep to the schedule rather than per token, so the rate holds under load
+            lag = started + i / settings.tokens_per_second - time.monotonic()
+            if lag > 0:
+                await asyncio.sleep(lag)
+            yield _chunk(completion_id, model, created, {"content": token}, None)
+        yield _chunk(completion_id, model, created, {}, finish)
+        if include_usage:
+            yield "data: " + json.dumps({"id": completion_id, "object": "chat.completion.chunk", "created": created,
+                                         "model": model, "choices": [], "usage": usage}) + "\n\n"
+        yield "data: [DONE]\n\n"
+
+    return StreamingResponse(stream(), media_type="text/event-stream")
+
+
+def _file_object(file_id: str, purpose: str) -> dict:
+    return {"id": file_id, "object": "file", "bytes": len(files[file_id]), "created_at": int(time.time()),
+            "filename": f"{file_id}.jsonl", "purpose": purpose}
+
+
+def _store(purpose: str, lines: list[dict]) -> str:
+    file_id = f"file-mock-{len(files)}"
+    files[file_id] = "".join(json.dumps(line) + "\n" for line in lines).encode()
+    return file_id
+
+
+@app.post("/v1/files")
+async def upload_file(request: Request):
+    form = await request.form()
+    file_id = f"file-mock-{len(files)}"
+    files[file_id] = await form["file"].read()  # type: ignore
+    return _file_object(file_id, str(form.get("purpose", "batch")))
+
+
+@app.get("/v1/files/{file_id}/content")
+async def file_content(file_id: str):
+    if file_id not in files:
+        return _error(404, f"No such file: {file_id}", "invalid_request_error")
+    return PlainTextResponse(files[file_id], media_type="application/jsonl")
+
+
+def _batch_response(body: dict, custom_id: str) -> tuple[int, dict]:
+    """(status code, body) of one batch line, a plain chat completion or an error."""
+    rng = _rng(json.dumps(body["messages"]), "faults", str(time.time_ns()))
+    if rng.random() < settings.error_rate:
+        return 500, {"error": {"message": "The server had an error while processing your request (mock)", "type": "server_error"}}
+    tokens, finish, prompt_tokens = plan_response(body["messages"], body.get("max_tokens"), body.get("response_format"))
+    usage = {"prompt_tokens": prompt_tokens, "completion_tokens": len(tokens), "total_tokens": prompt_tokens + len(tokens)}
+    return 200, {"id": f"chatcmpl-mock-{custom_id}", "object": "chat.completion", "created": int(time.time()),
+                 "model": body.get("model", "mock"), "usage": usage,
+                 "choices": [{"index": 0, "finish_reason": finish, "message": {"role": "assistant", "content": "".join(tokens)}}]}
+
+
+async def _process(batch: dict):
+    await asyncio.sleep(settings.batch_delay)
+    lines = [json.loads(line) for line in files[batch["input_file_id"]].decode().splitlines() if line.strip()]
+    batch.update(status="in_progress", in_progress_at=int(time.time()))
+    batch["request_counts"]["total"] = len(lines)
+    output, errors = [], []
+    longest = 0
+    for line in lines:
+        status, body = _batch_response(line["body"], line["custom_id"])
+        result = {"id": f"batch_req_{line['custom_id']}", "custom_id": line["custom_id"],
+                  "response": {"status_code": status, "request_id": line["custom_id"], "body": body}, "error": None}
+        (output if status == 200 else errors).append(result)
+        batch["request_counts"]["completed" if status == 200 else "failed"] += 1
+        longest = max(longest, body.get("usage", {}).get("completion_tokens", 0))
+    # the requests run side by side, so the batch takes as long as its longest one
+    await asyncio.sleep(settings.ttft + longest / settings.tokens_per_second)
+    batch.update(status="completed", completed_at=int(time.time()),
+                 output_file_id=_store("batch_output", output) if output else None,
+                 error_file_id=_store("batch_output", errors) if errors else None)
+
+
+@app.post("/v1/batches")
+async def create_batch(request: Request):
+    body = await request.json()
+    if body.get("input_file_id") not in files:
+        return _error(400, f"No such file: {body.get('input_file_id')}", "invalid_request_error")
+    batch_id = f"batch_mock_{len(batches)}"
+    batch = {"id": batch_id, "object": "batch", "endpoint": body.get("endpoint"), "errors": None,
+             "input_file_id": body["input_file_id"], "completion_window": body.get("completion_window", "24h"),
+             "status": "validating", "output_file_id": None, "error_file_id": None, "created_at": int(time.time()),
+             "request_counts": {"total": 0, "completed": 0, "failed": 0}, "metadata": body.get("metadata")}
+    batches[batch_id] = batch
+    asyncio.create_task(_process(batch))
+    return batch
+
+
+@app.get("/v1/batches/{batch_id}")
+async def retrieve_batch(batch_id: str):
+    if batch_id not in batches:
+        return _error(404, f"No such batch: {batch_id}", "invalid_request_error")
+    return batches[batch_id]
+
+
+def _finish_weights(value: str) -> dict[str, float]:
+    weights = {}
+    for part in value.split(","):
+        reason, weight = part.split("=")
+        weights[reason.strip()] = float(weight)
+    return weights
+
+
+if __name__ == "__main__":
+    import uvicorn
+
+    parser = argparse.ArgumentParser(description="Serve a deterministic fake of the OpenAI chat completions API.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8001)
+    parser.add_argument("--ttft", type=float, default=settings.ttft, help="seconds to the first token")
+    parser.add_argument("--ttft-jitter", type=float, default=settings.ttft_jitter)
+    parser.add_argument("--tps", type=float, default=settings.tokens_per_second, help="tokens per second")
+    parser.add_argument("--finish", type=_finish_weights, default=settings.finish_weights,
+                        help="finish reason weights, e.g. stop=0.9,length=0.08,content_filter=0.02")
+    parser.add_argument("--error-rate", type=float, default=settings.error_rate)
+    parser.add_argument("--rate-limit-rate", type=float, default=settings.rate_limit_rate)
+    parser.add_argument("--off-format-rate", type=float, default=settings.off_format_rate,
+                        help="fraction of responses that ignore the format asked for")
+    parser.add_argument("--flaw-rate", type=float, default=settings.flaw_rate,
+                        help="fraction of requests answered nearly in format, for repair.py to fix")
+    parser.add_argument("--scale", type=float, default=settings.scale, help="multiplies the length of the prose")
+    parser.add_argument("--seed", type=int, default=settings.seed)
+    parser.add_argument("--batch-delay", type=float, default=settings.batch_delay, help="seconds before a batch starts")
+    args = parser.parse_args()
+
+    settings.ttft, settings.ttft_jitter, settings.tokens_per_second = args.ttft, args.ttft_jitter, args.tps
+    settings.finish_weights, settings.error_rate, settings.rate_limit_rate = args.finish, args.error_rate, args.rate_limit_rate
+    settings.scale, settings.seed, settings.batch_delay = args.scale, args.seed, args.batch_delay
+    settings.off_format_rate, settings.flaw_rate = args.off_format_rate, args.flaw_rate
+    uvicorn.run(app, host=args.host, port=args.port)
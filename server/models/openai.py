@@ -32,6 +32,11 @@ class QueryBase(BaseSQLModel):
     continues: int = Field(default=0)
     retries: int = Field(default=0)
 
+    # orchestrator step, see routing.STEPS
+    step: Optional[str] = Field(default=None)
+    # "streaming" while the executor is writing it, see checkpoint.py
+    status: str = Field(default="complete", sa_column_kwargs={"server_default": "complete"})
+
     original_prompt: str = Field(sa_column_kwargs={"nullable": False})
     system_prompt: str = Field(sa_column_kwargs={"nullable": False})
     complete_output: str = Field(sa_column_kwargs={"nullable": False})
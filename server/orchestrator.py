@@ -1,27 +1,213 @@
 
-from collections.abc import Generator
+import json
+import threading
+from collections.abc import AsyncGenerator, Awaitable, Callable
+from dataclasses import dataclass
 from fastapi import HTTPException
-from typing import cast
+from typing import Any, cast
 from sqlmodel import Session
+from fastapi.concurrency import run_in_threadpool
 from pydantic import BaseModel
-from .models import User, Story, StoryOutline, ChapterOutline, SceneOutline, Scene, Query, ApiCall, StoryRead, StoryOutlineRead, ChapterOutlineRead, SceneOutlineRead, SceneRead
+from .models import User, Story, StoryOutline, ChapterOutline, SceneOutline, Scene, Query, ApiCall, StoryRead, StoryOutlineRead, ChapterOutlineRead, SceneOutlineRead, SceneRead, LinkableObject, Message
 from . import formats
 from . import prompt_generator
 from . import error
-from .executor import query_executor
+from . import batch
+from . import scheduler
+from . import repair
+from .executor import async_query_executor, build_messages
+from .database import engine
+from .routing import resolve_route
+from .budget import typical_output
+from .deadline import Deadline
+from .checkpoint import interrupted_query, completed_query, resuming, RESUMED
+from .config import get_settings
 
 MAX_RETRIES = 1
 
+conf = get_settings()
+
 # skip 4th step of story outline to save $$
 SKIP_STEP_4 = True
 
+# what a step is assumed to write, and a chapter to have scenes, before there's history to go by
+DEFAULT_STEP_TOKENS = 1000
+DEFAULT_SCENE_COUNT = 4
+
+# held by a save, see save
+writing = threading.Lock()
+
 class MidPoint(BaseModel):
     step: int
     step_name: str
     pass
 
 
-def generate_story(story: Story, db_session: Session, retry_count=0) -> Generator[str | Story | StoryRead, None, None]:
+@dataclass
+class StepResult:
+    """
+    The outcome of a single orchestration step: the finished query and its parsed sections.
+
+    A dataclass rather than a pydantic model so the Query isn't copied on validation.
+    """
+    query: Query
+    splits: dict[str, Any]
+
+
+@dataclass
+class SectionsParser:
+    """
+    A step parser that splits the output into sections and validates one of them.
+
+    Raises KeyError if the section is missing and ParsingError if it doesn't parse. others
+    are the free text sections the step reads as well, asked for when it's structured.
+    """
+    section: str
+    parser: Callable[[str], Any]
+    others: tuple[str, ...] = ()
+
+    def __call__(self, output: str) -> dict[str, Any]:
+        splits = formats.split_sections(output)
+        _test = self.parser(splits[self.section])
+        return splits
+
+
+def sections_parser(section: str, parser: Callable[[str], Any], *others: str) -> SectionsParser:
+    return SectionsParser(section, parser, others)
+
+
+def stream_parser(parse: Callable[[str], Any]) -> formats.StreamParser | None:
+    """A fresh incremental parser for a step's output, see formats.StreamParser."""
+    if isinstance(parse, SectionsParser):
+        return formats.stream_parser(parse.parser, parse.section)
+    return formats.stream_parser(parse)
+
+
+def structured_format(parse: Callable[[str], Any]) -> formats.StructuredFormat | None:
+    """The step's format as JSON, see formats.StructuredFormat."""
+    if isinstance(parse, SectionsParser):
+        return formats.structured_format(parse.parser, parse.section, parse.others)
+    return formats.structured_format(parse)
+
+
+def repairer(parse: Callable[[str], Any]) -> repair.Repairer | None:
+    """What fixes up the step's output when it doesn't quite parse, see repair.py."""
+    if isinstance(parse, SectionsParser):
+        return repair.repairer(parse, parse.parser, parse.section, parse.others)
+    return repair.repairer(parse, parse)
+
+
+async def run_step(db_session: Session, step: str, sys_prompt: str, prompt: str, author: User, obj: LinkableObject,
+                   parse: Callable[[str], dict[str, Any]], previous_messages: list[Message] = []) -> AsyncGenerator[str | StepResult, None]:
+    """
+    Stream a single step's query, then parse the output.
+
+    step names the step for model routing, see routing.py. The step, parse retries included,
+    has STEP_DEADLINE seconds, after which GenerationTimeout escapes to the SSE pipeline.
+
+    Yields text chunks as they arrive, each block of the format (formats.Section) once it's
+    complete, then a StepResult. Output that doesn't quite parse is repaired first (see
+    repair.py), with follow ups for just the parts that are missing. One that still doesn't
+    parse retries the query up to MAX_RETRIES times, after which the KeyError/ParsingError
+    escalates to an API failure. Output that goes off format is cut off as soon as that's
+    clear and retried the same way. Retries skip the response cache, replaying the output we
+    just failed to parse won't help.
+
+    Under a batch (see batch.py) the query is a line in the next batch rather than a stream.
+
+    If a previous run of this step was interrupted (see checkpoint.py), the first attempt
+    continues from its output. While resuming, a step already done from the same messages
+    isn't run again, its output is replayed as stored if it parses, otherwise the step runs as
+    usual.
+
+    If the step's route has structured_output, the model is asked for JSON in the step's
+    schema instead, which is validated and rendered back into the format's markdown. The
+    JSON isn't streamed, the markdown is yielded once it's all there.
+    """
+    route = resolve_route(step, author)
+    structured = structured_format(parse) if route.structured_output else None
+    if structured is not None:
+        prompt += formats.STRUCTURED_INSTRUCTIONS
+
+    def markdown(output: str) -> str:
+        return structured.decode(output) if structured is not None else output
+
+    deadline = Deadline.after(conf.STEP_DEADLINE)
+    executor = batch.batch_query_executor if batch.current_batch.get() is not None else async_query_executor
+    # JSON is held to its schema already
+    fixer = repairer(parse) if structured is None else None
+
+    def follow_up(query: Query) -> Callable[[str], Awaitable[str]]:
+        """Asks a follow up in the conversation query ended, for repairs."""
+        async def ask(request: str) -> str:
+            history = [message for message in query.all_messages if message.role != "system"]
+            answer = ""
+            async for chunk in executor(db_session, sys_prompt, request, author, obj, history,
+                                        route=route, step=f"{step}_repair", deadline=deadline):
+                if isinstance(chunk, Query):
+                    answer = chunk.complete_output
+            return answer
+        return ask
+
+    if resuming.get():
+        done = completed_query(db_session, step, obj, build_messages(sys_prompt, prompt, previous_messages)[0], prompt,
+                               json.dumps([message.dict() for message in previous_messages]))
+        if done is not None:
+            # only reused as stored, a repair would be a new paid call for a step that's "done"
+            try:
+                text = markdown(done.complete_output)
+                splits = parse(text)
+            except (KeyError, formats.ParsingError):
+                splits = None
+            if splits is not None:
+                print("STEP ALREADY DONE, REUSING: ", step, done.id)
+                yield text
+                yield StepResult(query=done, splits=splits)
+                return
+
+    interrupted = interrupted_query(db_session, step, obj, prompt)
+    if interrupted is not None:
+        interrupted.status = RESUMED
+        db_session.add(interrupted)
+        await save(db_session)
+    for attempt in range(MAX_RETRIES + 1):
+        # JSON can't go off format, the schema holds it to it
+        watching = stream_parser(parse) if structured is None else None
+        try:
+            async for chunk in executor(db_session, sys_prompt, prompt, author, obj, previous_messages,
+                                        use_cache=attempt == 0, route=route, step=step,
+                                        deadline=deadline, resume_from=interrupted if attempt == 0 else None,
+                                        stream_parser=watching,
+                                        response_format=structured.response_format() if structured is not None else None):
+                if isinstance(chunk, str):
+                    if structured is not None:
+                        continue
+                    yield chunk
+                    # the executor fed it the chunk before handing it over
+                    for section in watching.take() if watching is not None else []:
+                        yield section
+                elif chunk is None:
+                    continue
+                else:
+                    text = markdown(chunk.complete_output)
+                    if fixer is not None:
+                        text = await fixer(text, follow_up(chunk))
+                    if structured is not None:
+                        yield text
+                        watching = stream_parser(parse)
+                        if watching is not None:
+                            watching.feed(text)
+                    for section in watching.close() if watching is not None else []:
+                        yield section
+                    yield StepResult(query=chunk, splits=parse(text))
+                    return
+        except (KeyError, formats.ParsingError) as e:
+            print("ERROR PARSING, RETRYING: ", e)
+            if attempt >= MAX_RETRIES:
+                raise
+
+
+async def generate_story(story: Story, db_session: Session) -> AsyncGenerator[str | Story | StoryRead, None]:
     """
     Generate a new story, filling in the setting, main character, and summary fields of a model.
 
@@ -32,51 +218,40 @@ def generate_story(story: Story, db_session: Session, retry_count=0) -> Generato
         story.description, story.style, story.themes, story.request)
     story_prompt = prompt_generator.generate_story_base()
 
-    query_result_stream = query_executor(db_session, sys_prompt, story_prompt, story.author, story)
-
-    for chunk in query_result_stream:
-        if isinstance(chunk, str):
-            yield chunk
-        elif chunk is None:
-            continue
-        else:
-            query_result = chunk
-            try:
-                d = formats.parse_story_base(query_result.complete_output)
-                story.tags = d['tags']
-                story.setting = d['setting']
-                story.main_characters = d['main_characters']
-                story.summary = d['summary']
+    result = None
+    try:
+        async for chunk in run_step(db_session, "story_base", sys_prompt, story_prompt, story.author, story, formats.parse_story_base):
+            if isinstance(chunk, StepResult):
+                result = chunk
+            else:
+                yield chunk
+    except (KeyError, formats.ParsingError):
+        # retries exhausted, the story is left as is.
+        print("ERROR PARSING, GIVING UP")
+        return
 
+    if result is None:
+        return
 
-                if story.id is None:
-                    raise HTTPException(status_code=500, detail="Story must be saved before generating outline.")
-                outline = StoryOutline(story_id=story.id, author_id=story.author_id)
+    d = result.splits
+    story.tags = d['tags']
+    story.setting = d['setting']
+    story.main_characters = d['main_characters']
+    story.summary = d['summary']
 
 
-                count = db_session.query(StoryOutline).filter(StoryOutline.story_id == story.id).update({StoryOutline.invalidated:True})
-                print("invalidated : ", count)
-                story_outline = db_session.add(outline)
-                story.modified = False
-                db_session.add(story)
-                db_session.commit()
-                db_session.refresh(story)
+    if story.id is None:
+        raise HTTPException(status_code=500, detail="Story must be saved before generating outline.")
+    await save(db_session, story, change=lambda: generate_story_outline_stub(story, db_session))
 
 
-                # SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
-                # yield StoryRead.from_orm(story)
-                yield story
-                break
-            except (KeyError, formats.ParsingError):
-                print("ERROR PARSING, RETRYING")
-                # attempt query one more time, then escalate to an API failure
-                if retry_count < MAX_RETRIES:
-                    yield from generate_story(story, db_session, retry_count + 1)
-                    break
+    # SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
+    # yield StoryRead.from_orm(story)
+    yield story
 
 
 
-def generate_story_outline(story_outline: StoryOutline, db_session: Session) -> Generator[str | MidPoint | StoryOutline | StoryOutlineRead, None, None]:
+async def generate_story_outline(story_outline: StoryOutline, db_session: Session) -> AsyncGenerator[str | MidPoint | StoryOutline | StoryOutlineRead, None]:
     """
     Algorithm:
 
@@ -92,139 +267,64 @@ def generate_story_outline(story_outline: StoryOutline, db_session: Session) ->
     # Step 1: Generate one-sentence outline
     prompt_1 = prompt_generator.generate_story_outline_step_1()
 
-    query_result_1 = None
-    splits = None
-
-    try:
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, story_outline)
-
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                _test = formats.parse_story_outline_simple(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, story_outline)
-
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                _test = formats.parse_story_outline_simple(splits['outline'])
-                break
+    result_1 = None
+    async for chunk in run_step(db_session, "story_outline_1", sys_prompt, prompt_1, story.author, story_outline,
+                                sections_parser('outline', formats.parse_story_outline_simple)):
+        if isinstance(chunk, StepResult):
+            result_1 = chunk
+        else:
+            yield chunk
 
-    if query_result_1 is None or splits is None:
+    if result_1 is None:
         raise error.OrchestrationError("Orchestration failure at generate story outline step 1")
     # Get the outline and yield it and save it.
-    story_outline.outline_onesentence = splits['outline']
-    db_session.commit()
-    db_session.refresh(story_outline)
+    story_outline.outline_onesentence = result_1.splits['outline']
+    await save(db_session, story_outline)
 
     yield MidPoint(step=1, step_name="Generating Improved Outline")
 
     # Step 2: Generate main events outline
     prompt_2 = prompt_generator.generate_story_outline_step_2()
 
-    query_result_2 = None
-    splits = None
-    try:
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, story_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_story_outline_medium(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, story_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_story_outline_medium(splits['outline'])
-                break
+    result_2 = None
+    async for chunk in run_step(db_session, "story_outline_2", sys_prompt, prompt_2, story.author, story_outline,
+                                sections_parser('outline', formats.parse_story_outline_medium),
+                                result_1.query.all_messages):
+        if isinstance(chunk, StepResult):
+            result_2 = chunk
+        else:
+            yield chunk
 
-    if query_result_2 is None or splits is None:
+    if result_2 is None:
         raise error.OrchestrationError("Orchestration failure at generate story outline step 2")
-    story_outline.outline_mainevents_raw = splits['outline']
+    story_outline.outline_mainevents_raw = result_2.splits['outline']
 
-    db_session.commit()
-    db_session.refresh(story_outline)
+    await save(db_session, story_outline)
 
     yield MidPoint(step=2, step_name="Generating Expanded Outline")
 
     # Step 3: Edit and improve the outline
     prompt_3 = prompt_generator.generate_story_outline_step_3(story_outline.outline_mainevents_raw, SKIP_STEP_4)
 
-    query_result_3 = None
-    splits = None
-
-    try:
-        query_result_stream_3 = query_executor(db_session,
-            sys_prompt, prompt_3, story.author, story_outline)
-
-        for chunk in query_result_stream_3:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_3 = chunk
-                splits = formats.split_sections(query_result_3.complete_output)
-                _test = formats.parse_story_outline_medium(splits['outline'])
-                break
-
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_3 = query_executor(db_session,
-            sys_prompt, prompt_3, story.author, story_outline)
-
-        for chunk in query_result_stream_3:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_3 = chunk
-                splits = formats.split_sections(query_result_3.complete_output)
-                _test = formats.parse_story_outline_medium(splits['outline'])
-                break
+    result_3 = None
+    async for chunk in run_step(db_session, "story_outline_3", sys_prompt, prompt_3, story.author, story_outline,
+                                sections_parser('outline', formats.parse_story_outline_medium, 'editing_notes')):
+        if isinstance(chunk, StepResult):
+            result_3 = chunk
+        else:
+            yield chunk
 
-    if query_result_3 is None or splits is None:
+    if result_3 is None:
         raise error.OrchestrationError("Orchestration failure at generate story outline step 3")
 
-    story_outline.editing_notes = splits['editing_notes']
-    story_outline.outline_mainevents_improved = splits['outline']
+    story_outline.editing_notes = result_3.splits['editing_notes']
+    story_outline.outline_mainevents_improved = result_3.splits['outline']
 
 
     if SKIP_STEP_4:
         story_outline.outline_paragraphs = story_outline.outline_mainevents_improved
 
-    db_session.commit()
-    db_session.refresh(story_outline)
+    await save(db_session, story_outline)
 
 
 
@@ -234,79 +334,31 @@ def generate_story_outline(story_outline: StoryOutline, db_session: Session) ->
         # Step 4: Expand the outline with paragraph summary and notes
         prompt_4 = prompt_generator.generate_story_outline_step_4(story_outline.outline_mainevents_improved)
 
+        result_4 = None
+        async for chunk in run_step(db_session, "story_outline_4", sys_prompt, prompt_4, story.author, story_outline,
+                                    sections_parser('outline', formats.parse_story_outline_complex)):
+            if isinstance(chunk, StepResult):
+                result_4 = chunk
+            else:
+                yield chunk
 
-        query_result_4 = None
-        splits = None
-
-        try:
-            query_result_stream_4 = query_executor(db_session,
-                sys_prompt, prompt_4, story.author, story_outline)
-
-            for chunk in query_result_stream_4:
-                if isinstance(chunk, str):
-                    yield chunk
-                elif chunk is None:
-                    continue
-                else:
-                    query_result_4 = chunk
-                    splits = formats.split_sections(query_result_4.complete_output)
-                    _test = formats.parse_story_outline_complex(splits['outline'])
-                    break
-
-        except (KeyError, formats.ParsingError):
-            print("ERROR PARSING, RETRYING")
-            # attempt query one more time, then escalate to an API failure
-            query_result_stream_4 = query_executor(db_session,
-                sys_prompt, prompt_4, story.author, story_outline)
-
-            for chunk in query_result_stream_4:
-                if isinstance(chunk, str):
-                    yield chunk
-                elif chunk is None:
-                    continue
-                else:
-                    query_result_4 = chunk
-                    splits = formats.split_sections(query_result_4.complete_output)
-                    _test = formats.parse_story_outline_complex(splits['outline'])
-                    break
-
-        if query_result_4 is None or splits is None:
+        if result_4 is None:
             raise error.OrchestrationError("Orchestration failure at generate story outline step 4")
 
 
-        story_outline.outline_paragraphs = splits['outline']
-        db_session.commit()
+        story_outline.outline_paragraphs = result_4.splits['outline']
+        await save(db_session)
 
 
     # Finally: Generate chapter stubs
-    previous_chapter = None
-    count = db_session.query(ChapterOutline).filter(ChapterOutline.story_outline_id == story_outline.id).update({ChapterOutline.invalidated:True})
-    print("invalidated : ", count)
-    for chapter in story_outline.outline_paragraphs_parsed:
-        print("SAVING CHAPTER", chapter['chapter_number'])
-        chapter_outline = ChapterOutline(story_outline_id=cast(int, story_outline.id),
-                                         author_id=story_outline.author_id,
-                                         previous_chapter_id=previous_chapter.id if previous_chapter else None,
-                                         part_label=chapter['part_label'],
-                                         chapter_notes=chapter['notes'],
-                                         chapter_number=int(chapter['chapter_number']),
-                                         title=chapter['title'],
-                                         purpose=chapter['chapter_purpose'],
-                                         main_events=chapter['main_events'],
-                                         chapter_summary=chapter['chapter_summary'])
-        previous_chapter = chapter_outline
-        db_session.add(chapter_outline)
-    story_outline.story.modified = False
-    db_session.add(story_outline.story)
-    db_session.commit()
-    db_session.refresh(story_outline)
+    await save(db_session, story_outline, change=lambda: generate_chapter_stubs(story_outline, db_session))
 
     # SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
     # yield StoryOutlineRead.from_orm(story_outline)
     yield story_outline
 
 
-def generate_chapter_outline(chapter_outline: ChapterOutline, db_session: Session) -> Generator[str | MidPoint | ChapterOutline | ChapterOutlineRead, None, None]:
+async def generate_chapter_outline(chapter_outline: ChapterOutline, db_session: Session) -> AsyncGenerator[str | MidPoint | ChapterOutline | ChapterOutlineRead, None]:
 
     yield MidPoint(step=1, step_name="Creating Outline")
     story_outline = chapter_outline.story_outline
@@ -332,44 +384,20 @@ def generate_chapter_outline(chapter_outline: ChapterOutline, db_session: Sessio
         chapter_outline.main_events,
         chapter_outline.chapter_notes)
 
-    query_result_1 = None
-    splits = None
-
-    try:
-        query_result_stream_1= query_executor(db_session, sys_prompt, prompt_1, story.author, chapter_outline)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                print(splits)
-                _test = formats.parse_chapter_outline(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, chapter_outline)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                _test = formats.parse_chapter_outline(splits['outline'])
-                break
+    result_1 = None
+    async for chunk in run_step(db_session, "chapter_outline_1", sys_prompt, prompt_1, story.author, chapter_outline,
+                                sections_parser('outline', formats.parse_chapter_outline)):
+        if isinstance(chunk, StepResult):
+            result_1 = chunk
+        else:
+            yield chunk
 
-    if query_result_1 is None or splits is None:
-        print("Error source: ", query_result_1, splits)
+    if result_1 is None:
+        print("Error source: ", result_1)
         raise error.OrchestrationError("Orchestration failure at generate chapter outline step 1")
     # Get the outline and yield it and save it.
-    chapter_outline.raw = splits['outline']
-    db_session.commit()
-    db_session.refresh(chapter_outline)
+    chapter_outline.raw = result_1.splits['outline']
+    await save(db_session, chapter_outline)
 
     yield MidPoint(step=2, step_name="Editing Outline")
 
@@ -382,64 +410,24 @@ def generate_chapter_outline(chapter_outline: ChapterOutline, db_session: Sessio
                                     chapter_outline.main_events,
                                     chapter_outline.chapter_notes)
 
-    query_result_2 = None
-    splits = None
-    try:
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, chapter_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_chapter_outline(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, chapter_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_chapter_outline(splits['outline'])
-                break
+    result_2 = None
+    async for chunk in run_step(db_session, "chapter_outline_2", sys_prompt, prompt_2, story.author, chapter_outline,
+                                sections_parser('outline', formats.parse_chapter_outline, 'editing_notes'),
+                                result_1.query.all_messages):
+        if isinstance(chunk, StepResult):
+            result_2 = chunk
+        else:
+            yield chunk
 
-    if query_result_2 is None or splits is None:
-        print("Error source: ", query_result_2, splits)
+    if result_2 is None:
+        print("Error source: ", result_2)
         raise error.OrchestrationError("Orchestration failure at generate chapter outline step 2")
-    chapter_outline.edit_notes = splits['editing_notes']
-    chapter_outline.improved = splits['outline']
-    db_session.commit()
-    db_session.refresh(chapter_outline)
+    chapter_outline.edit_notes = result_2.splits['editing_notes']
+    chapter_outline.improved = result_2.splits['outline']
+    await save(db_session, chapter_outline)
 
     # Step Z: Generate scene stubs
-    count = db_session.query(SceneOutline).filter(SceneOutline.chapter_outline_id == chapter_outline.id).update({SceneOutline.invalidated:True})
-    print("invalidated : ", count)
-    previous_scene: SceneOutline | None = None
-    for scene in chapter_outline.improved_parsed:
-        scene_outline = SceneOutline(chapter_outline_id=cast(int, chapter_outline.id),
-                                     author_id=chapter_outline.author_id,
-                                     previous_scene_id=previous_scene.id if previous_scene else None,
-                                     scene_number=int(scene['scene_number']),
-                                     setting=scene['setting'],
-                                     primary_function=scene['primary_function'],
-                                     secondary_function=scene['secondary_function'],
-                                     summary=scene['summary'],
-                                     context=scene['context'])
-        previous_scene = scene_outline
-        db_session.add(scene_outline)
-    chapter_outline.modified = False
-    db_session.commit()
-    db_session.refresh(chapter_outline)
+    await save(db_session, chapter_outline, change=lambda: generate_scene_outline_stubs(chapter_outline, db_session))
     # db_session.refresh(chapter_outline.story_outline)
 
     # SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
@@ -447,7 +435,7 @@ def generate_chapter_outline(chapter_outline: ChapterOutline, db_session: Sessio
     yield chapter_outline
 
 
-def generate_scene_outline(scene_outline: SceneOutline, db_session: Session) -> Generator[str | MidPoint | SceneOutline | SceneOutlineRead, None, None]:
+async def generate_scene_outline(scene_outline: SceneOutline, db_session: Session) -> AsyncGenerator[str | MidPoint | SceneOutline | SceneOutlineRead, None]:
 
     yield MidPoint(step=1, step_name="Creating Outline")
     chapter_outline = scene_outline.chapter_outline
@@ -483,43 +471,21 @@ def generate_scene_outline(scene_outline: SceneOutline, db_session: Session) ->
                                                               previous_scene_outline.improved if previous_scene_outline else None,
                                                               chapter_outline.previous_chapter.improved if chapter_outline.previous_chapter else None)
 
-    query_result_1 = None
-    splits = None
-    try:
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, scene_outline)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                print(splits)
-                _test = formats.parse_scene_outline(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, scene_outline)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                _test = formats.parse_scene_outline(splits['outline'])
-                break
-    if query_result_1 is None or splits is None:
-        print("Error source: ", query_result_1, splits)
+    result_1 = None
+    async for chunk in run_step(db_session, "scene_outline_1", sys_prompt, prompt_1, story.author, scene_outline,
+                                sections_parser('outline', formats.parse_scene_outline)):
+        if isinstance(chunk, StepResult):
+            result_1 = chunk
+        else:
+            yield chunk
+
+    if result_1 is None:
+        print("Error source: ", result_1)
         raise error.OrchestrationError("Orchestration failure at generate scene outline step 1")
 
     # Get the outline and yield it and save it.
-    scene_outline.raw = splits['outline']
-    db_session.commit()
-    db_session.refresh(scene_outline)
+    scene_outline.raw = result_1.splits['outline']
+    await save(db_session, scene_outline)
 
     yield MidPoint(step=2, step_name="Editing Outline")
 
@@ -532,52 +498,79 @@ def generate_scene_outline(scene_outline: SceneOutline, db_session: Session) ->
                                                               scene_outline.summary,
                                                               scene_outline.context)
 
-    query_result_2 = None
-    splits = None
-    try:
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, chapter_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_scene_outline(splits['outline'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_2 = query_executor(db_session,
-            sys_prompt, prompt_2, story.author, chapter_outline, query_result_1.all_messages)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_scene_outline(splits['outline'])
-                break
+    result_2 = None
+    async for chunk in run_step(db_session, "scene_outline_2", sys_prompt, prompt_2, story.author, chapter_outline,
+                                sections_parser('outline', formats.parse_scene_outline, 'editing_notes'),
+                                result_1.query.all_messages):
+        if isinstance(chunk, StepResult):
+            result_2 = chunk
+        else:
+            yield chunk
 
-    if query_result_2 is None or splits is None:
-        print("Error source: ", query_result_2, splits)
+    if result_2 is None:
+        print("Error source: ", result_2)
         raise error.OrchestrationError("Orchestration failure at generate chapter outline step 2")
 
-    scene_outline.edit_notes = splits['editing_notes']
-    scene_outline.improved = splits['outline']
+    scene_outline.edit_notes = result_2.splits['editing_notes']
+    scene_outline.improved = result_2.splits['outline']
     scene_outline.modified = False
-    db_session.commit()
-    db_session.refresh(scene_outline)
+    await save(db_session, scene_outline)
 
     # SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
     # yield SceneOutlineRead.from_orm(scene_outline)
     yield scene_outline
 
-    generate_scene_stub(story, scene_outline, db_session)
+    await save(db_session, change=lambda: generate_scene_stub(story, scene_outline, db_session))
+
+
+def generate_story_outline_stub(story: Story, db_session: Session):
+    outline = StoryOutline(story_id=cast(int, story.id), author_id=story.author_id)
+    count = db_session.query(StoryOutline).filter(StoryOutline.story_id == story.id).update({StoryOutline.invalidated:True})
+    print("invalidated : ", count)
+    db_session.add(outline)
+    story.modified = False
+    db_session.add(story)
+
+
+def generate_chapter_stubs(story_outline: StoryOutline, db_session: Session):
+    previous_chapter = None
+    count = db_session.query(ChapterOutline).filter(ChapterOutline.story_outline_id == story_outline.id).update({ChapterOutline.invalidated:True})
+    print("invalidated : ", count)
+    for chapter in story_outline.outline_paragraphs_parsed:
+        print("SAVING CHAPTER", chapter['chapter_number'])
+        chapter_outline = ChapterOutline(story_outline_id=cast(int, story_outline.id),
+                                         author_id=story_outline.author_id,
+                                         previous_chapter_id=previous_chapter.id if previous_chapter else None,
+                                         part_label=chapter['part_label'],
+                                         chapter_notes=chapter['notes'],
+                                         chapter_number=int(chapter['chapter_number']),
+                                         title=chapter['title'],
+                                         purpose=chapter['chapter_purpose'],
+                                         main_events=chapter['main_events'],
+                                         chapter_summary=chapter['chapter_summary'])
+        previous_chapter = chapter_outline
+        db_session.add(chapter_outline)
+    story_outline.story.modified = False
+    db_session.add(story_outline.story)
+
+
+def generate_scene_outline_stubs(chapter_outline: ChapterOutline, db_session: Session):
+    count = db_session.query(SceneOutline).filter(SceneOutline.chapter_outline_id == chapter_outline.id).update({SceneOutline.invalidated:True})
+    print("invalidated : ", count)
+    previous_scene: SceneOutline | None = None
+    for scene in chapter_outline.improved_parsed:
+        scene_outline = SceneOutline(chapter_outline_id=cast(int, chapter_outline.id),
+                                     author_id=chapter_outline.author_id,
+                                     previous_scene_id=previous_scene.id if previous_scene else None,
+                                     scene_number=int(scene['scene_number']),
+                                     setting=scene['setting'],
+                                     primary_function=scene['primary_function'],
+                                     secondary_function=scene['secondary_function'],
+                                     summary=scene['summary'],
+                                     context=scene['context'])
+        previous_scene = scene_outline
+        db_session.add(scene_outline)
+    chapter_outline.modified = False
 
 
 def generate_scene_stub(story:Story, scene_outline: SceneOutline, db_session: Session):
@@ -598,7 +591,7 @@ def generate_scene_stub(story:Story, scene_outline: SceneOutline, db_session: Se
     return scene_outline
 
 
-def generate_scene_text(scene: Scene, db_session: Session) -> Generator[str | MidPoint | Scene | SceneRead, None, None]:
+async def generate_scene_text(scene: Scene, db_session: Session) -> AsyncGenerator[str | MidPoint | Scene | SceneRead, None]:
 
     yield MidPoint(step=1, step_name="Creating Scene")
 
@@ -648,43 +641,21 @@ def generate_scene_text(scene: Scene, db_session: Session) -> Generator[str | Mi
                                                            previous_chapter_outline=previous_chapter_outline.improved if previous_chapter_outline else None,
                                                            previous_text=previous_text if previous_text else None)
 
-    query_result_1 = None
-    splits = None
-    try:
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, scene)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                print(splits)
-                _test = formats.parse_scene_text(splits['scene'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_1 = query_executor(db_session, sys_prompt, prompt_1, story.author, scene)
-        for chunk in query_result_stream_1:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_1 = chunk
-                splits = formats.split_sections(query_result_1.complete_output)
-                _test = formats.parse_scene_text(splits['scene'])
-                break
-    if query_result_1 is None or splits is None:
-        print("Error source: ", query_result_1, splits)
+    result_1 = None
+    async for chunk in run_step(db_session, "scene_text_1", sys_prompt, prompt_1, story.author, scene,
+                                sections_parser('scene', formats.parse_scene_text)):
+        if isinstance(chunk, StepResult):
+            result_1 = chunk
+        else:
+            yield chunk
+
+    if result_1 is None:
+        print("Error source: ", result_1)
         raise error.OrchestrationError("Orchestration failure at generate scene step 1")
 
     # Get the outline and yield it and save it.
-    scene.raw = splits['scene']
-    db_session.commit()
-    db_session.refresh(scene)
+    scene.raw = result_1.splits['scene']
+    await save(db_session, scene)
 
     yield MidPoint(step=2, step_name="Editing Scene")
 
@@ -699,46 +670,194 @@ def generate_scene_text(scene: Scene, db_session: Session) -> Generator[str | Mi
                                                            scene.raw)
 
 
-    query_result_2 = None
-    splits = None
-    try:
-        query_result_stream_2 = query_executor(db_session, sys_prompt, prompt_2, story.author, scene)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                print(splits)
-                _test = formats.parse_scene_text(splits['scene'])
-                break
-    except (KeyError, formats.ParsingError):
-        print("ERROR PARSING, RETRYING")
-        # attempt query one more time, then escalate to an API failure
-        query_result_stream_2 = query_executor(db_session, sys_prompt, prompt_2, story.author, scene)
-        for chunk in query_result_stream_2:
-            if isinstance(chunk, str):
-                yield chunk
-            elif chunk is None:
-                continue
-            else:
-                query_result_2 = chunk
-                splits = formats.split_sections(query_result_2.complete_output)
-                _test = formats.parse_scene_text(splits['scene'])
-                break
-    if query_result_2 is None or splits is None:
-        print("Error source: ", query_result_2, splits)
+    result_2 = None
+    async for chunk in run_step(db_session, "scene_text_2", sys_prompt, prompt_2, story.author, scene,
+                                sections_parser('scene', formats.parse_scene_text, 'editing_notes')):
+        if isinstance(chunk, StepResult):
+            result_2 = chunk
+        else:
+            yield chunk
+
+    if result_2 is None:
+        print("Error source: ", result_2)
         raise error.OrchestrationError("Orchestration failure at generate scene step 1")
 
-    scene.edit_notes = splits['editing_notes']
-    scene.improved = splits['scene']
+    scene.edit_notes = result_2.splits['editing_notes']
+    scene.improved = result_2.splits['scene']
     scene.final_text = scene.improved_text
     scene.modified = False
-    db_session.commit()
-    db_session.refresh(scene)
+    await save(db_session, scene)
 
     #SQLAlchemy HATES this and we can just refresh from the frontend, still: TODO
     # yield SceneRead.from_orm(scene)
     yield scene
+
+
+async def save(db_session: Session, *objs: Any, change: Callable[[], Any] | None = None) -> None:
+    """
+    Make change, commit and refresh objs, in the threadpool so the event loop carries on
+    streaming meanwhile.
+
+    Changes that query (bulk updates, lazy loads) go in change rather than before the call,
+    so no transaction is left open on the loop. Saves are one at a time: SQLite has one
+    writer, and two sessions in the middle of a write fail each other rather than wait.
+    """
+    def commit():
+        with writing:
+            if change is not None:
+                change()
+            db_session.commit()
+            for obj in objs:
+                db_session.refresh(obj)
+    await run_in_threadpool(commit)
+
+
+async def drain(gen: AsyncGenerator) -> None:
+    async for _ in gen:
+        pass
+
+
+def current(objs: list, order: Callable[[Any], Any]) -> list:
+    return sorted((obj for obj in objs if not obj.invalidated), key=order)
+
+
+def node_object(session: Session, model: type, obj_id: int) -> Any:
+    obj = session.get(model, obj_id)
+    if obj is None:
+        raise error.OrchestrationError(f"{model.__name__} {obj_id} no longer exists")
+    return obj
+
+
+def step_weight(steps: list[str], author: User) -> float:
+    """How long steps usually take to run, by how much they usually write."""
+    return sum(typical_output(step, resolve_route(step, author).model) or DEFAULT_STEP_TOKENS for step in steps)
+
+
+def scene_nodes(story: Story, chapter_outline: ChapterOutline, previous_chapter: ChapterOutline | None) -> list[scheduler.Node]:
+    """
+    The outline and text of each of a chapter's scenes, as scheduler nodes.
+
+    A scene outline is written from the chapter outline, the previous chapter's and the
+    previous scene's outline. A scene's text from its outline, the previous scene's text and
+    the previous chapter's outline. Steps already done are added as done.
+
+    Each node runs on a session of its own, re-loading its scene outline by id, since the
+    scheduler runs several of them at once.
+    """
+    outline_weight = step_weight(["scene_outline_1", "scene_outline_2"], story.author)
+    text_weight = step_weight(["scene_text_1", "scene_text_2"], story.author)
+    chapter_deps = {("chapter", chapter_outline.id)}
+    if previous_chapter is not None:
+        chapter_deps.add(("chapter", previous_chapter.id))
+
+    def outline(scene_outline_id: int) -> Callable[[], Awaitable[list[scheduler.Node]]]:
+        async def run() -> list[scheduler.Node]:
+            with Session(engine) as db_session:
+                scene_outline = node_object(db_session, SceneOutline, scene_outline_id)
+                await drain(generate_scene_outline(scene_outline, db_session))
+            return []
+        return run
+
+    def text(scene_outline_id: int) -> Callable[[], Awaitable[list[scheduler.Node]]]:
+        async def run() -> list[scheduler.Node]:
+            with Session(engine) as db_session:
+                scene_outline = node_object(db_session, SceneOutline, scene_outline_id)
+                scenes = current(scene_outline.scenes, lambda x: x.id)
+                if not scenes:
+                    await save(db_session, change=lambda: generate_scene_stub(story, scene_outline, db_session))
+                    await run_in_threadpool(db_session.refresh, scene_outline)
+                    scenes = current(scene_outline.scenes, lambda x: x.id)
+                await drain(generate_scene_text(scenes[-1], db_session))
+            return []
+        return run
+
+    nodes = []
+    previous: SceneOutline | None = None
+    for scene_outline in current(chapter_outline.scene_outlines, lambda x: x.scene_number):
+        scenes = current(scene_outline.scenes, lambda x: x.id)
+        outline_deps = set(chapter_deps)
+        text_deps = {("scene_outline", scene_outline.id)} | chapter_deps
+        if previous is not None:
+            outline_deps.add(("scene_outline", previous.id))
+            text_deps.add(("scene", previous.id))
+        nodes.append(scheduler.Node(key=("scene_outline", scene_outline.id), run=outline(cast(int, scene_outline.id)),
+                                    deps=outline_deps, weight=outline_weight,
+                                    status=scheduler.DONE if scene_outline.improved is not None else scheduler.PENDING))
+        nodes.append(scheduler.Node(key=("scene", scene_outline.id), run=text(cast(int, scene_outline.id)),
+                                    deps=text_deps, weight=text_weight,
+                                    status=scheduler.DONE if scenes and scenes[-1].final_text is not None else scheduler.PENDING))
+        previous = scene_outline
+    return nodes
+
+
+def book_nodes(story: Story, story_outline: StoryOutline) -> list[scheduler.Node]:
+    """
+    Every chapter outline, scene outline and scene text step of a book, as scheduler nodes.
+
+    Chapter outlines only need the story outline. The scenes of a chapter whose outline isn't
+    written yet don't exist, its node adds them when it's done and until then is prioritised
+    as if it had as many scenes as the chapters that have them.
+    """
+    chapters = current(story_outline.chapter_outlines, lambda x: x.chapter_number)
+    outline_weight = step_weight(["scene_outline_1", "scene_outline_2"], story.author)
+    text_weight = step_weight(["scene_text_1", "scene_text_2"], story.author)
+    known = [len(current(chapter.scene_outlines, lambda x: x.id)) for chapter in chapters if chapter.improved is not None]
+    scene_count = round(sum(known) / len(known)) if known else DEFAULT_SCENE_COUNT
+    # the longer of the two chains through a chapter's scenes, outlines then the last text or
+    # the first outline then every text
+    estimate = max(scene_count * outline_weight + text_weight, outline_weight + scene_count * text_weight)
+
+    def chapter_outline(chapter_id: int, previous: ChapterOutline | None) -> Callable[[], Awaitable[list[scheduler.Node]]]:
+        async def run() -> list[scheduler.Node]:
+            with Session(engine) as db_session:
+                chapter = node_object(db_session, ChapterOutline, chapter_id)
+                await drain(generate_chapter_outline(chapter, db_session))
+                await run_in_threadpool(db_session.refresh, chapter)
+                return scene_nodes(story, chapter, previous)
+        return run
+
+    nodes = []
+    previous: ChapterOutline | None = None
+    for chapter in chapters:
+        done = chapter.improved is not None
+        nodes.append(scheduler.Node(key=("chapter", chapter.id), run=chapter_outline(cast(int, chapter.id), previous),
+                                    weight=step_weight(["chapter_outline_1", "chapter_outline_2"], story.author),
+                                    estimate=estimate, status=scheduler.DONE if done else scheduler.PENDING))
+        if done:
+            nodes.extend(scene_nodes(story, chapter, previous))
+        previous = chapter
+    return nodes
+
+
+async def generate_book(story: Story, db_session: Session) -> Story:
+    """
+    Run every step the story still needs, from the story base to the last scene's text.
+
+    Once the story outline exists, the rest goes through a scheduler (see scheduler.py): each
+    step runs as soon as the steps it reads from are done, BOOK_CONCURRENCY at a time, the
+    longest remaining chain first. A step that fails is logged, the steps that read from it
+    are skipped and the others carry on. Run under a batch collector, each round of ready
+    steps is one batch.
+    """
+    if story.summary is None:
+        [failure] = await batch.gather(drain(generate_story(story, db_session)))
+        await run_in_threadpool(db_session.refresh, story)
+        if failure is not None or story.summary is None:
+            raise error.OrchestrationError(f"Could not generate the story base: {failure}")
+
+    outlines = current(story.story_outlines, lambda x: x.id)
+    if not outlines:
+        raise error.OrchestrationError("Story has no outline to generate.")
+    story_outline = outlines[-1]
+    if story_outline.outline_paragraphs is None:
+        [failure] = await batch.gather(drain(generate_story_outline(story_outline, db_session)))
+        if failure is not None:
+            raise failure
+        await run_in_threadpool(db_session.refresh, story_outline)
+
+    book = scheduler.Scheduler(conf.BOOK_CONCURRENCY)
+    for node in book_nodes(story, story_outline):
+        book.add(node)
+    print("BOOK STEPS: ", book.counts())
+    print("BOOK DONE: ", await book.run())
+    return story
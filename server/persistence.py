@@ -0,0 +1,249 @@
+import asyncio
+import itertools
+import queue
+import threading
+import time
+from dataclasses import dataclass
+from typing import Any, Optional, Type, cast
+from sqlmodel import Session
+from fastapi.concurrency import run_in_threadpool
+from .models import Query, ApiCall
+from .database import engine
+from .config import get_settings
+
+"""
+Write-behind logging for Query and ApiCall rows.
+
+Logging a generation used to mean a commit before the stream started, one per API call and
+one at the end, each taking SQLite's write lock while other users were streaming. Instead,
+the executor snapshots rows into a bounded queue and a single writer thread applies them in
+grouped transactions.
+
+Rows don't have database ids until the writer inserts them, so callers refer to them by a
+local key handed out by an itertools counter (atomic under the GIL, no lock needed), and
+await row_id(key) for the real id. The writer keeps the ORM row for each key until its final
+update and resolves a child's foreign key from its parent's row when it writes the child.
+
+A batch that fails is retried with the next one, so a busy database only delays the log.
+After FLUSH_ATTEMPTS failures its ops are written one by one and any that still fail are
+logged and dropped, rather than holding up everything queued behind them. A row whose insert
+was dropped takes its later updates and its children with it, rather than have them written
+as orphans, and row_id(key) gives None.
+"""
+
+conf = get_settings()
+
+# tries at writing a batch before giving up on the ops in it that won't go
+FLUSH_ATTEMPTS = 5
+
+LoggedModel = Query | ApiCall
+
+
+@dataclass
+class LogOp:
+    kind: str  # "insert" or "update"
+    key: int
+    model: Type[LoggedModel]
+    values: dict[str, Any]
+    parent: Optional[int] = None
+    # last update for this key, the writer can forget about the row afterwards
+    final: bool = False
+
+
+_STOP = object()
+
+
+def snapshot(obj: LoggedModel) -> dict[str, Any]:
+    """Copy the column values of a row, so the writer never touches an object another thread owns."""
+    return {column.key: getattr(obj, column.key) for column in type(obj).__table__.columns if column.key != "id"}  # type: ignore
+
+
+class QueryLog():
+    def __init__(self, max_queue: int, batch_size: int, flush_interval: float):
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: queue.Queue = queue.Queue(maxsize=max_queue)
+        self._keys = itertools.count(1)
+        self._thread: Optional[threading.Thread] = None
+        self._start_lock = threading.Lock()
+        # key -> row, only ever touched by the writer thread
+        self._rows: dict[int, LoggedModel] = {}
+        # key -> the id of its row once it's written, until its final update
+        self._ids: dict[int, tuple[asyncio.AbstractEventLoop, asyncio.Future]] = {}
+        # a failed batch, written ahead of the next one
+        self._retry: list[LogOp] = []
+        # keys whose insert was dropped, until their final update
+        self._dropped: set[int] = set()
+        self._attempts = 0
+        self._session: Optional[Session] = None
+
+    def start(self):
+        with self._start_lock:
+            if self._thread is not None and self._thread.is_alive():
+                return
+            self._thread = threading.Thread(target=self._run, name="query-log-writer", daemon=True)
+            self._thread.start()
+
+    def stop(self, timeout: float = 30):
+        """Flush everything queued so far and stop the writer."""
+        if self._thread is None:
+            return
+        self._queue.put(_STOP)
+        self._thread.join(timeout)
+        self._thread = None
+
+    async def _submit(self, op: LogOp):
+        self.start()
+        try:
+            self._queue.put_nowait(op)
+        except queue.Full:
+            # the writer is badly behind. wait for room off the event loop rather than drop the log.
+            print("WARNING: QUERY LOG QUEUE FULL, WAITING")
+            await run_in_threadpool(self._queue.put, op)
+
+    async def insert(self, obj: LoggedModel, parent: Optional[int] = None, final: bool = False) -> int:
+        """Queue an insert, returning the local key to refer to the row by."""
+        key = next(self._keys)
+        loop = asyncio.get_running_loop()
+        self._ids[key] = (loop, loop.create_future())
+        await self._submit(LogOp("insert", key, type(obj), snapshot(obj), parent=parent, final=final))
+        return key
+
+    async def row_id(self, key: int) -> Optional[int]:
+        """The database id of the row inserted as key, once it's written. None if it couldn't be. Call before its final update."""
+        return await self._ids[key][1]
+
+    async def update(self, key: int, obj: LoggedModel, final: bool = False):
+        """Queue an update of a previously inserted row to the current values of obj."""
+        await self._submit(LogOp("update", key, type(obj), snapshot(obj), final=final))
+
+    def _run(self):
+        self._session = Session(engine, expire_on_commit=False)
+        stopping = False
+        while not stopping:
+            batch: list[LogOp] = []
+            try:
+                op = self._queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                if self._retry:
+                    self._flush(self._retry)
+                continue
+            deadline = time.monotonic() + self.flush_interval
+            while True:
+                if op is _STOP:
+                    stopping = True
+                    break
+                batch.append(op)
+                if len(batch) >= self.batch_size:
+                    break
+                try:
+                    op = self._queue.get(timeout=max(0.0, deadline - time.monotonic()))
+                except queue.Empty:
+                    break
+            if batch or self._retry:
+                self._flush(self._retry + batch)
+        if self._retry:
+            self._flush(self._retry, last=True)
+        self._session.close()
+
+    def _orphaned(self, op: LogOp) -> bool:
+        return op.key in self._dropped or op.parent in self._dropped
+
+    def _drop(self, op: LogOp):
+        print("DROPPING QUERY LOG OP: ", op.kind, op.model.__name__, op.key)
+        self._written([op], failed=True)
+
+    def _flush(self, batch: list[LogOp], last: bool = False):
+        assert self._session is not None
+        self._retry = []
+        orphaned = [self._orphaned(op) for op in batch]
+        for op in itertools.compress(batch, orphaned):
+            self._drop(op)
+        batch = [op for op, orphan in zip(batch, orphaned) if not orphan]
+        if not batch:
+            return
+        if self._write(batch):
+            self._attempts = 0
+            self._written(batch)
+            return
+        self._attempts += 1
+        if self._attempts < FLUSH_ATTEMPTS and not last:
+            # most likely a busy database, carry the batch over to the next flush.
+            print("RETRYING QUERY LOG BATCH OF ", len(batch), "ATTEMPT", self._attempts)
+            self._retry = batch
+            time.sleep(self.flush_interval)
+            return
+        self._attempts = 0
+        for op in batch:
+            if not self._orphaned(op) and self._write([op]):
+                self._written([op])
+            else:
+                self._drop(op)
+
+    def _write(self, batch: list[LogOp]) -> bool:
+        session = cast(Session, self._session)
+        try:
+            for op in batch:
+                self._apply(session, op)
+            session.commit()
+            return True
+        except Exception as e:
+            print("ERROR WRITING QUERY LOG: ", e)
+            session.rollback()
+            # rows inserted by the failed transaction are new again
+            for op in batch:
+                if op.kind == "insert" and op.key in self._rows and self._rows[op.key] not in session:
+                    self._rows[op.key].id = None
+            return False
+
+    def _written(self, batch: list[LogOp], failed: bool = False):
+        session = cast(Session, self._session)
+        for op in batch:
+            if op.kind == "insert" and op.key in self._ids:
+                loop, future = self._ids[op.key]
+                self._resolve(loop, future, None if failed or op.key in self._dropped else self._rows[op.key].id)
+            if failed and op.kind == "insert":
+                # its row never made it, updates would insert it afresh and children have no parent
+                self._dropped.add(op.key)
+                self._rows.pop(op.key, None)
+            if op.final:
+                self._ids.pop(op.key, None)
+                self._dropped.discard(op.key)
+                row = self._rows.pop(op.key, None)
+                if row is not None and row in session:
+                    session.expunge(row)
+
+    @staticmethod
+    def _resolve(loop: asyncio.AbstractEventLoop, future: asyncio.Future, row_id: Optional[int]):
+        def set_id():
+            if not future.done():
+                future.set_result(row_id)
+        try:
+            loop.call_soon_threadsafe(set_id)
+        except RuntimeError:
+            # the loop waiting on it is gone
+            pass
+
+    def _apply(self, session: Session, op: LogOp):
+        if op.kind == "insert":
+            row = self._rows.get(op.key)
+            if row is None:
+                row = op.model()
+                self._rows[op.key] = row
+        else:
+            row = self._rows[op.key]
+
+        for name, value in op.values.items():
+            setattr(row, name, value)
+        if op.parent is not None:
+            parent = self._rows[op.parent]
+            if parent.id is None:
+                # the parent was queued in this same batch, flush (not commit) it to get its id.
+                session.flush()
+            setattr(row, "query_id", parent.id)
+        session.add(row)
+
+
+query_log = QueryLog(max_queue=conf.QUERY_LOG_QUEUE_SIZE,
+                     batch_size=conf.QUERY_LOG_BATCH_SIZE,
+                     flush_interval=conf.QUERY_LOG_FLUSH_INTERVAL)
@@ -0,0 +1,123 @@
+import argparse
+from . import prompt_generator
+from .executor import build_messages
+from .tokens import get_encoding, DEFAULT_MODEL
+
+"""
+Measure how much prompt prefix consecutive calls in a pipeline share.
+
+Providers and local backends (vLLM, llama.cpp) reuse the KV cache for a shared token prefix,
+so the longer the prefix consecutive calls have in common, the cheaper and faster they get.
+This replays the call sequence the orchestrator makes for the scenes of one chapter with
+placeholder content and reports the shared prefix of every call against the call before it.
+
+    python -m server.prefix_probe --scenes 4
+"""
+
+
+def render_messages(messages: list[dict]) -> str:
+    """Flatten chat messages roughly the way chat templates do, close enough for prefix comparisons."""
+    return "".join(f"<|{message['role']}|>\n{message['content']}\n" for message in messages)
+
+
+def shared_prefix_tokens(previous: list[dict], current: list[dict], model: str = DEFAULT_MODEL) -> tuple[int, int]:
+    """
+    Return (shared prefix tokens, total prompt tokens of current).
+
+    Tokenizing both sides and comparing token ids, since a shared character prefix can still
+    split into different tokens at the boundary.
+    """
+    encoding = get_encoding(model)
+    a = encoding.encode(render_messages(previous))
+    b = encoding.encode(render_messages(current))
+    shared = 0
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        shared += 1
+    return shared, len(b)
+
+
+def _filler(label: str, sentences: int) -> str:
+    return " ".join(f"{label} sentence {i} carries some placeholder detail." for i in range(sentences))
+
+
+def chapter_pipeline(scene_count: int) -> list[tuple[str, list[dict]]]:
+    """
+    Build the (step name, messages) sequence for the scene outlines and scene texts of one chapter.
+
+    Mirrors orchestrator.generate_scene_outline and orchestrator.generate_scene_text, including
+    step 2 of the scene outline continuing the conversation of step 1.
+    """
+    sys_prompt = prompt_generator.generate_system_instruction(
+        _filler("description", 5), _filler("style", 2), _filler("themes", 2), _filler("request", 2),
+        setting=_filler("setting", 10), main_characters=_filler("characters", 10), summary=_filler("summary", 15),
+        outline=_filler("outline", 120))
+    chapter_outline = _filler("chapter", 60)
+    previous_chapter_outline = _filler("previous chapter", 60)
+
+    calls: list[tuple[str, list[dict]]] = []
+    previous_scene_outline = None
+    for n in range(1, scene_count + 1):
+        scene = dict(scene_number=str(n), setting=_filler(f"scene {n} setting", 2),
+                     primary_function=_filler(f"scene {n} primary", 1), secondary_function=_filler(f"scene {n} secondary", 1),
+                     summary=_filler(f"scene {n} summary", 4), context=_filler(f"scene {n} context", 2))
+        prompt_1 = prompt_generator.generate_scene_outline_step_1(chapter_outline, **scene,
+                                                                  previous_scene_outline=previous_scene_outline,
+                                                                  previous_chapter_outline=previous_chapter_outline)
+        _, messages_1 = build_messages(sys_prompt, prompt_1, [])
+        calls.append((f"scene {n} outline step 1", messages_1))
+
+        raw_outline = _filler(f"scene {n} raw outline", 20)
+        prompt_2 = prompt_generator.generate_scene_outline_step_2(chapter_outline, **scene)
+        calls.append((f"scene {n} outline step 2", messages_1 + [{"role": "assistant", "content": raw_outline},
+                                                                  {"role": "user", "content": prompt_2}]))
+        previous_scene_outline = _filler(f"scene {n} outline", 20)
+
+    previous_text = None
+    for n in range(1, scene_count + 1):
+        scene = dict(scene_number=str(n), setting=_filler(f"scene {n} setting", 2),
+                     primary_function=_filler(f"scene {n} primary", 1), secondary_function=_filler(f"scene {n} secondary", 1),
+                     summary=_filler(f"scene {n} summary", 4), context=_filler(f"scene {n} context", 2))
+        scene_outline = _filler(f"scene {n} outline", 20)
+        prompt_1 = prompt_generator.generate_scene_text_step_1(chapter_outline, **scene, scene_outline=scene_outline,
+                                                               previous_chapter_outline=previous_chapter_outline,
+                                                               previous_text=previous_text)
+        _, messages_1 = build_messages(sys_prompt, prompt_1, [])
+        calls.append((f"scene {n} text step 1", messages_1))
+
+        raw_text = _filler(f"scene {n} raw text", 60)
+        prompt_2 = prompt_generator.generate_scene_text_step_2(chapter_outline, **scene, scene_outline=scene_outline,
+                                                               scene_text_raw=raw_text)
+        _, messages_2 = build_messages(sys_prompt, prompt_2, [])
+        calls.append((f"scene {n} text step 2", messages_2))
+        previous_text = _filler(f"scene {n} text", 60)
+
+    return calls
+
+
+def report(calls: list[tuple[str, list[dict]]], model: str = DEFAULT_MODEL) -> float:
+    """Print the shared prefix of every call against the call before it, returning the overall ratio."""
+    shared_total = 0
+    prompt_total = 0
+    previous = None
+    for name, messages in calls:
+        if previous is None:
+            shared, total = 0, len(get_encoding(model).encode(render_messages(messages)))
+        else:
+            shared, total = shared_prefix_tokens(previous, messages, model)
+        shared_total += shared
+        prompt_total += total
+        print(f"{name:<28} {shared:>7} / {total:<7} shared ({shared / total:.0%})")
+        previous = messages
+    ratio = shared_total / prompt_total if prompt_total else 0.0
+    print(f"{'overall':<28} {shared_total:>7} / {prompt_total:<7} shared ({ratio:.0%})")
+    return ratio
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Report shared prompt prefixes across a chapter's scene pipeline.")
+    parser.add_argument("--scenes", type=int, default=3)
+    parser.add_argument("--model", default=DEFAULT_MODEL)
+    args = parser.parse_args()
+    report(chapter_pipeline(args.scenes), args.model)
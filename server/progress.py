@@ -0,0 +1,91 @@
+import time
+from contextvars import ContextVar
+from dataclasses import dataclass
+from typing import Any, AsyncIterator, Optional
+from .tokens import get_encoding
+from .utils import calc_cost
+from .budget import typical_output
+
+"""
+Live progress of a generation, for the metrics events of the SSE stream.
+
+The executor reports every call it makes and every delta it streams to the Progress of the
+generation it runs under, found through a ContextVar. Token counts come from the tokenizer
+as the text arrives and the cost is estimated from them, the provider's usage only shows up
+once a call is done. The ETA assumes the step will write about as much as it usually does
+(see budget.py).
+"""
+
+current_progress: ContextVar[Optional["Progress"]] = ContextVar("current_progress", default=None)
+
+
+@dataclass
+class StepProgress():
+    step: Optional[str]
+    model: str
+    started: float
+    first_token_at: Optional[float] = None
+    tokens: int = 0
+    # the step's usual output length, None without history
+    expected_tokens: Optional[int] = None
+
+
+class Progress():
+    def __init__(self):
+        self.started = time.monotonic()
+        self.tokens = 0
+        self.cost = 0.0
+        self.calls = 0
+        self.continuations = 0
+        self.step: Optional[StepProgress] = None
+
+    def start_call(self, step: Optional[str], model: str, prompt_tokens: int, continuation: bool):
+        self.calls += 1
+        if continuation:
+            self.continuations += 1
+        self.cost += calc_cost(prompt_tokens, 0, model)
+        if self.step is None or self.step.step != step:
+            self.step = StepProgress(step=step, model=model, started=time.monotonic(),
+                                     expected_tokens=typical_output(step, model))
+
+    def add(self, text: str):
+        if self.step is None:
+            return
+        now = time.monotonic()
+        if self.step.first_token_at is None:
+            self.step.first_token_at = now
+        tokens = len(get_encoding(self.step.model).encode(text))
+        self.step.tokens += tokens
+        self.tokens += tokens
+        self.cost += calc_cost(0, tokens, self.step.model)
+
+    def snapshot(self) -> dict[str, Any]:
+        now = time.monotonic()
+        step = self.step
+        metrics: dict[str, Any] = {"elapsed": round(now - self.started, 2),
+                                   "tokens": self.tokens,
+                                   "estimated_cost": round(self.cost, 5),
+                                   "calls": self.calls,
+                                   "continuations": self.continuations,
+                                   "step": None, "step_tokens": 0, "ttft": None, "tokens_per_second": None,
+                                   "expected_tokens": None, "progress": None, "eta": None}
+        if step is None:
+            return metrics
+        metrics.update(step=step.step, step_tokens=step.tokens, expected_tokens=step.expected_tokens)
+        if step.first_token_at is not None:
+            metrics["ttft"] = round(step.first_token_at - step.started, 3)
+            streaming = now - step.first_token_at
+            if streaming > 0 and step.tokens:
+                metrics["tokens_per_second"] = round(step.tokens / streaming, 1)
+        if step.expected_tokens:
+            metrics["progress"] = round(min(1.0, step.tokens / step.expected_tokens), 3)
+            if metrics["tokens_per_second"]:
+                metrics["eta"] = round(max(0, step.expected_tokens - step.tokens) / metrics["tokens_per_second"], 1)
+        return metrics
+
+
+async def track(gen: AsyncIterator, progress: Progress) -> AsyncIterator:
+    """Pass gen through with progress as the current Progress. Meant to be drained by its own task, the ContextVar is never reset."""
+    current_progress.set(progress)
+    async for item in gen:
+        yield item
@@ -60,11 +60,16 @@ def generate_system_instruction(description: str,
 
     # Is this vulnerable to prompt injection? Almost certainly. But we're displaying it back
     # to the client and this prompt is literally on github so we don't have anything to lose here.
+
+    # Layout matters: providers (and vLLM/llama.cpp) cache shared prompt prefixes, so the
+    # boilerplate goes first, then what's fixed for the story, then what changes per phase.
     base = f"""
 YOUR CORE INSTRUCTIONS:
 You are a skilled, NYT bestselling author and editor, and you have been tasked with ghost writing high quality stories for a major publisher. You are a professional, handling difficult themes with grace. As a skilled novelist, you write tight prose. You describe environments vividly, name characters where appropriate, and paint a consistent and interesting world for the story to take place in.
 
     Our goal here is to write a novel length work, meaning 70k-120k words. Unless the client specifies other wise, you'll bias towards writing in a tight third person perspective.
+
+    Our responses will be parsed by software, so please limit yourself to the task and the markdown formatting specified by the user agent—the software will not understand it otherwise. Remember to focus on quality. Feel free to be creative.
     END CORE INSTRUCTIONS
 
     The client has provided the following information about the story.
@@ -106,10 +111,6 @@ You are a skilled, NYT bestselling author and editor, and you have been tasked w
         {outline}
         """
 
-    base += """
-
-    Our responses will be parsed by software, so please limit yourself to the task and the markdown formatting specified by the user agent—the software will not understand it otherwise. Remember to focus on quality. Feel free to be creative."""
-
     return strip_tabs(base)
 
 
@@ -191,14 +192,10 @@ def generate_story_outline_step_3(previous_outline: str, skip_to_4=False) -> str
     else:
         insert = formats.STORY_OUTLINE_FORMAT_STEP_3
 
+    # instructions before the outline, the outline is the only part that varies between stories.
     prompt = f"""
     In this step you've taken on the role of a NYT bestselling editor. You're going to work through the outline generated for the previous message and you're going to improve it. Specifically we're going to make sure none of the chapters are too large, that the tension in the plot builds up and resolves nicely, and that we're addressing the themes of the story in our outline.
 
-    Here's the previous outline:
-    \"\"\"
-    {previous_outline}
-    \"\"\"
-
     We'll start by making some editing notes on how we can improve the outline, then we'll go through and write an improved outline for our story.
 
     To do this well, feel free to edit or move around the chapters and move around where different secondary functions occur.
@@ -207,6 +204,11 @@ def generate_story_outline_step_3(previous_outline: str, skip_to_4=False) -> str
     ```
     {insert}
     ```
+
+    Here's the previous outline:
+    \"\"\"
+    {previous_outline}
+    \"\"\"
     """
     return strip_tabs(prompt)
 
@@ -221,11 +223,6 @@ def generate_story_outline_step_4(previous_outline: str) -> str:
     prompt = f"""
     In this final outlining step, we're going to go back through the outline and amend our main events by adding a paragraph detailing the chapter, as well as expanding the notes to include any information and context we're going to need to write a high quality chapter that fits in with the rest of our story.
 
-    Here's the previous outline:
-    \"\"\"
-    {previous_outline}
-    \"\"\"
-
     Remember: when we write the chapter itself, we won't see the rest of the story, just the outline, so any information or context we need to write the chapter well needs to be included in the chapter notes.
 
     After the outline, we'll create a factsheet of any important information we want to remember about the story when we're writing the individual chapters and scenes, as well as a reference of all the characters in our story. Again, this is to help us write the chapters and scenes.
@@ -234,6 +231,11 @@ def generate_story_outline_step_4(previous_outline: str) -> str:
     ```
     {formats.STORY_OUTLINE_FORMAT_STEP_4}
     ```
+
+    Here's the previous outline:
+    \"\"\"
+    {previous_outline}
+    \"\"\"
     """
     return strip_tabs(prompt)
 
@@ -250,9 +252,17 @@ def generate_chapter_outline_step_1(chapter_number: str,
     USAGE: note that using this, the setting, maincharacter, summary, and outline should be in the system prompt.
     """
 
+    # the chapter goes last so every chapter of a story shares everything before it.
     prompt = f"""
     In this step, we'll generate the outline for a chapter.
 
+    We'll generate three things: an outline of the chapter, listing every single scene in the chapter. For each scene, we'll note the setting, the primary function, the secondary function, if any, and the outline of the scene itself in the form of a summary paragraphs. We'll also add any context we want to remind ourselves of when writing the scene. Write this for maximum usefulness for a Large Language Model author such as yourself.
+
+    Please respond using valid markdown syntax, separating the sections as shown inside this code block. We've used <> to indicate where you should fill things:
+    ```
+    {formats.CHAPTER_OUTLINE_FORMAT_STEP_1}
+    ```
+
     Here's the information about the chapter:
     \"\"\"
     # Title
@@ -266,13 +276,6 @@ def generate_chapter_outline_step_1(chapter_number: str,
     # Chapter Notes
     {chapter_notes}
     \"\"\"
-
-    We'll generate three things: an outline of the chapter, listing every single scene in the chapter. For each scene, we'll note the setting, the primary function, the secondary function, if any, and the outline of the scene itself in the form of a summary paragraphs. We'll also add any context we want to remind ourselves of when writing the scene. Write this for maximum usefulness for a Large Language Model author such as yourself.
-
-    Please respond using valid markdown syntax, separating the sections as shown inside this code block. We've used <> to indicate where you should fill things:
-    ```
-    {formats.CHAPTER_OUTLINE_FORMAT_STEP_1}
-    ```
     """
 
     return strip_tabs(prompt)
@@ -319,13 +322,17 @@ def generate_scene_outline_step_1(chapter_outline: str,
     """
     Generate the scene outline.
 
-    This code
+    The chapter level context comes first and the scene level context last, so consecutive
+    scenes of a chapter share as long a prompt prefix as possible.
 
     USAGE: note that using this, the setting, maincharacter, summary, and outline should be in the system prompt.
     """
 
     prompt = f"""
-    First, some general context for where we are right now.
+    For context, here is the outline of the whole chapter:
+    \"\"\"
+    {chapter_outline}
+    \"\"\"
     """
 
     if previous_chapter_outline:
@@ -336,6 +343,18 @@ def generate_scene_outline_step_1(chapter_outline: str,
         \"\"\"
         """
 
+    prompt += f"""
+
+    In this step, we'll generate the outline for a scene. We'll generate a list of the paragraphs in the scene, including in that list all of the dialogue in the scene. Write this for maximum usefulness for a Large Language Model author such as yourself.
+
+    We'll generate one thing: an outline of the scene, listing every single paragraph in the scene. We'll write one sentence for each paragraph. We'll also note placeholders for dialogue. The placeholders should include what is communicated and achieved in a section of dialog. If multiple things are communicated, we should leave multiple dialog placeholders in sequence, since the dialog will be longer.
+
+    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
+    ```
+    {formats.SCENE_OUTLINE_FORMAT_STEP_1}
+    ```
+    """
+
     # TODO: We can potentially go more aggressive on context here, will have to experiment with cost vs benefit.
     # if previous_chapter_last_scene_outline:
     #     prompt += f"""
@@ -354,14 +373,6 @@ def generate_scene_outline_step_1(chapter_outline: str,
         """
 
     prompt += f"""
-
-    For renewed context, here is the outline of the whole chapter:
-    \"\"\"
-    {chapter_outline}
-    \"\"\"
-
-    In this step, we'll generate the outline for a scene. We'll generate a list of the paragraphs in the scene, including in that list all of the dialogue in the scene. Write this for maximum usefulness for a Large Language Model author such as yourself.
-
     Here's the information about the scene:
     \"\"\"
     # Scene {scene_number}
@@ -376,13 +387,6 @@ def generate_scene_outline_step_1(chapter_outline: str,
     # Context
     {context}
     \"\"\"
-
-    We'll generate one thing: an outline of the scene, listing every single paragraph in the scene. We'll write one sentence for each paragraph. We'll also note placeholders for dialogue. The placeholders should include what is communicated and achieved in a section of dialog. If multiple things are communicated, we should leave multiple dialog placeholders in sequence, since the dialog will be longer.
-
-    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
-    ```
-    {formats.SCENE_OUTLINE_FORMAT_STEP_1}
-    ```
     """
     return strip_tabs(prompt)
 
@@ -394,14 +398,21 @@ def generate_scene_outline_step_2(chapter_outline: str,
                                   secondary_function: str,
                                   summary: str,
                                   context: str) -> str:
-    prompt = f"""In this step you've taken on the role of a NYT bestselling editor. You're going to work through the outline generated for the previous message and you're going to improve it. Specifically we're going to make sure that, given the chapter outline and the information about the scene, we're writing a high quality scene. We'll expand on any dialogue that's too short by adding more placeholders, add description paragraphs where necessary, add blocking notes to dialog placeholders that are missing it, and generally tighten everything up.
-
-
-    For renewed context, here is the outline of the whole chapter:
+    prompt = f"""
+    For context, here is the outline of the whole chapter:
     \"\"\"
     {chapter_outline}
     \"\"\"
 
+    In this step you've taken on the role of a NYT bestselling editor. You're going to work through the outline generated for the previous message and you're going to improve it. Specifically we're going to make sure that, given the chapter outline and the information about the scene, we're writing a high quality scene. We'll expand on any dialogue that's too short by adding more placeholders, add description paragraphs where necessary, add blocking notes to dialog placeholders that are missing it, and generally tighten everything up.
+
+    In order to improve the scene, we'll first make some editing notes on the earlier draft of the scene, then we'll go through and write an improved outline for the scene.
+
+    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
+    ```
+    {formats.SCENE_OUTLINE_FORMAT_STEP_2}
+    ```
+
     Here's the information about the scene:
     \"\"\"
     # Scene {scene_number}
@@ -416,13 +427,6 @@ def generate_scene_outline_step_2(chapter_outline: str,
     # Context
     {context}
     \"\"\"
-
-    In order to improve the scene, we'll first make some editing notes on the earlier draft of the scene, then we'll go through and write an improved outline for the scene.
-
-    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
-    ```
-    {formats.SCENE_OUTLINE_FORMAT_STEP_2}
-    ```
     """
 
     return strip_tabs(prompt)
@@ -440,9 +444,17 @@ def generate_scene_text_step_1(chapter_outline: str,
                                previous_chapter_outline: str | None = None,
                                previous_chapter_last_scene_outline: str | None = None,
                                previous_text: str | None = None) -> str:
-    prompt = f"""
+    """
+    Generate the text of a scene.
 
-    For general context, here's previous parts of the story, already written.
+    Same layout as the scene outline prompts: chapter context, then the instructions, then
+    everything specific to this scene.
+    """
+    prompt = f"""
+    For context, here is the outline of the whole chapter:
+    \"\"\"
+    {chapter_outline}
+    \"\"\"
     """
 
     if previous_chapter_outline:
@@ -454,10 +466,12 @@ def generate_scene_text_step_1(chapter_outline: str,
         """
 
     prompt += f"""
-    For context, here is the outline of the current chapter:
-    \"\"\"
-    {chapter_outline}
-    \"\"\"
+    In this step, we'll generate the text for a scene. Expand each paragraph or dialogue placeholder into their respective paragraphs and dialogue. We're writing high quality prose fitting for a NYT best seller.
+
+    Please respond using valid markdown syntax, using the structure (but not necessarily the order or count) shown inside this code block. We've used <> to indicate where you should fill things:
+    ```
+    {formats.SCENE_TEXT_FORMAT_STEP_1}
+    ```
     """
 
     # TODO: We can potentially go more aggressive on context here, will have to experiment with cost vs benefit.
@@ -505,13 +519,6 @@ def generate_scene_text_step_1(chapter_outline: str,
     \"\"\"
     {scene_outline}
     \"\"\"
-
-    In this step, we'll generate the text for a scene. Expand each paragraph or dialogue placeholder into their respective paragraphs and dialogue. We're writing high quality prose fitting for a NYT best seller. Use the following format:
-
-    Please respond using valid markdown syntax, using the structure (but not necessarily the order or count) shown inside this code block. We've used <> to indicate where you should fill things:
-    ```
-    {formats.SCENE_TEXT_FORMAT_STEP_1}
-    ```
     """
 
     return strip_tabs(prompt)
@@ -528,16 +535,21 @@ def generate_scene_text_step_2(chapter_outline: str,
                                scene_text_raw: str) -> str:
 
     prompt = f"""
+    For context, here is the outline of the whole chapter:
+    \"\"\"
+    {chapter_outline}
+    \"\"\"
 
     General Context:
 
     In this step you've taken on the role of a NYT bestselling editor. You're going to work through the outline generated for the previous message and you're going to improve it. Specifically we're going to make sure that, given the chapter outline and the information about the scene, we're writing a high quality scene. We'll expand on any dialogue that's too short by adding more placeholders, add description paragraphs where necessary, add blocking notes to dialog placeholders that are missing it, and generally tighten everything up.
 
+    In order to improve the scene, we'll first make some editing notes on the earlier draft of the scene, then we'll go through and write an improved version of the scene.
 
-    For renewed context, here is the outline of the whole chapter:
-    \"\"\"
-    {chapter_outline}
-    \"\"\"
+    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
+    ```
+    {formats.SCENE_TEXT_FORMAT_STEP_2}
+    ```
 
     Here's the information about the scene:
     \"\"\"
@@ -558,13 +570,6 @@ def generate_scene_text_step_2(chapter_outline: str,
     \"\"\"
     {scene_text_raw}
     \"\"\"
-
-    In order to improve the scene, we'll first make some editing notes on the earlier draft of the scene, then we'll go through and write an improved version of the scene.
-
-    Please respond using valid markdown syntax, using the structure (but not necessarily the order) shown inside this code block. We've used <> to indicate where you should fill things:
-    ```
-    {formats.SCENE_TEXT_FORMAT_STEP_2}
-    ```
     """
 
     return strip_tabs(prompt)
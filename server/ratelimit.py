@@ -0,0 +1,179 @@
+import asyncio
+import json
+import sqlite3
+import time
+from contextlib import asynccontextmanager
+from functools import lru_cache
+from typing import Optional
+from fastapi.concurrency import run_in_threadpool
+from .config import get_settings
+from .endpoints import load_endpoints
+
+"""
+Client side rate limiting for LLM calls, off unless limits are configured.
+
+Every endpoint and model gets two token buckets, one for requests per minute and one for
+tokens per minute, matching how a provider meters us. Limits come from the endpoint's "rpm"
+and "tpm" in LLM_ENDPOINTS, then RATE_LIMIT_OVERRIDES for the model, then RATE_LIMIT_RPM and
+RATE_LIMIT_TPM, 0 meaning unlimited. A call is charged its estimated tokens (the prompt plus
+what it may complete) before it's sent and the estimate is settled against the reported
+usage afterwards. A 429 empties the endpoint's buckets for the model, so every caller pauses
+instead of each one backing off on its own schedule.
+
+The buckets live in a SQLite file so all uvicorn workers draw from the same budget. Within a
+worker, callers for an endpoint and model wait in line behind an asyncio.Lock, which wakes
+waiters in arrival order, and only the head of the line polls the database.
+
+A separate per-worker semaphore caps how many calls stream at once.
+"""
+
+# the longest we sleep before checking the buckets again, another worker may have refunded tokens
+MAX_POLL_INTERVAL = 1.0
+
+
+class RateLimiter():
+    def __init__(self, path: str, rpm: int, tpm: int, overrides: dict[str, dict[str, int]],
+                 endpoint_limits: dict[str, dict[str, int]], max_concurrency: int):
+        self.path = path
+        self.rpm = rpm
+        self.tpm = tpm
+        self.overrides = overrides
+        self.endpoint_limits = endpoint_limits
+        self._lines: dict[tuple[str, str], asyncio.Lock] = {}
+        self._slots = asyncio.Semaphore(max_concurrency) if max_concurrency > 0 else None
+        self.enabled = bool(rpm or tpm or any(any(limits.values()) for limits in [*overrides.values(), *endpoint_limits.values()]))
+        if not self.enabled:
+            return
+        with self._connect() as conn:
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("""CREATE TABLE IF NOT EXISTS endpoint_buckets (
+                                endpoint TEXT NOT NULL,
+                                model TEXT NOT NULL,
+                                requests REAL NOT NULL,
+                                tokens REAL NOT NULL,
+                                updated_at REAL NOT NULL,
+                                PRIMARY KEY (endpoint, model))""")
+
+    def _connect(self) -> sqlite3.Connection:
+        return sqlite3.connect(self.path, timeout=10, isolation_level=None)
+
+    def limits(self, endpoint: str, model: str) -> tuple[int, int]:
+        """(requests per minute, tokens per minute) for a model on an endpoint, 0 meaning unlimited."""
+        if not self.enabled:
+            return 0, 0
+        override = {**self.overrides.get(model, {}), **self.endpoint_limits.get(endpoint, {})}
+        return override.get("rpm", self.rpm), override.get("tpm", self.tpm)
+
+    def _update(self, endpoint: str, model: str, change) -> float:
+        """
+        Refill the buckets of the model on endpoint, then let change(requests, tokens) spend from them.
+
+        change returns (requests, tokens, wait). Runs in one write transaction so workers
+        can't both spend the same budget.
+        """
+        rpm, tpm = self.limits(endpoint, model)
+        now = time.time()
+        conn = self._connect()
+        try:
+            conn.execute("BEGIN IMMEDIATE")
+            row = conn.execute("SELECT requests, tokens, updated_at FROM endpoint_buckets WHERE endpoint = ? AND model = ?",
+                               (endpoint, model)).fetchone()
+            if row is None:
+                requests, tokens = float(rpm), float(tpm)
+            else:
+                elapsed = max(0.0, now - row[2])
+                requests = min(float(rpm), row[0] + elapsed * rpm / 60)
+                tokens = min(float(tpm), row[1] + elapsed * tpm / 60)
+            requests, tokens, wait = change(requests, tokens)
+            conn.execute("INSERT OR REPLACE INTO endpoint_buckets (endpoint, model, requests, tokens, updated_at) VALUES (?, ?, ?, ?, ?)",
+                         (endpoint, model, requests, tokens, now))
+            conn.execute("COMMIT")
+            return wait
+        except BaseException:
+            conn.execute("ROLLBACK")
+            raise
+        finally:
+            conn.close()
+
+    def _try_acquire(self, endpoint: str, model: str, estimated_tokens: int) -> float:
+        """Spend one request and estimated_tokens if both are available, otherwise return how long to wait."""
+        rpm, tpm = self.limits(endpoint, model)
+        # a single request larger than the whole bucket would never fit, charge it the full bucket instead
+        needed = min(float(estimated_tokens), float(tpm))
+
+        def change(requests: float, tokens: float):
+            wait = 0.0
+            if rpm and requests < 1:
+                wait = max(wait, (1 - requests) * 60 / rpm)
+            if tpm and tokens < needed:
+                wait = max(wait, (needed - tokens) * 60 / tpm)
+            if wait > 0:
+                return requests, tokens, wait
+            return requests - (1 if rpm else 0), tokens - (needed if tpm else 0), 0.0
+
+        return self._update(endpoint, model, change)
+
+    async def acquire(self, endpoint: str, model: str, estimated_tokens: int):
+        """Wait, in line with the other callers of this worker, until the model on endpoint has budget for the call."""
+        rpm, tpm = self.limits(endpoint, model)
+        if not rpm and not tpm:
+            return
+        line = self._lines.setdefault((endpoint, model), asyncio.Lock())
+        async with line:
+            waited = False
+            while True:
+                wait = await run_in_threadpool(self._try_acquire, endpoint, model, estimated_tokens)
+                if wait <= 0:
+                    return
+                if not waited:
+                    print(f"RATE LIMITED: {model} on {endpoint} waiting ~{wait:.2f}s for {estimated_tokens} tokens")
+                    waited = True
+                await asyncio.sleep(min(wait, MAX_POLL_INTERVAL))
+
+    async def settle(self, endpoint: str, model: str, estimated_tokens: int, actual_tokens: int):
+        """Refund (or charge) the difference between what a call was charged and what it used."""
+        rpm, tpm = self.limits(endpoint, model)
+        if not tpm:
+            return
+        charged = min(float(estimated_tokens), float(tpm))
+        difference = charged - actual_tokens
+        await run_in_threadpool(self._update, endpoint, model,
+                                lambda requests, tokens: (requests, min(float(tpm), tokens + difference), 0.0))
+
+    async def penalize(self, endpoint: str, model: str):
+        """The endpoint said 429, empty its buckets for the model so everyone waits for a refill."""
+        rpm, tpm = self.limits(endpoint, model)
+        if not rpm and not tpm:
+            return
+        print("RATE LIMIT HIT, DRAINING BUCKETS FOR: ", model, endpoint)
+        await run_in_threadpool(self._update, endpoint, model, lambda requests, tokens: (min(requests, 0.0), min(tokens, 0.0), 0.0))
+
+    @asynccontextmanager
+    async def slot(self):
+        """Hold one of the worker's LLM_MAX_CONCURRENCY streaming slots."""
+        if self._slots is None:
+            yield
+            return
+        async with self._slots:
+            yield
+
+
+@lru_cache()
+def get_rate_limiter() -> RateLimiter:
+    conf = get_settings()
+    overrides = json.loads(conf.RATE_LIMIT_OVERRIDES) if conf.RATE_LIMIT_OVERRIDES else {}
+    endpoint_limits = {endpoint.url: {name: limit for name, limit in (("rpm", endpoint.rpm), ("tpm", endpoint.tpm)) if limit is not None}
+                       for endpoint in load_endpoints()}
+    return RateLimiter(conf.RATE_LIMIT_PATH,
+                       rpm=int(conf.RATE_LIMIT_RPM),
+                       tpm=int(conf.RATE_LIMIT_TPM),
+                       overrides=overrides,
+                       endpoint_limits=endpoint_limits,
+                       max_concurrency=int(conf.LLM_MAX_CONCURRENCY))
+
+
+def estimate_completion_tokens(max_tokens: Optional[int]) -> int:
+    """What a call may complete, for charging before we know. max_tokens if set, since the provider counts it too."""
+    if max_tokens:
+        return int(max_tokens)
+    return int(get_settings().RATE_LIMIT_COMPLETION_ESTIMATE)
@@ -0,0 +1,312 @@
+import re
+from collections.abc import Awaitable, Callable
+from typing import Any, Optional, cast
+from . import formats
+
+"""
+Targeted repair of step outputs that don't quite parse.
+
+Most outputs that fail to parse are nearly right: a heading written "## Revised outline", a
+chapter line with a colon where the em dash goes, the editing notes left out, one chapter
+missing its main events. Throwing all of it away and paying for the whole response again is
+the expensive fix. Instead a Repairer
+
+- normalizes what it can locally (headings, dashes, code fences, heading levels),
+- asks, in the same conversation, for just the sections that are still missing or don't
+  parse, and merges them in,
+- asks for just the numbered entries (chapters, scenes) that came out incomplete, and
+  splices them in.
+
+Output that parses is left alone, repairs only start once check fails. An entry counts as
+incomplete when a field its format always fills is empty (REQUIRED_FIELDS), not any field:
+the parsers leave later fields empty on well-formed output, e.g. the summary and notes of a
+complex outline chapter whose main events are a list.
+
+Only if the output still doesn't parse after that does the step retry from scratch. A follow
+up is a few hundred tokens of output rather than the thousands of a full retry.
+"""
+
+# story base isn't sectioned, its headings take the place of sections
+STORY_BASE_HEADINGS = ("Setting", "Main Characters", "Summary", "Tags")
+
+# loose spellings of the "# " headings, by the canonical one
+HEADING_VARIANTS = {
+    "Editing Notes": r"edit(?:ing|or'?s)? notes",
+    "Outline": r"(?:\w+ )?outline",
+    "FactSheet": r"fact ?sheet",
+    "Characters": r"(?:\w+ )?characters",
+    "Scene": r"scene",
+    "Setting": r"setting",
+    "Main Characters": r"main characters",
+    "Summary": r"summary",
+    "Tags": r"tags",
+}
+
+CHAPTER_SUBHEADINGS = {
+    "Chapter Purpose": r"(?:chapter )?purpose",
+    "Main Events": r"(?:main |key )?events",
+    "Chapter Summary": r"chapter summary|summary",
+    "Chapter Notes": r"(?:chapter )?notes",
+}
+
+SCENE_SUBHEADINGS = {
+    "Setting": r"setting",
+    "Primary Function": r"primary function",
+    "Secondary Function": r"secondary function",
+    "Summary": r"summary",
+    "Context": r"context",
+}
+
+# the block heading of each format, how to write it canonically, and its subheadings
+BLOCKS: dict[Callable, tuple[str, Callable[[re.Match], str], dict[str, str]]] = {
+    parse: (r"chapter\s*(\d+)\s*[:\-–—.]*\s*(.*)",
+            lambda m: f"Chapter {m.group(1)} — {m.group(2)}" if m.group(2) else f"Chapter {m.group(1)}",
+            {} if parse is formats.parse_story_outline_simple else CHAPTER_SUBHEADINGS)
+    for parse in (formats.parse_story_outline_simple, formats.parse_story_outline_medium, formats.parse_story_outline_complex)
+}
+BLOCKS[formats.parse_chapter_outline] = (r"scene\s*:?\s*(\d+)\b.*", lambda m: f"Scene {m.group(1)}", SCENE_SUBHEADINGS)
+BLOCKS[formats.parse_scene_outline] = (r"scene\s*:?\s*(\d+)\b.*", lambda m: f"Scene {m.group(1)}", {})
+BLOCKS[formats.parse_scene_text] = (r"(paragraph|dialogue)\s*[:\-–—]?\s*(.*)",
+                                    lambda m: f"{m.group(1).capitalize()} {m.group(2)}", {})
+
+# the fields of an entry that are never empty when its block is written as the format asks
+REQUIRED_FIELDS: dict[Callable, tuple[str, ...]] = {
+    formats.parse_story_outline_simple: ("description",),
+    formats.parse_story_outline_medium: ("chapter_purpose",),
+    formats.parse_story_outline_complex: ("chapter_purpose",),
+    formats.parse_chapter_outline: ("setting",),
+    formats.parse_scene_outline: ("content",),
+}
+
+FENCE = re.compile(r"\s*```\w*\s*$")
+HEADING = re.compile(r"\s*(#+)\s*(.*?)\s*:?\s*$")
+BOLD = re.compile(r"\s*\*\*(.+?):?\*\*:?\s*$")
+NUMBERED = re.compile(r"(?:Chapter|Scene) (\d+)")
+
+MISSING_PROMPT = """\
+Your answer above is missing {names}. Without repeating the rest of it, please write just {that}, \
+heading included, in the same format."""
+
+ENTRIES_PROMPT = """\
+In your answer above, {names} {are} incomplete. Without repeating anything else, please write just \
+{that} again in full, heading included, in the same format."""
+
+
+def _names(items: list[str]) -> str:
+    return items[0] if len(items) == 1 else ", ".join(items[:-1]) + " and " + items[-1]
+
+
+class Repairer():
+    """
+    Repairs the output of a step parsed by check, whose section (or, for story base, the whole
+    output) is in the format parser parses. others are the free text sections the step reads.
+    """
+    def __init__(self, check: Callable[[str], Any], parser: Callable, section: Optional[str] = None,
+                 others: tuple[str, ...] = ()):
+        self.check = check
+        self.parser = parser
+        self.section = formats.SECTION_HEADINGS[section] if section is not None else None
+        if section is None:
+            self.titles: tuple[str, ...] = STORY_BASE_HEADINGS
+            self.needed: tuple[str, ...] = STORY_BASE_HEADINGS
+        else:
+            self.titles = tuple(formats.SECTION_HEADINGS.values())
+            self.needed = tuple(title for key, title in formats.SECTION_HEADINGS.items() if key == section or key in others)
+        self.level = formats.STREAM_FORMATS[parser][1]
+        self.block, self.block_heading, self.subheadings = BLOCKS.get(parser, (None, None, {}))
+        self.required = REQUIRED_FIELDS.get(parser, ())
+
+    def _title(self, text: str) -> Optional[str]:
+        for title in self.titles:
+            if re.fullmatch(HEADING_VARIANTS[title], text, re.IGNORECASE):
+                return title
+        return None
+
+    def _subheading(self, text: str) -> Optional[str]:
+        for heading, variants in self.subheadings.items():
+            if re.fullmatch(variants, text, re.IGNORECASE):
+                return heading
+        return None
+
+    def _heading(self, line: str) -> Optional[tuple[int, str]]:
+        """(level, text) of a heading line, a bold line counting as a block's level."""
+        heading = HEADING.match(line)
+        if heading is not None:
+            return len(heading.group(1)), heading.group(2)
+        bold = BOLD.match(line)
+        if bold is not None:
+            return self.level, bold.group(1).strip()
+        return None
+
+    def normalize(self, output: str) -> str:
+        """Fix heading spellings, levels and dashes, and drop code fences, without asking anything."""
+        lines: list[str] = []
+        for line in output.strip().split("\n"):
+            if FENCE.match(line):
+                continue
+            heading = self._heading(line)
+            if heading is not None:
+                level, text = heading
+                bold = not line.lstrip().startswith("#")
+                title = self._title(text) if level <= 2 or bold else None
+                block = re.fullmatch(self.block, text, re.IGNORECASE) if self.block else None
+                subheading = self._subheading(text) if level > self.level or bold else None
+                if title is not None:
+                    lines += ["", f"# {title}"] if lines else [f"# {title}"]
+                    continue
+                if block is not None:
+                    line = "#" * self.level + " " + self.block_heading(block).strip()
+                elif subheading is not None:
+                    line = "#" * (self.level + 1) + " " + subheading
+            elif not line.strip() and lines and lines[-1].startswith("##"):
+                # the parsers want a heading's content on the line after it
+                continue
+            lines.append(line)
+        text = "\n".join(lines)
+        sections = self.sections(text)
+        if self.section is not None and not sections.get(self.section) and self._blocks(sections.get("", "")):
+            # the blocks are there, just not under their heading
+            sections[self.section] = sections.pop("")
+        return self.join(sections) if len(sections) > 1 or "" not in sections else text
+
+    def sections(self, text: str) -> dict[str, str]:
+        """The "# " sections of text by heading, what comes before the first under ""."""
+        sections: dict[str, str] = {}
+        title = ""
+        content: list[str] = []
+        for line in text.split("\n"):
+            if line.startswith("# "):
+                sections[title] = "\n".join(content).strip()
+                title, content = line[2:].strip(), []
+            else:
+                content.append(line)
+        sections[title] = "\n".join(content).strip()
+        if not sections[""]:
+            del sections[""]
+        return sections
+
+    def join(self, sections: dict[str, str]) -> str:
+        order = [title for title in self.titles if title in sections] + \
+            [title for title in sections if title not in self.titles and title]
+        return "\n\n".join(f"# {title}\n{sections[title]}" for title in order)
+
+    def _blocks(self, text: str) -> list[tuple[str, int, int]]:
+        """(label, first line, end line) of each numbered block (Chapter 3, Scene 2) in text, at any level."""
+        lines = text.split("\n")
+        blocks: list[tuple[str, int, int]] = []
+        current: Optional[tuple[str, int, int]] = None
+        for i, line in enumerate(lines):
+            heading = self._heading(line)
+            if heading is None:
+                continue
+            level, heading_text = heading
+            if current is not None and level <= current[2]:
+                blocks.append((current[0], current[1], i))
+                current = None
+            block = re.fullmatch(self.block, heading_text, re.IGNORECASE) if self.block and level > 1 else None
+            number = NUMBERED.match(self.block_heading(block)) if block is not None else None
+            if number is not None:
+                current = (number.group(0), i, level)
+        if current is not None:
+            blocks.append((current[0], current[1], len(lines)))
+        return blocks
+
+    def _entries(self, text: str) -> Optional[list]:
+        """The entries of the section as parsed, None if it doesn't parse."""
+        try:
+            parsed = self.parser(self.sections(text).get(cast(str, self.section), ""))
+        except formats.ParsingError:
+            return None
+        return next((value for value in parsed.values() if isinstance(value, list)), None)
+
+    def missing(self, text: str) -> list[str]:
+        """The sections (story base: headings) that are missing, empty, or have nothing that parses."""
+        sections = self.sections(text)
+        missing = [title for title in self.needed if not sections.get(title)]
+        if self.section is not None and self.section not in missing and not self._entries(text):
+            missing.append(self.section)
+        return missing
+
+    def incomplete(self, text: str) -> list[str]:
+        """The numbered entries of the section that parsed with required fields left empty, or didn't parse at all."""
+        if self.section is None or self.block is None:
+            return []
+        incomplete: list[str] = []
+        parsed = set()
+        for entry in self._entries(text) or []:
+            number = next((key for key in entry if key.endswith("_number")), None)
+            if number is None:
+                continue
+            label = f"{'Chapter' if number == 'chapter_number' else 'Scene'} {entry[number]}"
+            parsed.add(label)
+            if any(not entry.get(key) for key in self.required):
+                incomplete.append(label)
+        for label, _start, _end in self._blocks(self.sections(text).get(self.section, "")):
+            if label not in parsed and label not in incomplete:
+                incomplete.append(label)
+        return incomplete
+
+    def parses(self, text: str) -> bool:
+        try:
+            self.check(text)
+        except (KeyError, formats.ParsingError):
+            return False
+        return True
+
+    def complete(self, text: str) -> bool:
+        return self.parses(text) and not self.missing(text) and not self.incomplete(text)
+
+    def merge_sections(self, text: str, answer: str, missing: list[str]) -> str:
+        sections, answered = self.sections(text), self.sections(answer)
+        if "" in answered and len(missing) == 1 and not answered.get(missing[0]):
+            # just the content, without its heading
+            answered[missing[0]] = answered.pop("")
+        for title in missing:
+            if answered.get(title):
+                sections[title] = answered[title]
+        return self.join(sections)
+
+    def merge_entries(self, text: str, answer: str, incomplete: list[str]) -> str:
+        sections = self.sections(text)
+        section = cast(str, self.section)
+        lines = sections[section].split("\n")
+        answer_lines = answer.split("\n")
+        replacements = {label: answer_lines[start:end] for label, start, end in self._blocks(answer)}
+        for label, start, end in reversed(self._blocks(sections[section])):
+            if label in incomplete and label in replacements:
+                lines[start:end] = [line for line in replacements[label] if not FENCE.match(line)]
+        sections[section] = "\n".join(lines).strip()
+        return self.join(sections)
+
+    async def __call__(self, output: str, ask: Callable[[str], Awaitable[str]]) -> str:
+        """
+        output, repaired as far as it can be. ask sends a follow up to the conversation the
+        output ended and returns the answer. Whether the result parses is up to check.
+        """
+        if self.parses(output):
+            return output
+        text = self.normalize(output)
+        missing = self.missing(text)
+        if missing and len(missing) < len(self.needed):
+            print("REPAIRING MISSING SECTIONS: ", missing)
+            names = [f'the "# {title}" section' for title in missing]
+            answer = await ask(MISSING_PROMPT.format(names=_names(names), that="that" if len(missing) == 1 else "those"))
+            text = self.merge_sections(text, self.normalize(answer), missing)
+        elif missing:
+            # nothing to build on, a retry is no more expensive than asking for all of it
+            return text
+        incomplete = self.incomplete(text)
+        if incomplete:
+            print("REPAIRING INCOMPLETE ENTRIES: ", incomplete)
+            answer = await ask(ENTRIES_PROMPT.format(names=_names(incomplete), are="is" if len(incomplete) == 1 else "are",
+                                                     that="that" if len(incomplete) == 1 else "those"))
+            text = self.merge_entries(text, self.normalize(answer), incomplete)
+        return text
+
+
+def repairer(check: Callable[[str], Any], parser: Callable, section: Optional[str] = None,
+             others: tuple[str, ...] = ()) -> Optional[Repairer]:
+    """A Repairer for a step in the format parser parses, None for formats it doesn't know."""
+    if parser not in formats.STREAM_FORMATS:
+        return None
+    return Repairer(check, parser, section, others)
@@ -0,0 +1,112 @@
+import json
+from dataclasses import dataclass, replace, fields
+from functools import lru_cache
+from typing import Optional
+from .models import User
+from .config import get_settings
+
+"""
+Per-step model routing.
+
+Every orchestrator step has a name (story_base, story_outline_1 .. 4, chapter_outline_1 and 2,
+scene_outline_1 and 2, scene_text_1 and 2) and is sent to the model its route names, with that
+route's sampling parameters and, optionally, its own OpenAI compatible endpoint. Cheap
+structural steps can go to a faster model while the prose stays on the strongest one.
+
+Routes come from MODEL_ROUTES, a JSON object keyed by step name, by "<tier>:<step>" or by
+"<tier>:*", e.g.
+
+    {"story_outline_1": {"model": "gpt-3.5-turbo-1106"},
+     "unverified:*": {"model": "gpt-3.5-turbo-1106", "max_tokens": 2000}}
+
+A route only needs the fields it changes, the rest come from the default route built from
+QUERY_MAX_TOKENS, QUERY_TEMPERATURE and QUERY_FREQUENCY_PENALTY. Lookups go from most to
+least specific: "<tier>:<step>", "<step>", "<tier>:*", then "*".
+
+structured_output asks the route's model for JSON in the step's schema rather than markdown
+(see formats.StructuredFormat), for models that support structured outputs. It defaults to
+STRUCTURED_OUTPUT.
+"""
+
+DEFAULT_MODEL = "gpt-4-1106-preview"
+
+STEPS = ("story_base",
+         "story_outline_1", "story_outline_2", "story_outline_3", "story_outline_4",
+         "chapter_outline_1", "chapter_outline_2",
+         "scene_outline_1", "scene_outline_2",
+         "scene_text_1", "scene_text_2")
+
+
+@dataclass(frozen=True)
+class Route():
+    model: str = DEFAULT_MODEL
+    # None means OPENAI_BASE_URL
+    base_url: Optional[str] = None
+    max_tokens: Optional[int] = None
+    temperature: float = 1
+    frequency_penalty: float = 0.1
+    # for models budget.MODEL_LIMITS doesn't know, lets max_tokens be planned for them
+    context_window: Optional[int] = None
+    structured_output: bool = False
+
+    def request_params(self) -> dict:
+        """The sampling parameters sent with the request, also what the response cache keys on."""
+        return dict(model=self.model,
+                    max_tokens=self.max_tokens,
+                    temperature=self.temperature,
+                    frequency_penalty=self.frequency_penalty)
+
+
+def user_tier(user: User) -> str:
+    """There's no billing tier on users (yet), so tiers follow the account flags."""
+    if user.superuser:
+        return "superuser"
+    if user.verified:
+        return "verified"
+    return "unverified"
+
+
+@lru_cache()
+def default_route() -> Route:
+    conf = get_settings()
+    return Route(model=DEFAULT_MODEL,
+                 max_tokens=int(conf.QUERY_MAX_TOKENS) if conf.QUERY_MAX_TOKENS else None,
+                 temperature=float(conf.QUERY_TEMPERATURE),
+                 frequency_penalty=float(conf.QUERY_FREQUENCY_PENALTY),
+                 structured_output=conf.STRUCTURED_OUTPUT)
+
+
+@lru_cache()
+def routing_table() -> dict[str, Route]:
+    """Parse MODEL_ROUTES, raising on unknown fields so a typo doesn't silently route to the default."""
+    conf = get_settings()
+    if not conf.MODEL_ROUTES:
+        return {}
+    known = {f.name for f in fields(Route)}
+    table = {}
+    for key, overrides in json.loads(conf.MODEL_ROUTES).items():
+        unknown = set(overrides) - known
+        if unknown:
+            raise ValueError(f"MODEL_ROUTES[{key}] has unknown fields: {', '.join(sorted(unknown))}")
+        step = key.split(":", 1)[-1]
+        if step != "*" and step not in STEPS:
+            print("WARNING: MODEL_ROUTES entry for unknown step: ", key)
+        table[key] = replace(default_route(), **overrides)
+    return table
+
+
+def resolve_route(step: Optional[str], user: Optional[User] = None) -> Route:
+    table = routing_table()
+    tier = user_tier(user) if user is not None else None
+    candidates = []
+    if step is not None:
+        if tier is not None:
+            candidates.append(f"{tier}:{step}")
+        candidates.append(step)
+    if tier is not None:
+        candidates.append(f"{tier}:*")
+    candidates.append("*")
+    for key in candidates:
+        if key in table:
+            return table[key]
+    return default_route()
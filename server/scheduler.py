@@ -0,0 +1,132 @@
+import asyncio
+from dataclasses import dataclass, field
+from typing import Awaitable, Callable, Hashable, Optional
+from . import batch
+
+"""
+A dependency aware scheduler for generation steps.
+
+Nodes run once every node they depend on has finished, up to concurrency at a time. Among
+the nodes that are ready, the one heading the longest chain of work still to do goes first,
+so the critical path is never left waiting behind work that could have waited. A node can
+add nodes when it finishes (a chapter outline adds its scenes), estimate says how much work
+it will add so it's prioritised before its children exist.
+
+Nothing is kept in memory between runs: the graph is built from what's already in the
+database, finished nodes are added done, so a rerun picks up where the last one stopped.
+
+Workers wait for ready nodes idle (see batch.idle), so under a batch collector each round of
+ready nodes becomes one batch.
+"""
+
+PENDING = "pending"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# a node it depends on failed
+SKIPPED = "skipped"
+
+
+@dataclass
+class Node():
+    key: Hashable
+    # the nodes this one adds to the graph, if any
+    run: Optional[Callable[[], Awaitable[list["Node"]]]] = None
+    deps: set = field(default_factory=set)
+    status: str = PENDING
+    weight: float = 1
+    # work this node will add when it runs, in weight units
+    estimate: float = 0
+    error: Optional[BaseException] = None
+
+
+class Scheduler():
+    def __init__(self, concurrency: int):
+        self.concurrency = max(1, concurrency)
+        self.nodes: dict[Hashable, Node] = {}
+        self._changed = asyncio.Condition()
+        self._heights: Optional[dict[Hashable, float]] = None
+
+    def add(self, node: Node):
+        # dependencies that aren't in the graph are taken as met
+        node.deps = {dep for dep in node.deps if dep in self.nodes}
+        self.nodes[node.key] = node
+        self._heights = None
+
+    def heights(self) -> dict[Hashable, float]:
+        """The longest chain of weight, from each node to the end of the graph."""
+        if self._heights is not None:
+            return self._heights
+        children: dict[Hashable, list[Hashable]] = {key: [] for key in self.nodes}
+        for node in self.nodes.values():
+            for dep in node.deps:
+                children[dep].append(node.key)
+        heights: dict[Hashable, float] = {}
+
+        def height(key: Hashable) -> float:
+            if key not in heights:
+                node = self.nodes[key]
+                below = max((height(child) for child in children[key]), default=0)
+                heights[key] = node.weight + max(below, node.estimate if node.status == PENDING else 0)
+            return heights[key]
+
+        for key in self.nodes:
+            height(key)
+        self._heights = heights
+        return heights
+
+    def _next(self) -> Optional[Node]:
+        ready = []
+        for node in self.nodes.values():
+            if node.status != PENDING:
+                continue
+            states = [self.nodes[dep].status for dep in node.deps]
+            if any(state in (FAILED, SKIPPED) for state in states):
+                node.status = SKIPPED
+                self._heights = None
+                continue
+            if all(state == DONE for state in states):
+                ready.append(node)
+        if not ready:
+            return None
+        heights = self.heights()
+        return max(ready, key=lambda node: heights[node.key])
+
+    def counts(self) -> dict[str, int]:
+        counts: dict[str, int] = {}
+        for node in self.nodes.values():
+            counts[node.status] = counts.get(node.status, 0) + 1
+        return counts
+
+    async def _work(self):
+        while True:
+            async with self._changed:
+                node = self._next()
+                while node is None:
+                    if not any(n.status == RUNNING for n in self.nodes.values()):
+                        return
+                    async with batch.idle():
+                        await self._changed.wait()
+                    node = self._next()
+                node.status = RUNNING
+
+            added: list[Node] = []
+            try:
+                if node.run is not None:
+                    added = await node.run()
+                node.status = DONE
+            except Exception as e:
+                print("SCHEDULED STEP FAILED: ", node.key, repr(e))
+                node.status, node.error = FAILED, e
+
+            async with self._changed:
+                for new_node in added:
+                    self.add(new_node)
+                self._heights = None
+                print("SCHEDULER: ", node.key, node.status, self.counts())
+                self._changed.notify_all()
+
+    async def run(self) -> dict[str, int]:
+        """Run everything that can run, returning how many nodes ended in each state."""
+        await batch.gather(*(self._work() for _ in range(self.concurrency)))
+        return self.counts()
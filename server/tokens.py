@@ -0,0 +1,140 @@
+import hashlib
+import threading
+import tiktoken
+from collections import OrderedDict
+from functools import lru_cache
+from fastapi.concurrency import run_in_threadpool
+
+"""
+Token counting.
+
+Encodings are loaded once per process (tiktoken reads, and on first use downloads, the BPE
+ranks) and warmed at startup. Per-message counts are memoized on a hash of the content,
+since with continuations the same history gets counted again every round.
+"""
+
+DEFAULT_MODEL = "gpt-4-1106-preview"
+MESSAGE_CACHE_SIZE = 8192
+
+_message_token_cache: OrderedDict[tuple[str, str], int] = OrderedDict()
+_message_token_cache_lock = threading.Lock()
+
+
+@lru_cache(maxsize=None)
+def get_encoding(model: str = DEFAULT_MODEL) -> tiktoken.Encoding:
+    """Return the (process-wide, cached) encoding for a model."""
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        print("Warning: model not found. Using cl100k_base encoding.")
+        return tiktoken.get_encoding("cl100k_base")
+
+
+def warm_tokenizers(models: tuple[str, ...] = (DEFAULT_MODEL,)):
+    """
+    Load the encodings up front so the first request doesn't pay for it.
+
+    Failures are only logged, startup shouldn't die because the BPE file couldn't be fetched.
+    """
+    for model in models:
+        try:
+            get_encoding(model).encode("warm up")
+        except Exception as e:
+            print("WARNING: could not warm tokenizer for", model, e)
+
+
+def count_text_tokens(text: str, model: str = DEFAULT_MODEL) -> int:
+    """Count the tokens in a string, memoized on the content hash."""
+    encoding = get_encoding(model)
+    key = (encoding.name, hashlib.sha1(text.encode()).hexdigest())
+    with _message_token_cache_lock:
+        if key in _message_token_cache:
+            _message_token_cache.move_to_end(key)
+            return _message_token_cache[key]
+
+    count = len(encoding.encode(text))
+
+    with _message_token_cache_lock:
+        _message_token_cache[key] = count
+        while len(_message_token_cache) > MESSAGE_CACHE_SIZE:
+            _message_token_cache.popitem(last=False)
+    return count
+
+
+"""
+Slight variant of https://github.com/openai/openai-cookbook/blob/main/examples/How_to_count_tokens_with_tiktoken.ipynb
+
+NOTICE:
+Eyeball testing has determined that this overestimates tokens by ~1% for gpt-4-1106-preview.
+"""
+def num_tokens_from_messages(messages, model=DEFAULT_MODEL):
+    """Return the number of tokens used by a list of messages."""
+    if model in {
+        "gpt-3.5-turbo-0613",
+        "gpt-3.5-turbo-16k-0613",
+        "gpt-4-0314",
+        "gpt-4-32k-0314",
+        "gpt-4-0613",
+        "gpt-4-32k-0613",
+        "gpt-4-1106-preview"
+        }:
+        tokens_per_message = 3
+        tokens_per_name = 1
+    elif model == "gpt-3.5-turbo-0301":
+        tokens_per_message = 4  # every message follows <|start|>{role/name}\n{content}<|end|>\n
+        tokens_per_name = -1  # if there's a name, the role is omitted
+    elif "gpt-3.5-turbo" in model:
+        print("Warning: gpt-3.5-turbo may update over time. Returning num tokens assuming gpt-3.5-turbo-0613.")
+        return num_tokens_from_messages(messages, model="gpt-3.5-turbo-0613")
+    elif "gpt-4" in model:
+        print("Warning: gpt-4 may update over time. Returning num tokens assuming gpt-4-0613.")
+        return num_tokens_from_messages(messages, model="gpt-4-0613")
+    else:
+        # routed to a model we don't know the chat format of (a local one, most likely).
+        # an estimate beats failing the call over it.
+        print(f"Warning: num_tokens_from_messages() is not implemented for model {model}. Estimating with gpt-4 message overhead.")
+        tokens_per_message = 3
+        tokens_per_name = 1
+    num_tokens = 0
+    for message in messages:
+        num_tokens += tokens_per_message
+        for key, value in message.items():
+            num_tokens += count_text_tokens(value, model)
+            if key == "name":
+                num_tokens += tokens_per_name
+    num_tokens += 3  # every reply is primed with <|start|>assistant<|message|>
+    return num_tokens
+
+
+async def async_num_tokens_from_messages(messages, model=DEFAULT_MODEL) -> int:
+    """num_tokens_from_messages, run in the threadpool to keep BPE work off the event loop."""
+    return await run_in_threadpool(num_tokens_from_messages, messages, model)
+
+
+def usage_tokens(usage) -> tuple[int, int] | None:
+    """
+    Pull (prompt_tokens, completion_tokens) out of a provider usage block.
+
+    Streamed usage arrives on the final chunk; depending on the client version it is either
+    a model or a plain dict, so we accept both.
+    """
+    if usage is None:
+        return None
+    if isinstance(usage, dict):
+        prompt_tokens, completion_tokens = usage.get("prompt_tokens"), usage.get("completion_tokens")
+    else:
+        prompt_tokens, completion_tokens = getattr(usage, "prompt_tokens", None), getattr(usage, "completion_tokens", None)
+    if prompt_tokens is None or completion_tokens is None:
+        return None
+    return int(prompt_tokens), int(completion_tokens)
+
+
+def cached_prompt_tokens(usage) -> int | None:
+    """How many prompt tokens the provider served from its prefix cache, if it says."""
+    if usage is None:
+        return None
+    details = usage.get("prompt_tokens_details") if isinstance(usage, dict) else getattr(usage, "prompt_tokens_details", None)
+    if details is None:
+        return None
+    cached = details.get("cached_tokens") if isinstance(details, dict) else getattr(details, "cached_tokens", None)
+    return int(cached) if cached is not None else None
@@ -1,4 +1,7 @@
+import json
 import re
+from functools import lru_cache
+from .config import get_settings
 
 def strip_tabs(string):
     """
@@ -9,16 +12,44 @@ def strip_tabs(string):
     comp = re.compile(r'^(\s{4})+', re.MULTILINE)
     return comp.sub('', string)
 
-def calc_cost(prompt_tokens, completion_tokens):
+# USD per 1K (prompt, completion) tokens
+MODEL_PRICES: dict[str, tuple[float, float]] = {
+    "gpt-4-1106-preview": (0.01, 0.03),
+    "gpt-4": (0.03, 0.06),
+    "gpt-4-0613": (0.03, 0.06),
+    "gpt-4-32k": (0.06, 0.12),
+    "gpt-3.5-turbo-1106": (0.001, 0.002),
+    "gpt-3.5-turbo": (0.0015, 0.002),
+    "gpt-3.5-turbo-0613": (0.0015, 0.002),
+    "gpt-3.5-turbo-16k": (0.003, 0.004),
+}
+
+DEFAULT_PRICE_MODEL = "gpt-4-1106-preview"
+
+
+@lru_cache()
+def model_prices() -> dict[str, tuple[float, float]]:
+    """MODEL_PRICES with the MODEL_PRICES setting (JSON of model -> [prompt, completion]) on top."""
+    prices = dict(MODEL_PRICES)
+    overrides = get_settings().MODEL_PRICES
+    if overrides:
+        prices.update({model: (float(p[0]), float(p[1])) for model, p in json.loads(overrides).items()})
+    return prices
+
+
+def calc_cost(prompt_tokens, completion_tokens, model=DEFAULT_PRICE_MODEL):
     """
     Calc costs.
 
-    Current:
-    $0.01 / 1K tokens	$0.03 / 1K tokens
+    Priced per model, see MODEL_PRICES. Models we don't know are priced as gpt-4-1106-preview,
+    overestimating is better than calling them free.
     """
+    prices = model_prices()
+    if model not in prices:
+        print("Warning: no price for model", model, "pricing as", DEFAULT_PRICE_MODEL)
+    prompt_price, completion_price = prices.get(model, prices[DEFAULT_PRICE_MODEL])
 
-    prompt_cost = prompt_tokens / 1000 * 0.01
-    completion_cost = completion_tokens / 1000 * 0.03
+    prompt_cost = prompt_tokens / 1000 * prompt_price
+    completion_cost = completion_tokens / 1000 * completion_price
 
     return prompt_cost + completion_cost
-
@@ -0,0 +1,43 @@
+import asyncio
+from server import formats
+from server.repair import Repairer
+
+
+def chapter(number: int) -> str:
+    return f"""\
+### Chapter {number} — The Title
+#### Chapter Purpose
+Sets up the conflict.
+#### Main Events
+- The first event
+- The second event
+- The third event
+#### Chapter Summary
+A paragraph summarizing the chapter.
+#### Chapter Notes
+Foreshadows the ending."""
+
+
+OUTLINE = "# Outline\n\n## Part 1 — The Beginning\n" + "\n".join(chapter(number) for number in range(1, 6)) + \
+    "\n\n# FactSheet\nFacts about the story."
+
+
+def check(output: str) -> dict:
+    splits = formats.split_sections(output)
+    formats.parse_story_outline_complex(splits["outline"])
+    return splits
+
+
+def test_clean_complex_outline_is_complete():
+    repairer = Repairer(check, formats.parse_story_outline_complex, "outline")
+    assert repairer.incomplete(OUTLINE) == []
+    assert repairer.complete(OUTLINE)
+
+
+def test_output_that_parses_is_not_repaired():
+    repairer = Repairer(check, formats.parse_story_outline_complex, "outline")
+
+    async def ask(request: str) -> str:
+        raise AssertionError(f"asked a follow up: {request}")
+
+    assert asyncio.run(repairer(OUTLINE, ask)) == OUTLINE